@@ -0,0 +1,104 @@
+'''
+Shard count of counters driven by observed contention
+'''
+import math
+import time
+import threading
+
+_DEFAULT_MIN_SHARDS = 1
+_DEFAULT_MAX_SHARDS = 64
+_DEFAULT_GROW_THRESHOLD = 5.0
+_DEFAULT_SHRINK_THRESHOLD = 0.5
+_DEFAULT_HALF_LIFE = 10.0
+_DEFAULT_COOLDOWN = 60.0
+
+
+class _CounterState(object):
+
+    __slots__ = ('shard_count', 'score', 'updated', 'resized')
+
+    def __init__(self, shard_count, now):
+        self.shard_count = shard_count
+        self.score = 0.0
+        self.updated = now
+        self.resized = now
+
+
+class AdaptiveShardCount(object):
+
+    """
+    keep a shard count per counter that follows contention
+
+    Every conflict (Azure etag retry) or throttle (DynamoDB
+    ProvisionedThroughputExceeded) of a counter adds to its contention score,
+    which halves every `half_life` seconds.
+    - a score over grow_threshold doubles the shard count, up to max_shards
+    - a score under shrink_threshold halves it, down to min_shards,
+      at most once every `cooldown` seconds, so cold counters spread over fewer shards
+
+    Settings, for any engine
+    'adaptive_shard_counters': {'min_shards': 1, 'max_shards': 64,
+                                'grow_threshold': 5, 'shrink_threshold': 0.5,
+                                'half_life': 10, 'cooldown': 60}
+    """
+
+    def __init__(self, min_shards=_DEFAULT_MIN_SHARDS, max_shards=_DEFAULT_MAX_SHARDS,
+                 grow_threshold=_DEFAULT_GROW_THRESHOLD, shrink_threshold=_DEFAULT_SHRINK_THRESHOLD,
+                 half_life=_DEFAULT_HALF_LIFE, cooldown=_DEFAULT_COOLDOWN):
+        self.min_shards = max(int(min_shards), 1)
+        self.max_shards = max(int(max_shards), self.min_shards)
+        self.grow_threshold = grow_threshold
+        self.shrink_threshold = shrink_threshold
+        self.half_life = half_life
+        self.cooldown = cooldown
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def shard_count(self, table_name, key):
+        """
+        the shard count a writer should use now
+        """
+        with self._lock:
+            state = self._counters.get((table_name, key))
+            if state is None:
+                return self.min_shards
+            now = time.time()
+            self._decay(state, now)
+            if state.score < self.shrink_threshold and now - state.resized >= self.cooldown:
+                if state.shard_count <= self.min_shards:
+                    del self._counters[(table_name, key)]  # cold again, forget it
+                    return self.min_shards
+                state.shard_count = max(state.shard_count // 2, self.min_shards)
+                state.resized = now
+            return state.shard_count
+
+    def record(self, table_name, key, events=1):
+        """
+        record contention events of a counter
+        returns the shard count after the events
+        """
+        with self._lock:
+            now = time.time()
+            state = self._counters.get((table_name, key))
+            if state is None:
+                state = self._counters[(table_name, key)] = _CounterState(self.min_shards, now)
+            self._decay(state, now)
+            state.score += events
+            if state.score >= self.grow_threshold and state.shard_count < self.max_shards:
+                state.shard_count = min(state.shard_count * 2, self.max_shards)
+                state.score = 0.0  # give the new shards a chance before growing again
+                state.resized = now
+            return state.shard_count
+
+    def stats(self):
+        """
+        returns {(table_name, key): (shard_count, contention score)} of the tracked counters
+        """
+        with self._lock:
+            return dict((counter, (state.shard_count, state.score))
+                        for counter, state in self._counters.iteritems())
+
+    def _decay(self, state, now):
+        if self.half_life and now > state.updated:
+            state.score *= math.pow(0.5, (now - state.updated) / self.half_life)
+        state.updated = now
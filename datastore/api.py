@@ -8,6 +8,38 @@ Created on 2014/1/23
 from dynamodb import DynamoDB
 from functools import partial
 from azuretable import AzureTable
+from memory import MemoryStore
+from replicated import ReplicatedStore
+from cluster import ClusterStore
+from buffer import IncrBuffer
+from cache import LRUCache
+from metrics import Metrics, measured
+from lifecycle import TableLifecycle
+from topk import TopKTracker
+import transfer
+import topk
+
+# engine methods that make no request, or only once iterated
+_UNMEASURED = frozenset(['instrument', 'last_retries', 'retry_stats', 'sharded_key', 'writer_row_key', 'scan',
+                         'replication_stats', 'drain'])
+
+
+def create_engine(settings):
+    """
+    the engine of settings['engine']
+    """
+    engine = settings['engine'].lower()
+    if engine == 'dynamodb':
+        return DynamoDB(settings)
+    elif engine == 'azure_table':
+        return AzureTable(settings)
+    elif engine == 'memory':
+        return MemoryStore(settings)
+    elif engine == 'replicated':
+        return ReplicatedStore(settings, create_engine)
+    elif engine == 'cluster':
+        return ClusterStore(settings, create_engine)
+    raise NotImplementedError("%s datastore is not implement yet." % settings.get('engine'))
 
 
 class Datastore():
@@ -33,6 +65,54 @@ class Datastore():
         'account_key': AZURE_ACCOUNT_KEY
     }
 
+    Memory Example settings, see memory.MemoryStore
+    'memory': {
+        'engine': 'memory',
+        'latency': 0.005,
+        'throttle': False
+    }
+
+    Replicated Example settings, see replicated.ReplicatedStore
+    'replicated': {
+        'engine': 'replicated',
+        'primary': {'engine': 'dynamodb', ...},
+        'secondary': {'engine': 'azure_table', ...},
+        'hedge_delay': 0.05
+    }
+
+    Cluster Example settings, see cluster.ClusterStore
+    'cluster': {
+        'engine': 'cluster',
+        'nodes': {'a': {'engine': 'dynamodb', ...}, 'b': {'engine': 'dynamodb', ...}},
+        'vnodes': 100
+    }
+
+    Optional settings for both engines
+    'incr_buffer': {'max_size': 1000,  # flush after this many pending increments
+                    'interval': 1      # flush every second, 0 to flush manually
+                    }
+    buffer increments in memory and write one summed incr per counter on flush,
+    call flush() to write them immediately
+
+    'cache': {'max_entries': 10000,
+              'max_bytes': 64 * 1024 * 1024,
+              'ttl': 60,                    # seconds
+              'table_ttl': {'config': 300}  # per table ttl, 0 disables caching
+              }
+    cache decoded get_data results in process, set/delete through this
+    instance invalidate the cached key, see cache_stats()
+
+    'metrics': {'statsd': {'host': 'localhost', 'port': 8125}}  # or True
+    record every call, see stats() and metrics.Metrics
+
+    'table_lifecycle': {'tables': {'events_%Y%m%d': {'ahead': 1, 'retention': 30}}}
+    create time sliced tables ahead and expire them in the background,
+    see lifecycle.TableLifecycle, DynamoDB and memory engines only
+
+    'top_k': {'tables': ['counter'], 'capacity': 100, 'interval': 10}  # or True
+    track the largest counters of the tables fed by incr, see top_k()
+    and topk.TopKTracker
+
     Potential Errors:
     from boto.dynamodb.exceptions import DynamoDBResponseError
     #connection, attempt to delete while creating, dulplicate table name
@@ -41,16 +121,162 @@ class Datastore():
     def __init__(self, settings):
 
         self.settings = settings
-        if self.settings['engine'].lower() == 'dynamodb':
-            self.db = DynamoDB(settings)
-        elif self.settings['engine'].lower() == 'azure_table':
-            self.db = AzureTable(settings)
-        else:
-            raise NotImplementedError("%s datastore is not implement yet." %
-                                      self.settings.get('engine'))
+        self.db = create_engine(settings)
+
+        self.incr_buffer = None
+        if self.settings.get('incr_buffer'):
+            self.incr_buffer = IncrBuffer(self.db.incr, **self.settings['incr_buffer'])
+
+        self.cache = None
+        if self.settings.get('cache'):
+            self.cache = LRUCache(**self.settings['cache'])
+
+        self.metrics = None
+        if self.settings.get('metrics'):
+            options = self.settings['metrics']
+            self.metrics = Metrics(**(options if isinstance(options, dict) else {}))
+            self.db.instrument(self.metrics)
+
+        self.lifecycle = None
+        if self.settings.get('table_lifecycle'):
+            self.lifecycle = TableLifecycle(self.db, **self.settings['table_lifecycle'])
+
+        self.top_k_tracker = None
+        if self.settings.get('top_k'):
+            options = self.settings['top_k']
+            self.top_k_tracker = TopKTracker(self.db, **(options if isinstance(options, dict) else {}))
+
+    @measured
+    def get_data(self, table_name, key, *args, **kwargs):
+        """
+        only plain get_data(table_name, key) calls are cached
+        """
+        if self.cache is None or args or kwargs:
+            return self.db.get_data(table_name, key, *args, **kwargs)
+        hit, data = self.cache.get(table_name, key)
+        if not hit:
+            generation = self.cache.generation(table_name, key)
+            data = self.db.get_data(table_name, key)
+            self.cache.set(table_name, key, data, generation)  # not if a write invalidated the key meanwhile
+        return data
+
+    @measured
+    def set_data(self, table_name, key, *args, **kwargs):
+        result = self.db.set_data(table_name, key, *args, **kwargs)
+        self._invalidate(table_name, [key])
+        return result
+
+    @measured
+    def delete_data(self, table_name, key, *args, **kwargs):
+        result = self.db.delete_data(table_name, key, *args, **kwargs)
+        self._invalidate(table_name, [key])
+        return result
+
+    @measured
+    def set_many(self, table_name, items, *args, **kwargs):
+        result = self.db.set_many(table_name, items, *args, **kwargs)
+        self._invalidate(table_name, items)
+        return result
+
+    @measured
+    def delete_many(self, table_name, keys, *args, **kwargs):
+        keys = list(keys)
+        result = self.db.delete_many(table_name, keys, *args, **kwargs)
+        self._invalidate(table_name, keys)
+        return result
+
+    @measured
+    def cas(self, table_name, key, expected_version, data, *args, **kwargs):
+        """
+        write data if the key is still at expected_version, see conditional.CasResult
+        """
+        result = self.db.cas(table_name, key, expected_version, data, *args, **kwargs)
+        self._invalidate(table_name, [key])
+        return result
+
+    @measured
+    def update_if(self, table_name, key, func, *args, **kwargs):
+        """
+        cas func(current value) until it's written, see conditional.update_if
+        """
+        result = self.db.update_if(table_name, key, func, *args, **kwargs)
+        self._invalidate(table_name, [key])
+        return result
+
+    def export_table(self, table_name, path, **kwargs):
+        """
+        write the table to a local file, see transfer.export_table
+        """
+        return transfer.export_table(self, table_name, path, **kwargs)
+
+    def import_table(self, table_name, path, **kwargs):
+        """
+        write an exported file to the table with set_many, see transfer.import_table
+        the file may come from another engine
+        """
+        return transfer.import_table(self, table_name, path, **kwargs)
+
+    def _invalidate(self, table_name, keys):
+        """
+        drop cached keys once the write is done
+        """
+        if self.cache is not None:
+            for key in keys:
+                self.cache.invalidate(table_name, key)
+
+    def stats(self):
+        """
+        snapshot of the metrics, see metrics.Metrics.stats
+        """
+        if self.metrics is not None:
+            return self.metrics.stats()
+        return None
+
+    def cache_stats(self):
+        if self.cache is not None:
+            return self.cache.stats()
+        return None
+
+    @measured
+    def incr(self, table_name, key, amount=1, shard_count=1):
+        if self.top_k_tracker is not None:
+            self.top_k_tracker.offer(table_name, key, amount)
+        if self.incr_buffer is None:
+            return self.db.incr(table_name, key, amount=amount, shard_count=shard_count)
+        return self.incr_buffer.incr(table_name, key, amount=amount, shard_count=shard_count)
+
+    @measured
+    def flush(self):
+        """
+        write buffered increments to the backend, and merge the tracked top-K
+        """
+        if self.top_k_tracker is not None:
+            self.top_k_tracker.flush()
+        if self.incr_buffer is not None:
+            return self.incr_buffer.flush()
+        return 0
+
+    @measured
+    def top_k(self, table_name, k):
+        """
+        [(key, count), ...] of the k largest counters of the table, as of the
+        last merge of the tracked top-K, see topk.TopKTracker
+        """
+        return topk.top_k(self.db, table_name, k)
+
+    def close(self):
+        if self.top_k_tracker is not None:
+            self.top_k_tracker.close()
+        if self.incr_buffer is not None:
+            self.incr_buffer.close()
+        if self.lifecycle is not None:
+            self.lifecycle.close()
 
     def __wrap(self, method, *args, **kwargs):
-        return getattr(self.db, method)(*args, **kwargs)
+        if self.metrics is None or method in _UNMEASURED:
+            return getattr(self.db, method)(*args, **kwargs)
+        table_name = args[0] if args and isinstance(args[0], basestring) else None
+        return self.metrics.measure(method, table_name, getattr(self.db, method), *args, **kwargs)
 
     def __getattr__(self, method):
         return partial(self.__wrap, method)
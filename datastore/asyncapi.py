@@ -0,0 +1,119 @@
+'''
+Non-blocking Datastore client
+'''
+import time
+from multiprocessing.pool import ThreadPool
+from api import Datastore
+
+_DEFAULT_MAX_CONCURRENCY = 10
+_DEFAULT_BATCH_CHUNK_SIZE = 100
+
+
+class GatheredResult(object):
+
+    """
+    AsyncResult-like result of many AsyncResults, combined by `combine`
+    timeout is for all the results together
+    """
+
+    def __init__(self, results, combine):
+        self.results = results
+        self.combine = combine
+
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        return self.combine([result.get(_remaining(deadline)) for result in self.results])
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        for result in self.results:
+            result.wait(_remaining(deadline))
+
+    def ready(self):
+        return all(result.ready() for result in self.results)
+
+    def successful(self):
+        return all(result.successful() for result in self.results)
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0)
+
+
+class AsyncDatastore(object):
+
+    """
+    Every call is run on a bounded thread pool and returns immediately with a
+    multiprocessing.pool.AsyncResult, call .get() on it to wait for the value.
+
+    db = AsyncDatastore(settings, max_concurrency=20)
+    result = db.get_data('table', 'key')
+    ...
+    data = result.get(timeout=5)
+
+    max_concurrency: max number of requests in flight, further calls are queued
+    All calls share the Datastore, so its connection, cache and incr buffer are reused.
+    Batch reads are split into chunks fetched concurrently.
+    """
+
+    def __init__(self, settings, max_concurrency=None, datastore=None):
+        self.settings = settings
+        self.datastore = datastore if datastore is not None else Datastore(settings)
+        self.max_concurrency = max_concurrency or settings.get('max_concurrency', _DEFAULT_MAX_CONCURRENCY)
+        self.pool = ThreadPool(self.max_concurrency)
+
+    def submit(self, method, *args, **kwargs):
+        """
+        run any Datastore method on the pool
+        """
+        return self.pool.apply_async(getattr(self.datastore, method), args, kwargs)
+
+    def get_data(self, table_name, key, *args, **kwargs):
+        return self.submit('get_data', table_name, key, *args, **kwargs)
+
+    def set_data(self, table_name, key, data, *args, **kwargs):
+        return self.submit('set_data', table_name, key, data, *args, **kwargs)
+
+    def delete_data(self, table_name, key, *args, **kwargs):
+        return self.submit('delete_data', table_name, key, *args, **kwargs)
+
+    def incr(self, table_name, key, amount=1, shard_count=1):
+        return self.submit('incr', table_name, key, amount=amount, shard_count=shard_count)
+
+    def get_count(self, table_name, key, *args, **kwargs):
+        return self.submit('get_count', table_name, key, *args, **kwargs)
+
+    def delete_counter(self, table_name, key, *args, **kwargs):
+        return self.submit('delete_counter', table_name, key, *args, **kwargs)
+
+    def get_many(self, table_name, keys, chunk_size=_DEFAULT_BATCH_CHUNK_SIZE, **kwargs):
+        """
+        fetch chunks of keys concurrently, the result is a dict keyed by the input keys
+        """
+        keys = list(keys)
+        results = [self.submit('get_many', table_name, keys[i:i + chunk_size], **kwargs)
+                   for i in xrange(0, len(keys), chunk_size)]
+        return GatheredResult(results, _merge_dicts)
+
+    def get_counts(self, table_name, keys, **kwargs):
+        """
+        the engine reads the counters in bulk, the result is a dict of key to count
+        """
+        return self.submit('get_counts', table_name, list(keys), **kwargs)
+
+    def close(self):
+        """
+        wait for calls in flight and stop the pool
+        """
+        self.pool.close()
+        self.pool.join()
+        self.datastore.close()
+
+
+def _merge_dicts(dicts):
+    merged = {}
+    for d in dicts:
+        merged.update(d)
+    return merged
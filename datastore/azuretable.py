@@ -3,19 +3,64 @@ Created on 2014/2/5
 
 @author: sushih-wen
 '''
-import time
+import os
+import base64
+import httplib
+import datetime
 import random
+import logging
+import time
+import socket
+import itertools
+import threading
+from multiprocessing.pool import ThreadPool
 from azure import storage
+from azure.http.httpclient import _HTTPClient
 from azure import WindowsAzureError
 from azure import WindowsAzureConflictError
 from azure import WindowsAzureMissingResourceError
+from adaptive import AdaptiveShardCount
+from codec import CodecRegistry
+from retry import RetryPolicy, RetryError, full_jitter_backoff
+from pool import ClientPool, ClientProxy
+from scan import scan_pages, RateLimiter
+from chunking import ValueChunker, ChunkError
+from conditional import CasResult
+from window import Window, bucket_bounds
+import hyperloglog
+import chunking
+import conditional
+import codec
+
+logger = logging.getLogger(__name__)
 
 _COUNTER_EXCEEDED_MAX_RETRY = 'Counter exceeded max retry'
 _COUNTER_DEFAULT_SHARD_FORMAT = 'shard_%s'
 _COUNTER_DEFAULT_ROW_KEY = 'shard_1'
+_COUNTER_WRITER_ROW_KEY_FORMAT = 'writer_%s_%s_%s_%s'
+_COUNTER_WRITER_BASE_ROW_KEY = 'writer'  # the counts of idle writer rows, sorts before them
+_COUNTER_WRITER_ATTEMPTS = 2  # a lost etag is read again once
+_COUNTER_WRITER_IDLE = 3600  # seconds after which a writer row is folded into the base row
+_COUNTER_DEFAULT_MAX_RETRY = 100
+_COUNTER_DEFAULT_DEADLINE = 30.0  # seconds an incr may spend on etag conflicts
+_DISTINCT_ROW_KEY_PREFIX = 'distinct_'
+_BATCH_MAX_OPERATIONS = 100
+_QUERY_MAX_PARTITIONS = 50
+_WINDOW_SHARD_COUNT = 8  # rows of a window bucket, incr_window picks one at random
+_QUERY_WORKERS = 8  # partition requests of one get_counts or set_many sent at the same time
+_CHUNK_SIZE = 45 * 1024  # 60 KB in base64, properties hold 64 KB
+_CHUNKS_PER_REQUEST = 16  # batches hold 4 MB
+_RETRY = object()  # returned by _try_incr to ask for a retry
+_IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD'])  # resent after a kept connection failed on them
+_UNCONDITIONAL_METHODS = frozenset(['PUT', 'MERGE', 'DELETE'])  # resent as well when they carry no If-Match
+_KEEP_ALIVE_IDLE = 30  # seconds a connection is kept unused, servers close idle ones
 
 # Errors
 _TABLE_NAME_ERROR = 'Table name error'
+_PRECONDITION_FAILED = 'Precondition Failed'  # 412 of an update on a changed etag
+
+
+_INSTANCE_IDS = itertools.count(1)  # the writer rows of every AzureTable of a process differ
 
 
 class AzureTableError(Exception):
@@ -35,11 +80,54 @@ class AzureTable(object):
 
     def __init__(self, settings):
         self.settings = settings
-        self.tableservice = storage.TableService(
-            account_name=settings['account_name'],
-            account_key=settings['account_key'])
+        #
+        # a TableService per thread, batches are kept on it, see pool.ClientPool
+        #
+        self.clients = ClientPool(self._connect, **(settings.get('client_pool') or {}))
+        self.tableservice = ClientProxy(self.clients)
         self.counter_property = settings.get('counter_property', 'c')
-        self.max_counter_retry = settings.get('max_counter_retry', 100)
+        self.retry_policy = RetryPolicy(**(settings.get('retry') or {}))
+        #
+        # etag conflicts of a hot counter are retried many times, but not for longer
+        # than counter_deadline seconds, the retry deadline if there is one
+        #
+        self.max_counter_retry = settings.get('max_counter_retry', _COUNTER_DEFAULT_MAX_RETRY)
+        self.counter_deadline = settings.get('counter_deadline',
+                                             self.retry_policy.deadline or _COUNTER_DEFAULT_DEADLINE)
+        self.codecs = CodecRegistry(settings)
+        #
+        # the chunks of a large value are rows of its partition, see chunking.ValueChunker
+        #
+        chunked_values = settings.get('chunked_values')
+        self.chunker = ValueChunker(**dict({'chunk_size': _CHUNK_SIZE if chunked_values else None},
+                                           **(chunked_values if isinstance(chunked_values, dict) else {})))
+        #
+        # writer shard counters give every thread of every instance its own row
+        # in the counter's partition, writers never contend
+        #
+        self.writer_shard_counters = settings.get('writer_shard_counters', False)
+        self.writer_row_idle = settings.get('writer_row_idle', _COUNTER_WRITER_IDLE)
+        self._writer = threading.local()
+        self._instance_id = next(_INSTANCE_IDS)
+        self._counter_generations = {}  # (table_name, key) -> times deleted by this process
+        self.adaptive = None
+        if settings.get('adaptive_shard_counters'):
+            self.adaptive = AdaptiveShardCount(**settings['adaptive_shard_counters'])
+        self.distinct_counters = settings.get('distinct_counters') or {}
+        self.window_shard_count = settings.get('window_shard_count', _WINDOW_SHARD_COUNT)
+        self.query_workers = settings.get('query_workers', _QUERY_WORKERS)
+        self._query_pool = None
+        self._query_pool_lock = threading.Lock()
+
+    def _connect(self):
+        tableservice = storage.TableService(
+            account_name=self.settings['account_name'],
+            account_key=self.settings['account_key'])
+        tableservice._httpclient = _KeepAliveHTTPClient(service_instance=tableservice,
+                                                        account_key=tableservice.account_key,
+                                                        account_name=tableservice.account_name,
+                                                        protocol=tableservice.protocol)
+        return tableservice
 
     def create_table(self, table_name, fail_on_exist=False):
         """
@@ -66,35 +154,496 @@ class AzureTable(object):
     def set_data(self, table_name, key, data, row_key=''):
         """
         use upsert
+        with chunked values, the value is read first to delete the chunks it replaces
         """
         partition_key = key
-        return self.tableservice.insert_or_replace_entity(table_name, partition_key, row_key, {'data': data})
+        data = self._encode_data(table_name, data)
+        if not self.chunker.enabled:
+            return self.tableservice.insert_or_replace_entity(table_name, partition_key, row_key, {'data': data})
+        old = self._get_raw_data(table_name, partition_key, row_key)
+        data = self._write_chunks(table_name, partition_key, row_key, data)
+        result = self.tableservice.insert_or_replace_entity(table_name, partition_key, row_key, {'data': data})
+        self._delete_chunks(table_name, partition_key, row_key, old)
+        return result
 
     def get_data(self, table_name, key, row_key='', select='data'):
         partition_key = key
         try:
             entity = self.tableservice.get_entity(table_name, partition_key, row_key, select=select)
-            return entity.data
+            data = getattr(entity, 'data', None)
+            try:
+                return self._decode_value(table_name, partition_key, row_key, data)
+            except ChunkError:
+                # replaced while its chunks were read, the new chunks are there before the new manifest
+                data = self._get_raw_data(table_name, partition_key, row_key)
+                return self._decode_value(table_name, partition_key, row_key, data)
+        except WindowsAzureMissingResourceError:
+            return None
+
+    def get_versioned(self, table_name, key, row_key=''):
+        """
+        (etag, data) of the entity, (None, None) if it's missing
+        """
+        partition_key = key
+        try:
+            entity = self.tableservice.get_entity(table_name, partition_key, row_key, select='data')
+        except WindowsAzureMissingResourceError:
+            return None, None
+        return entity.etag, self._decode_value(table_name, partition_key, row_key, getattr(entity, 'data', None))
+
+    def cas(self, table_name, key, expected_version, data, row_key=''):
+        """
+        write data if the etag of the entity is still expected_version,
+        None for a missing entity, see get_versioned
+        one insert or if-match update, on conflict the current value is read,
+        returns a conditional.CasResult with the new etag
+        """
+        partition_key = key
+        encoded = self._encode_data(table_name, data)
+        old = None
+        if self.chunker.enabled:
+            if expected_version is not None:
+                old = self._get_raw_data(table_name, partition_key, row_key)
+            encoded = self._write_chunks(table_name, partition_key, row_key, encoded)
+        try:
+            if expected_version is None:
+                etag = self.tableservice.insert_entity(
+                    table_name, {'PartitionKey': partition_key, 'RowKey': row_key, 'data': encoded}).etag
+            else:
+                etag = self.tableservice.update_entity(table_name, partition_key, row_key, {'data': encoded},
+                                                       if_match=expected_version)['etag']
+        except WindowsAzureError as e:
+            if not isinstance(e, (WindowsAzureConflictError, WindowsAzureMissingResourceError)) \
+                    and _PRECONDITION_FAILED not in str(e):
+                raise
+            self._delete_chunks(table_name, partition_key, row_key, encoded)
+            current_version, current = self.get_versioned(table_name, key, row_key)
+            return CasResult(False, current_version, current)
+        self._delete_chunks(table_name, partition_key, row_key, old)
+        return CasResult(True, etag, data)
+
+    def update_if(self, table_name, key, func, max_retries=None, row_key=''):
+        """
+        cas func(current value) until it's written, see conditional.update_if
+        """
+        return conditional.update_if(self, table_name, key, func, max_retries=max_retries, row_key=row_key)
+
+    def _get_raw_data(self, table_name, partition_key, row_key):
+        try:
+            return getattr(self.tableservice.get_entity(table_name, partition_key, row_key, select='data'), 'data', None)
         except WindowsAzureMissingResourceError:
             return None
 
+    def _encode_data(self, table_name, data):
+        """
+        data is stored as is, or encoded by the table's codec as an Edm.Binary property
+        """
+        value_codec = self.codecs.get(table_name)
+        if value_codec is None:
+            return data
+        return storage.EntityProperty('Edm.Binary', base64.b64encode(value_codec.encode(data)))
+
+    def _decode_value(self, table_name, partition_key, row_key, data):
+        """
+        decode data, or the value of a manifest from its chunks
+        """
+        manifest = self._chunk_manifest(data)
+        if manifest is None:
+            return self._decode_data(data)
+        value = self._read_chunks(table_name, partition_key, row_key, manifest)
+        if codec.is_encoded(value):
+            return codec.decode(value)
+        return value
+
+    def _chunk_manifest(self, data):
+        if isinstance(data, storage.EntityProperty) and data.type == 'Edm.Binary' and data.value:
+            value = base64.b64decode(data.value)
+            if chunking.is_manifest(value):
+                return value
+        return None
+
+    def _write_chunks(self, table_name, partition_key, row_key, data):
+        """
+        write the chunks of a large value as rows of its partition,
+        returns the manifest to write, or data if it fits
+        """
+        if isinstance(data, storage.EntityProperty) and data.type == 'Edm.Binary':
+            value = base64.b64decode(data.value)
+        elif isinstance(data, str):
+            value = data
+        else:
+            return data
+        manifest, chunks = self.chunker.split(row_key, value)
+        if not chunks:
+            return data
+        self._batch_by_partition([(partition_key, self.tableservice.insert_or_replace_entity,
+                                   (table_name, partition_key, chunk_row_key,
+                                    {'data': storage.EntityProperty('Edm.Binary', base64.b64encode(chunk))}))
+                                  for chunk_row_key, chunk in chunks], _CHUNKS_PER_REQUEST)
+        return storage.EntityProperty('Edm.Binary', base64.b64encode(manifest))
+
+    def _read_chunks(self, table_name, partition_key, row_key, manifest):
+        """
+        the value of a manifest, ranges of its chunk rows are queried in parallel
+        """
+        chunk_row_keys = self.chunker.chunk_keys(row_key, manifest)
+        groups = [chunk_row_keys[i:i + _CHUNKS_PER_REQUEST]
+                  for i in xrange(0, len(chunk_row_keys), _CHUNKS_PER_REQUEST)]
+
+        def read(group):
+            query = "PartitionKey eq '%s' and RowKey ge '%s' and RowKey le '%s'" % (
+                _quote(partition_key), _quote(group[0]), _quote(group[-1]))
+            return [(entity.RowKey, base64.b64decode(entity.data.value))
+                    for entity in self._query_all(table_name, query, 'RowKey,data')]
+
+        return self.chunker.join(row_key, manifest, dict(chunk for found in self.chunker.map(read, groups)
+                                                         for chunk in found))
+
+    def _delete_chunks(self, table_name, partition_key, row_key, old):
+        """
+        delete the chunks of a replaced or deleted value
+        """
+        manifest = self._chunk_manifest(old)
+        if manifest is not None:
+            self._batch_by_partition([(partition_key, self.tableservice.delete_entity,
+                                       (table_name, partition_key, chunk_row_key))
+                                      for chunk_row_key in self.chunker.chunk_keys(row_key, manifest)])
+
+    def _query_all(self, table_name, query, select):
+        """
+        the entities of every page of a query
+        """
+        entities = []
+        next_partition_key = next_row_key = None
+        while True:
+            page = self.tableservice.query_entities(table_name, query, select=select,
+                                                    next_partition_key=next_partition_key,
+                                                    next_row_key=next_row_key)
+            entities.extend(page)
+            continuation = getattr(page, 'x_ms_continuation', None)
+            if not continuation or not continuation.get('nextpartitionkey'):
+                return entities
+            next_partition_key = continuation.get('nextpartitionkey')
+            next_row_key = continuation.get('nextrowkey') or None
+
+    def _decode_data(self, data):
+        if isinstance(data, storage.EntityProperty) and data.type == 'Edm.Binary' and data.value:
+            value = base64.b64decode(data.value)
+            if codec.is_encoded(value):
+                return codec.decode(value)
+            return value
+        return data
+
     def delete_data(self, table_name, key, row_key='', if_match='*'):
+        """
+        with chunked values, the value is read first to delete its chunks
+        """
         partition_key = key
-        return self.tableservice.delete_entity(table_name, partition_key, row_key, if_match=if_match)
+        old = self._get_raw_data(table_name, partition_key, row_key) if self.chunker.enabled else None
+        result = self.tableservice.delete_entity(table_name, partition_key, row_key, if_match=if_match)
+        self._delete_chunks(table_name, partition_key, row_key, old)
+        return result
+
+    def get_many(self, table_name, keys, row_key='', select='data'):
+        """
+        get data of many keys, one query per 50 keys
+        returns a dict keyed by the input keys, missing keys are None
+        """
+        keys = list(keys)
+        results = dict.fromkeys(keys)
+        for partition_key, data in self._get_raw_many(table_name, keys, row_key, select).iteritems():
+            results[partition_key] = self._decode_value(table_name, partition_key, row_key, data)
+        return results
+
+    def _get_raw_many(self, table_name, keys, row_key='', select='data'):
+        """
+        returns a dict of the found keys to their undecoded data
+        """
+        found = {}
+        partition_keys = list(set(keys))
+        if select and 'PartitionKey' not in select:
+            select = 'PartitionKey,' + select
+        for i in xrange(0, len(partition_keys), _QUERY_MAX_PARTITIONS):
+            chunk = partition_keys[i:i + _QUERY_MAX_PARTITIONS]
+            query = "(%s) and RowKey eq '%s'" % (' or '.join("PartitionKey eq '%s'" % _quote(k) for k in chunk),
+                                                 _quote(row_key))
+            try:
+                entities = self.tableservice.query_entities(table_name, query, select=select)
+            except WindowsAzureMissingResourceError:
+                return found
+            for entity in entities:
+                found[entity.PartitionKey] = getattr(entity, 'data', None)
+        return found
+
+    def set_many(self, table_name, items, row_key=''):
+        """
+        upsert many keys
+        items: dict of key to data
+        every key is its own partition, so each upsert is its own request,
+        query_workers of them are sent at the same time
+        with chunked values, the keys are read first to delete the chunks they replace
+        """
+        items = dict((key, self._encode_data(table_name, data)) for key, data in items.iteritems())
+        old = {}
+        if self.chunker.enabled:
+            old = self._get_raw_many(table_name, items.keys(), row_key)
+            items = dict((key, self._write_chunks(table_name, key, row_key, data)) for key, data in items.iteritems())
+        self._batch_by_partition([(key, self.tableservice.insert_or_replace_entity,
+                                   (table_name, key, row_key, {'data': data}))
+                                  for key, data in items.iteritems()])
+        for key, data in old.iteritems():
+            self._delete_chunks(table_name, key, row_key, data)
+
+    def delete_many(self, table_name, keys, row_key=''):
+        """
+        a request per key sent query_workers at a time, see set_many
+        with chunked values, the keys are read first to delete their chunks
+        """
+        keys = set(keys)
+        old = self._get_raw_many(table_name, keys, row_key) if self.chunker.enabled else {}
+        self._batch_by_partition([(key, self.tableservice.delete_entity, (table_name, key, row_key))
+                                  for key in keys])
+        for key, data in old.iteritems():
+            self._delete_chunks(table_name, key, row_key, data)
+
+    def scan(self, table_name, segments=1, page_size=None, max_units_per_second=None,
+             checkpoint=None, keys_only=False, row_key='', split_points=None):
+        """
+        yield (key, data) of every entity of the table with row_key,
+        following the continuation tokens, see scan.scan_pages
+        segments: partition key ranges queried in parallel, by a thread each
+        split_points: the segments - 1 partition keys the ranges start at,
+        by default printable ASCII is split evenly
+        page_size: entities per query, 1000 at most
+        max_units_per_second: entities all segments may read per second
+        checkpoint: dict updated while the scan goes, pass it again to resume
+        keys_only: only read the keys, data is None
+        """
+        if split_points is None:
+            split_points = [chr(32 + 95 * i // segments) for i in xrange(1, segments)]
+        if len(split_points) != segments - 1:
+            raise AzureTableError('%s split points for %s segments' % (len(split_points), segments))
+        bounds = [None] + list(split_points) + [None]
+        select = 'PartitionKey' if keys_only else 'PartitionKey,data'
+
+        def fetch(segment, start):
+            query = ["RowKey eq '%s'" % _quote(row_key)]
+            if bounds[segment] is not None:
+                query.append("PartitionKey ge '%s'" % _quote(bounds[segment]))
+            if bounds[segment + 1] is not None:
+                query.append("PartitionKey lt '%s'" % _quote(bounds[segment + 1]))
+            start = start or {}
+            entities = self.tableservice.query_entities(table_name, ' and '.join(query), select=select,
+                                                        top=page_size,
+                                                        next_partition_key=start.get('next_partition_key'),
+                                                        next_row_key=start.get('next_row_key'))
+            items = [(entity.PartitionKey,
+                      None if keys_only else self._decode_value(table_name, entity.PartitionKey, row_key,
+                                                                getattr(entity, 'data', None)))
+                     for entity in entities]
+            continuation = getattr(entities, 'x_ms_continuation', None)
+            if not continuation or not continuation.get('nextpartitionkey'):
+                return items, None, len(items)
+            return items, {'next_partition_key': continuation.get('nextpartitionkey'),
+                           'next_row_key': continuation.get('nextrowkey') or None}, len(items)
+
+        limiter = RateLimiter(max_units_per_second) if max_units_per_second else None
+        for item in scan_pages(fetch, segments, checkpoint, limiter):
+            yield item
+
+    def _batch_by_partition(self, requests, max_operations=_BATCH_MAX_OPERATIONS):
+        """
+        requests: list of (partition_key, method, args)
+
+        Entity group transaction:
+        - all entities in a batch must have the same PartitionKey
+        - up to 100 operations per batch
+        requests of the same partition are committed as batches,
+        a partition with a single request is sent as is, the partitions
+        are sent concurrently, query_workers at a time
+        """
+        partitions = {}
+        for partition_key, method, args in requests:
+            partitions.setdefault(partition_key, []).append((method, args))
+        chunks = [group[i:i + max_operations] for group in partitions.itervalues()
+                  for i in xrange(0, len(group), max_operations)]
+        self._map_partitions(self._commit_chunk, chunks)
+
+    def _commit_chunk(self, chunk):
+        """
+        the requests of one partition, as a batch unless there is only one,
+        the TableService of the calling thread keeps the batch
+        """
+        if len(chunk) == 1:
+            method, args = chunk[0]
+            method(*args)
+            return
+        self.tableservice.begin_batch()
+        try:
+            for method, args in chunk:
+                method(*args)
+            self.tableservice.commit_batch()
+        except Exception:
+            self.tableservice.cancel_batch()
+            raise
+
+    def _map_partitions(self, func, args):
+        """
+        func(arg) of every arg, each arg being requests to its own partition,
+        query_workers at a time
+        """
+        if len(args) < 2:
+            return [func(arg) for arg in args]
+        with self._query_pool_lock:
+            if self._query_pool is None:
+                self._query_pool = ThreadPool(self.query_workers)
+        return self._query_pool.map(func, args)
 
     def incr(self, table_name, key, amount=1, shard_count=1):
         """
         shard_count: how many slot for this counter
+        with adaptive shard counters, shard_count is the least shard count,
+        etag conflicts grow the shard count of the counter
         """
+        if self.writer_shard_counters:
+            return self._incr_writer_shard(table_name, key, amount)
+        if self.adaptive is not None:
+            shard_count = max(shard_count, self.adaptive.shard_count(table_name, key))
         shard = random.randint(1, shard_count)
         return self._incr(table_name, key, amount=amount, row_key=_COUNTER_DEFAULT_SHARD_FORMAT % shard)
 
-    def _incr(self, table_name, key, amount=1, row_key=_COUNTER_DEFAULT_ROW_KEY, retry=0):
+    def writer_row_key(self):
+        """
+        the counter row owned by the current thread of this instance
+        """
+        return _COUNTER_WRITER_ROW_KEY_FORMAT % (socket.gethostname(), os.getpid(), self._instance_id,
+                                                 threading.current_thread().ident)
+
+    def _incr_writer_shard(self, table_name, key, amount):
+        """
+        only this thread writes its row, so the count it knows is the stored count
+        the row is read once per thread to pick up what an earlier thread
+        with the same ident left, after that every incr is an update on the
+        etag of the last write, which fails once a delete_counter of any
+        process removed the row, the row is then read again
+        a thread inserting its row folds the idle rows of the partition into
+        the base row, so restarted processes and threads don't grow it
+        only etag conflicts are retried, other errors are raised
+        """
+        counts = getattr(self._writer, 'counts', None)
+        if counts is None:
+            counts = self._writer.counts = {}  # (table_name, key) -> (generation, count, etag)
+        row_key = self.writer_row_key()
+        generation = self._counter_generations.get((table_name, key), 0)
+        error = None
+        for _ in xrange(_COUNTER_WRITER_ATTEMPTS):
+            known_generation, count, etag = counts.pop((table_name, key), (None, 0, None))
+            if known_generation != generation:
+                count, etag = self._get_writer_row(table_name, key, row_key)
+            new_count = count + amount
+            inserted = etag is None
+            try:
+                if inserted:
+                    entity = storage.Entity()
+                    entity.PartitionKey, entity.RowKey = key, row_key
+                    setattr(entity, self.counter_property, new_count)
+                    etag = self.tableservice.insert_entity(table_name, entity).etag
+                else:
+                    etag = self.tableservice.update_entity(table_name, key, row_key,
+                                                           {self.counter_property: new_count}, if_match=etag)['etag']
+            except WindowsAzureMissingResourceError as e:
+                if inserted:  # no row to update, the table is missing
+                    self.create_table(table_name)
+                error = e
+                continue  # the row was deleted
+            except WindowsAzureError as e:
+                if not _is_conflict(e):
+                    raise AzureTableError(e)
+                error = e
+                continue  # the etag changed or the row was inserted, read it again
+            counts[(table_name, key)] = (generation, new_count, etag)
+            if inserted:
+                self._compact_writer_rows(table_name, key)
+            return
+        raise AzureTableError("%s %s times, key: %s. %s" % (_COUNTER_EXCEEDED_MAX_RETRY, _COUNTER_WRITER_ATTEMPTS,
+                                                            key, error))
+
+    def _compact_writer_rows(self, table_name, key):
+        """
+        fold the writer rows not written for writer_row_idle seconds into the
+        base row, the deletes on the etags read and the base row update are
+        one entity group transaction, a writer coming back after its row was
+        folded finds it missing and inserts a new one
+        a failed compaction is logged, the next inserted writer row tries again
+        """
+        query = "PartitionKey eq '%s' and RowKey ge '%s' and RowKey lt '%s~'" % (
+            _quote(key), _COUNTER_WRITER_BASE_ROW_KEY, _COUNTER_WRITER_BASE_ROW_KEY)
+        try:
+            rows = self._query_all(table_name, query, 'RowKey,Timestamp,' + self.counter_property)
+        except WindowsAzureError as e:
+            logger.warning("Failed to read the writer rows of counter '%s' of '%s': %s", key, table_name, e)
+            return
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.writer_row_idle)
+        base = None
+        idle = []
+        for row in rows:
+            if row.RowKey == _COUNTER_WRITER_BASE_ROW_KEY:
+                base = row
+            elif row.RowKey.startswith(_COUNTER_WRITER_BASE_ROW_KEY + '_') and row.Timestamp < cutoff:
+                idle.append(row)
+        idle = idle[:_BATCH_MAX_OPERATIONS - 1]  # and the base row
+        if not idle:
+            return
+        count = sum(int(getattr(row, self.counter_property)) for row in idle)
+        self.tableservice.begin_batch()
+        try:
+            for row in idle:
+                self.tableservice.delete_entity(table_name, key, row.RowKey, if_match=row.etag)
+            if base is None:
+                entity = storage.Entity()
+                entity.PartitionKey, entity.RowKey = key, _COUNTER_WRITER_BASE_ROW_KEY
+                setattr(entity, self.counter_property, count)
+                self.tableservice.insert_entity(table_name, entity)
+            else:
+                self.tableservice.update_entity(table_name, key, _COUNTER_WRITER_BASE_ROW_KEY,
+                                                {self.counter_property: int(getattr(base, self.counter_property)) + count},
+                                                if_match=base.etag)
+            self.tableservice.commit_batch()
+        except Exception as e:  # commit_batch raises an HTTPError when a condition fails
+            self.tableservice.cancel_batch()
+            logger.info("Didn't fold the writer rows of counter '%s' of '%s': %s", key, table_name, e)
+
+    def _get_writer_row(self, table_name, key, row_key):
+        """
+        (count, etag) of a writer row, (0, None) when it's missing
+        """
+        try:
+            entity = self.tableservice.get_entity(table_name, key, row_key, select=self.counter_property)
+        except WindowsAzureMissingResourceError:
+            return 0, None
+        return int(getattr(entity, self.counter_property)), entity.etag
+
+    def _incr(self, table_name, key, amount=1, row_key=_COUNTER_DEFAULT_ROW_KEY):
         """
-        retry: current tim
+        read the counter and update it on its etag, conflicts are retried
+        with backoff until max_counter_retry or counter_deadline is reached
         """
-        retry += 1
+        try:
+            for _ in self.retry_policy.attempts('incr', max_retries=self.max_counter_retry,
+                                                deadline=self.counter_deadline):
+                result = self._try_incr(table_name, key, amount, row_key)
+                if result is not _RETRY:
+                    return result
+                if self.adaptive is not None:
+                    self.adaptive.record(table_name, key)
+        except RetryError as e:
+            raise AzureTableError("%s %s times, key: %s. %s" % (_COUNTER_EXCEEDED_MAX_RETRY,
+                                                                self.retry_policy.last_retries(), key, e.value))
 
+    def _try_incr(self, table_name, key, amount, row_key):
+        """
+        returns _RETRY when the increment should be retried
+        """
         partition_key = key
         last_modified = '*'
         try:
@@ -110,24 +659,24 @@ class AzureTable(object):
             except WindowsAzureMissingResourceError:
                 # no specified table
                 self.create_table(table_name)
-                return self._retry_incr(table_name, key, amount, row_key, retry)
+                return _RETRY
             except WindowsAzureConflictError:
                 # TODO: I really don't understand why a query would cause this, but ,jack, it did happen
-                return self._retry_incr(table_name, key, amount, row_key, retry)
+                return _RETRY
             else:
                 # or I guess the entity is missing
                 return self._insert_new_counter(table_name, partition_key, row_key, amount)
 
         except WindowsAzureError as e:
-            print 'something is wrong while querying, weird', e
-            return self._retry_incr(table_name, key, amount, row_key, retry)
+            logger.warning("Failed to read counter '%s' of '%s', will retry: %s", key, table_name, e)
+            return _RETRY
 
         try:
             new_count = getattr(entity, self.counter_property) + amount
             setattr(entity, self.counter_property, new_count)
-            self.tableservice.update_entity(table_name, partition_key, row_key, entity, if_match=last_modified)
+            return self.tableservice.update_entity(table_name, partition_key, row_key, entity, if_match=last_modified)
         except WindowsAzureError as e:
-            return self._retry_incr(table_name, key, amount, row_key, retry)
+            return _RETRY
         except Exception as e:
             raise AzureTableError(e)
 
@@ -139,22 +688,42 @@ class AzureTable(object):
         try:
             return self.tableservice.insert_entity(table_name, entity)
         except WindowsAzureConflictError as e:
-            return self._retry_incr(table_name, key, amount, row_key, retry=1)
+            return _RETRY
         except WindowsAzureMissingResourceError as e:
             # I have no idea what is missing
-            return self._retry_incr(table_name, key, amount, row_key, retry=1)
+            return _RETRY
         except Exception as e:
             raise AzureTableError(e)
 
-    def _retry_incr(self, table_name, key, amount, row_key, retry):
-        if retry >= self.max_counter_retry:
-            raise AzureTableError("%s %s times, key: %s" % (_COUNTER_EXCEEDED_MAX_RETRY, retry - 1, key))
-        time.sleep(exponential_backoff_waiting_time(retry))
-        return self._incr(table_name, key, amount, row_key, retry=retry + 1)
+    def last_retries(self):
+        """
+        retries of the last counter update made by this thread
+        """
+        return self.retry_policy.last_retries()
+
+    def retry_stats(self):
+        return self.retry_policy.stats()
+
+    def instrument(self, metrics):
+        """
+        count the requests and retries of every operation in metrics
+        requests of a batch are sent as one by commit_batch
+        """
+        def instrument_tableservice(tableservice):
+            tableservice._filter = metrics.counting(tableservice._filter)
+            tableservice.commit_batch = metrics.counting(tableservice.commit_batch)
+
+        self.clients.setup(instrument_tableservice)
+        self.retry_policy.listener = metrics.retried
 
     def get_count(self, table_name, key, row_key=_COUNTER_DEFAULT_ROW_KEY, sharded=False):
+        """
+        writer shard counters and adaptive shard counters are always sharded,
+        unless a row_key is given
+        """
         partition_key = key
-        if sharded:
+        always_sharded = self.writer_shard_counters or self.adaptive is not None
+        if sharded or (always_sharded and row_key == _COUNTER_DEFAULT_ROW_KEY):
             query = "PartitionKey eq '%s'" % partition_key
             counters = self.tableservice.query_entities(table_name, query, select=self.counter_property)
             all_count = 0
@@ -170,13 +739,99 @@ class AzureTable(object):
             except Exception as e:
                 raise AzureTableError(e)
 
+    def get_counts(self, table_name, keys, row_key=_COUNTER_DEFAULT_ROW_KEY, sharded=False):
+        """
+        get_count of many counters, returns a dict of key to count
+        every counter is its own partition, the partitions are queried
+        concurrently, query_workers at a time
+        """
+        keys = list(keys)
+        counts = self._map_partitions(lambda key: self.get_count(table_name, key, row_key=row_key, sharded=sharded),
+                                      keys)
+        return dict(zip(keys, counts))
+
+    def incr_window(self, table_name, key, bucket_seconds, amount=1, retention=None, now=None):
+        """
+        add amount to the current time bucket of a window counter, see window.Window
+        a bucket is window_shard_count counter rows of the key's partition, an
+        increment updates a random one on its etag, so a hot counter spreads its
+        etag conflicts, get_window sums the rows in the same range query
+        the writer that inserts the first row of a new bucket deletes the rows
+        out of retention, other rows don't, so concurrent sweeps don't collide
+        """
+        window = Window(bucket_seconds, retention, now)
+        shard = random.randint(1, max(self.window_shard_count, 1))
+        result = self._incr(table_name, key, amount=amount, row_key=window.shard(shard))
+        if shard == 1 and isinstance(result, storage.Entity):  # insert returns the entity, update its etag
+            query = "PartitionKey eq '%s' and RowKey ge '%s' and RowKey le '%s~'" % (
+                _quote(key), bucket_bounds()[0], window.expired_bucket())
+            expired = self._query_all(table_name, query, 'PartitionKey,RowKey')
+            self._batch_by_partition([(entity.PartitionKey, self.tableservice.delete_entity,
+                                       (table_name, entity.PartitionKey, entity.RowKey))
+                                      for entity in expired])
+        return result
+
+    def get_window(self, table_name, key, window_seconds, now=None):
+        """
+        the count of the buckets that started in the last window_seconds,
+        one query of the bucket rows in the window
+        """
+        window = Window(now=now)
+        query = "PartitionKey eq '%s' and RowKey ge '%s' and RowKey lt '%s'" % (
+            _quote(key), window.first_bucket(window_seconds), bucket_bounds()[1])
+        buckets = self._query_all(table_name, query, 'RowKey,' + self.counter_property)
+        return window.total(dict((bucket.RowKey, getattr(bucket, self.counter_property)) for bucket in buckets),
+                            window_seconds)
+
+    def add_distinct(self, table_name, key, members, shard_count=1, error_rate=None):
+        """
+        add members to the distinct counter of the key, see hyperloglog.HyperLogLog
+        the shards are rows of the key's partition, the sketch of the members is
+        merged into a random one with update_if on its etag
+        """
+        row_key = _DISTINCT_ROW_KEY_PREFIX + str(random.randint(1, max(shard_count, 1)))
+        hyperloglog.add_distinct(self, table_name, key, members,
+                                 error_rate or self.distinct_counters.get('error_rate'), row_key=row_key)
+
+    def count_distinct(self, table_name, key):
+        """
+        the estimated number of distinct members added to the key,
+        the sketches of all of its shards are read with one query
+        """
+        query = "PartitionKey eq '%s' and RowKey ge '%s' and RowKey lt '%s~'" % (
+            _quote(key), _DISTINCT_ROW_KEY_PREFIX, _DISTINCT_ROW_KEY_PREFIX)
+        shards = [shard for shard in self._query_all(table_name, query, 'RowKey,data')
+                  if not chunking.is_chunk_key(shard.RowKey)]
+        return hyperloglog.count_distinct(self._decode_value(table_name, key, shard.RowKey, getattr(shard, 'data', None))
+                                          for shard in shards)
+
     def delete_counter(self, table_name, key, row_key=_COUNTER_DEFAULT_ROW_KEY):
+        """
+        writer threads of this process read their row again after a delete,
+        writers of other processes find it when their update on the etag fails
+        """
         partition_key = key
+        self._counter_generations[(table_name, key)] = self._counter_generations.get((table_name, key), 0) + 1
         query = "PartitionKey eq '%s'" % partition_key
-        counters = self.tableservice.query_entities(table_name, query)
+        counters = self.tableservice.query_entities(table_name, query, select='PartitionKey,RowKey')
         if counters:
-            for counter in counters:
-                self.tableservice.delete_entity(table_name, counter.PartitionKey, counter.RowKey)
+            self._batch_by_partition([(counter.PartitionKey, self.tableservice.delete_entity,
+                                       (table_name, counter.PartitionKey, counter.RowKey))
+                                      for counter in counters])
+
+
+def _is_conflict(error):
+    """
+    a 409 of an insert of an existing row or a 412 of an update on a changed etag
+    """
+    return isinstance(error, WindowsAzureConflictError) or _PRECONDITION_FAILED in str(error)
+
+
+def _quote(value):
+    """
+    escape a string literal in a filter expression
+    """
+    return value.replace("'", "''")
 
 
 def exponential_backoff_waiting_time(retries):
@@ -184,11 +839,62 @@ def exponential_backoff_waiting_time(retries):
     retires: times of retry
     return: time in second we should wait till next retry
     """
-    retries = max(int(retries), 1)
-    default_backoff = 0.05
-    min_backoff = 0.01
-    max_backoff = 60
-    backoff = min_backoff + random.randrange(1000 * 0.8 * default_backoff, 1000 * 1.5 * default_backoff) / 1000.0
-    backoff *= 2 ^ retries - 1
-    backoff = min(backoff, max_backoff)
-    return backoff  # print 'retry after %s seconds' % backoff
+    return full_jitter_backoff(retries)
+
+
+class _KeepAliveHTTPClient(_HTTPClient):
+
+    """
+    the azure client opens a connection per request, this one keeps it open
+    for the next request of its TableService
+    a connection unused for _KEEP_ALIVE_IDLE seconds is closed instead of
+    reused, the server may have closed it already
+    a kept connection closed by the server is reopened once, the request is
+    sent again if it failed before its body was sent, if it's a read or an
+    unconditional put, merge or delete, which apply the same when sent twice,
+    a write with an If-Match or an insert the server may have applied is not
+    sent twice
+    """
+
+    def __init__(self, *args, **kwargs):
+        _HTTPClient.__init__(self, *args, **kwargs)
+        self._connections = {}
+
+    def get_connection(self, request):
+        address = (request.protocol_override or self.protocol, request.host)
+        connection = self._connections.get(address)
+        if connection is not None and time.time() - connection.last_used > _KEEP_ALIVE_IDLE:
+            del self._connections[address]
+            connection.close()
+            connection = None
+        if connection is None:
+            connection = self._connections[address] = _HTTPClient.get_connection(self, request)
+            connection.reused = False
+            connection.last_used = time.time()
+        return connection
+
+    def send_request_body(self, connection, request_body):
+        _HTTPClient.send_request_body(self, connection, request_body)
+        connection.sent = True
+
+    def perform_request(self, request):
+        connection = self.get_connection(request)
+        connection.sent = False
+        try:
+            return _HTTPClient.perform_request(self, request)
+        except (httplib.HTTPException, socket.error):
+            self._connections.pop((request.protocol_override or self.protocol, request.host), None)
+            connection.close()
+            if not connection.reused or (connection.sent and not _resendable(request)):
+                raise
+            return self.perform_request(request)  # on a new connection
+        finally:
+            connection.reused = True  # also after an error response, the connection is still good
+            connection.last_used = time.time()
+
+
+def _resendable(request):
+    if request.method in _IDEMPOTENT_METHODS:
+        return True
+    return request.method in _UNCONDITIONAL_METHODS and not any(
+        name.lower() == 'if-match' for name, _ in request.headers)
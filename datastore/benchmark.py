@@ -0,0 +1,290 @@
+'''
+Benchmark harness for key-value and counter operations
+
+    # against the memory engine, 8 threads, zipfian hot keys
+    python benchmark.py --threads 8 --distribution zipf --mix get=50,set=20,incr=25,count=5
+
+    # against a real backend, settings is a json file of Datastore settings
+    python benchmark.py --settings dynamodb.json --ops 1000 --output dynamodb.json
+
+Prints or writes a JSON report with throughput, p50/p95/p99 latency per operation,
+retries, errors and backend calls per logical operation.
+'''
+import sys
+import json
+import time
+import random
+import bisect
+import platform
+import argparse
+import datetime
+import threading
+import multiprocessing
+from api import Datastore
+
+_OPERATIONS = ('get', 'set', 'incr', 'count')
+_DEFAULT_MIX = 'get=50,set=20,incr=25,count=5'
+_DATA_TABLE = 'bench'
+_COUNTER_TABLE = 'bench_counter'
+
+
+class BenchmarkError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def parse_mix(mix):
+    """
+    'get=50,incr=50' -> [('get', 50.0), ('incr', 50.0)]
+    """
+    weights = []
+    for part in mix.split(','):
+        operation, _, weight = part.partition('=')
+        operation = operation.strip()
+        if operation not in _OPERATIONS:
+            raise BenchmarkError("unknown operation '%s', choose from %s" % (operation, ', '.join(_OPERATIONS)))
+        weights.append((operation, float(weight or 1)))
+    return weights
+
+
+class WeightedChoice(object):
+
+    """
+    pick from values with the given weights, using the given random.Random
+    """
+
+    def __init__(self, values, weights, rng):
+        self.values = values
+        self.rng = rng
+        self.cdf = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            self.cdf.append(total)
+        self.total = total
+
+    def __call__(self):
+        return self.values[bisect.bisect_right(self.cdf, self.rng.random() * self.total)]
+
+
+def key_sampler(distribution, key_count, rng, zipf_s=1.1):
+    """
+    uniform: every key is equally likely
+    zipf: the key of rank r has a weight of 1 / r ^ zipf_s, key_0 is the hottest
+    """
+    keys = ['key_%s' % i for i in xrange(key_count)]
+    if distribution == 'uniform':
+        return lambda: keys[rng.randrange(key_count)]
+    elif distribution == 'zipf':
+        return WeightedChoice(keys, [1.0 / (rank ** zipf_s) for rank in xrange(1, key_count + 1)], rng)
+    raise BenchmarkError("unknown distribution '%s'" % distribution)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def prepare(config):
+    """
+    create the benchmark tables, which takes a while on DynamoDB
+    """
+    db = Datastore(config['settings'])
+    for table_name in (_DATA_TABLE, _COUNTER_TABLE, _COUNTER_TABLE + '_shard_index'):
+        db.create_table(table_name)
+    return db
+
+
+def run_process(config, process_index):
+    """
+    run config['threads'] threads sharing one Datastore, returns the raw result
+    """
+    if config['settings'].get('engine') == 'memory':
+        # every process has its own memory, tables are created in place
+        db = prepare(config)
+    else:
+        # metrics count the backend calls of the other engines
+        db = Datastore(dict(config['settings'], metrics=config['settings'].get('metrics') or True))
+    ops_per_thread = config['ops'] // (config['processes'] * config['threads'])
+    value = 'x' * config['value_size']
+    results = []
+
+    def worker(thread_index):
+        seed = config['seed'] * 1000003 + process_index * 1009 + thread_index
+        rng = random.Random(seed)
+        next_key = key_sampler(config['distribution'], config['keys'], rng, config['zipf_s'])
+        mix = parse_mix(config['mix'])
+        next_operation = WeightedChoice([o for o, _ in mix], [w for _, w in mix], rng)
+        calls = {
+            'get': lambda key: db.get_data(_DATA_TABLE, key),
+            'set': lambda key: db.set_data(_DATA_TABLE, key, value),
+            'incr': lambda key: db.incr(_COUNTER_TABLE, key, shard_count=config['shard_count']),
+            'count': lambda key: db.get_count(_COUNTER_TABLE, key, sharded=config['shard_count'] > 1),
+        }
+        result = {'latencies': dict((o, []) for o in _OPERATIONS), 'retries': 0, 'errors': 0}
+        for _ in xrange(ops_per_thread):
+            operation = next_operation()
+            key = next_key()
+            start = time.time()
+            for attempt in xrange(config['max_retries'] + 1):
+                try:
+                    calls[operation](key)
+                    break
+                except Exception:
+                    if attempt == config['max_retries']:
+                        result['errors'] += 1
+                    else:
+                        result['retries'] += 1
+                        time.sleep(min(0.001 * 2 ** attempt, 0.1))
+            result['latencies'][operation].append(time.time() - start)
+        results.append(result)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in xrange(config['threads'])]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    db.flush()
+    elapsed = time.time() - start
+
+    merged = {'latencies': dict((o, []) for o in _OPERATIONS), 'retries': 0, 'errors': 0,
+              'elapsed': elapsed, 'backend_calls': None}
+    for result in results:
+        for operation, latencies in result['latencies'].iteritems():
+            merged['latencies'][operation].extend(latencies)
+        merged['retries'] += result['retries']
+        merged['errors'] += result['errors']
+    if hasattr(db.db, 'calls'):
+        merged['backend_calls'] = dict(db.db.calls)
+    elif db.metrics is not None:
+        merged['backend_calls'] = dict((operation, sum(stats['backend_calls'] for stats in tables.itervalues()))
+                                       for operation, tables in db.stats().iteritems())
+    return merged
+
+
+def _run_process(args):
+    return run_process(*args)
+
+
+def run(config):
+    """
+    returns the report as a dict
+    """
+    if config['settings'].get('engine') != 'memory':
+        prepare(config)
+    if config['processes'] > 1:
+        pool = multiprocessing.Pool(config['processes'])
+        try:
+            results = pool.map(_run_process, [(config, i) for i in xrange(config['processes'])])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_process(config, 0)]
+    return report(config, results)
+
+
+def report(config, results):
+    elapsed = max(r['elapsed'] for r in results)
+    operations = {}
+    total_ops = 0
+    for operation in _OPERATIONS:
+        latencies = sorted(l for r in results for l in r['latencies'][operation])
+        if not latencies:
+            continue
+        total_ops += len(latencies)
+        operations[operation] = {
+            'count': len(latencies),
+            'throughput': len(latencies) / elapsed if elapsed else None,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': latencies[-1] * 1000,
+        }
+    backend_calls = None
+    calls_per_op = None
+    if all(r['backend_calls'] is not None for r in results):
+        backend_calls = {}
+        for r in results:
+            for name, count in r['backend_calls'].iteritems():
+                backend_calls[name] = backend_calls.get(name, 0) + count
+        requests = sum(count for name, count in backend_calls.iteritems() if name != 'throttled')
+        calls_per_op = float(requests) / total_ops if total_ops else None
+    settings = dict((k, v) for k, v in config['settings'].iteritems() if 'key' not in k)  # no secrets
+    return {
+        'config': dict(config, settings=settings),
+        'python': platform.python_version(),
+        'started_at': config.get('started_at'),
+        'elapsed': elapsed,
+        'ops': total_ops,
+        'throughput': total_ops / elapsed if elapsed else None,
+        'retries': sum(r['retries'] for r in results),
+        'errors': sum(r['errors'] for r in results),
+        'backend_calls': backend_calls,
+        'backend_calls_per_op': calls_per_op,
+        'operations': operations,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark Datastore operations')
+    parser.add_argument('--settings', help='json file of Datastore settings, the memory engine by default')
+    parser.add_argument('--latency', type=float, default=0.0, help='memory engine latency per call, in seconds')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--ops', type=int, default=10000, help='total operations of all threads')
+    parser.add_argument('--keys', type=int, default=1000, help='number of distinct keys')
+    parser.add_argument('--distribution', choices=('uniform', 'zipf'), default='uniform')
+    parser.add_argument('--zipf-s', type=float, default=1.1, help='zipf exponent, higher is hotter')
+    parser.add_argument('--mix', default=_DEFAULT_MIX, help='operation weights, default %s' % _DEFAULT_MIX)
+    parser.add_argument('--shard-count', type=int, default=1)
+    parser.add_argument('--value-size', type=int, default=100)
+    parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the json report to this file instead of stdout')
+    return parser.parse_args(argv)
+
+
+def config_from_args(args):
+    if args.settings:
+        with open(args.settings) as f:
+            settings = json.load(f)
+    else:
+        settings = {'engine': 'memory', 'latency': args.latency}
+    parse_mix(args.mix)  # fail early
+    return {
+        'settings': settings,
+        'threads': args.threads,
+        'processes': args.processes,
+        'ops': args.ops,
+        'keys': args.keys,
+        'distribution': args.distribution,
+        'zipf_s': args.zipf_s,
+        'mix': args.mix,
+        'shard_count': args.shard_count,
+        'value_size': args.value_size,
+        'max_retries': args.max_retries,
+        'seed': args.seed,
+        'started_at': datetime.datetime.utcnow().isoformat(),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = json.dumps(run(config_from_args(args)), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
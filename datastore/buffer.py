@@ -0,0 +1,197 @@
+'''
+Write-behind aggregation buffer for counters
+'''
+import atexit
+import logging
+import weakref
+import threading
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_MAX_SIZE = 1000
+_DEFAULT_INTERVAL = 1.0
+
+_CLOSE_AT_EXIT = weakref.WeakSet()
+_FLUSH_WHEN_COLLECTED = set()  # weak references whose callback flushes what the collected object left
+
+
+def close_at_exit(obj):
+    """
+    call obj.close() when the process exits, unless obj was collected before,
+    the registry only keeps a weak reference
+    """
+    _CLOSE_AT_EXIT.add(obj)
+
+
+def flush_when_collected(obj, flush):
+    """
+    call flush() once obj is collected, flush must not hold obj, e.g. the
+    bound flush of an object keeping the state obj works on
+    """
+    name = type(obj).__name__
+
+    def collected(ref):
+        _FLUSH_WHEN_COLLECTED.discard(ref)
+        try:
+            flush()
+        except Exception as e:
+            logger.warning('Failed to flush collected %s: %s', name, e)
+
+    _FLUSH_WHEN_COLLECTED.add(weakref.ref(obj, collected))
+
+
+def start_timer(obj, method, interval, closed, now=False):
+    """
+    call obj.<method>() every interval seconds in a daemon thread until
+    closed is set or obj is collected, the first time right away if now
+    obj is only held while the method runs, so the timer doesn't keep it
+    returns the thread
+    """
+    timer = threading.Thread(target=_run_timer, args=(weakref.ref(obj), method, interval, closed, now),
+                             name=type(obj).__name__)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+@atexit.register
+def _close_all():
+    for obj in list(_CLOSE_AT_EXIT):
+        try:
+            obj.close()
+        except Exception as e:
+            logger.warning('Failed to close %s at exit: %s', type(obj).__name__, e)
+
+
+class IncrBuffer(object):
+
+    """
+    collect increments in memory and write the summed amount of each counter
+    to the backend with a single incr per flush
+
+    incr: the backend incr(table_name, key, amount=1, shard_count=1)
+    max_size: flush when this many increments are pending
+    interval: flush every `interval` seconds in a background thread,
+              0 or None disables the timer, flush() must be called explicitly
+
+    Pending increments are not visible to get_count until they are flushed.
+    A flush on max_size that fails is logged and retried by the next flush, it
+    is not raised to incr since the amount is already buffered. The buffer is
+    flushed when it is closed, when the process exits and when it is collected.
+    """
+
+    def __init__(self, incr, max_size=_DEFAULT_MAX_SIZE, interval=_DEFAULT_INTERVAL):
+        self.max_size = max(int(max_size), 1)
+        self.interval = interval
+        self._sums = _PendingSums(incr)
+        self._closed = threading.Event()
+        self._timer = None
+        if self.interval:
+            self._timer = start_timer(self, 'flush', self.interval, self._closed)
+        close_at_exit(self)
+        flush_when_collected(self, self._sums.flush)
+
+    def incr(self, table_name, key, amount=1, shard_count=1):
+        """
+        add amount to the pending sum of the counter
+        """
+        if self._sums.add((table_name, key, shard_count), amount) >= self.max_size:
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning('IncrBuffer flush failed, will retry: %s', e)
+
+    def flush(self):
+        """
+        write every pending counter to the backend
+        returns the number of backend incr calls
+
+        counters which fail to be written are put back into the buffer
+        and the first error is raised after the others are written
+        """
+        return self._sums.flush()
+
+    def pending(self):
+        """
+        returns a copy of the pending sums, keyed by (table_name, key, shard_count)
+        """
+        return self._sums.pending()
+
+    def close(self):
+        """
+        stop the timer and flush what is left
+        """
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._timer is not None and self._timer is not threading.current_thread():
+            self._timer.join(self.interval)
+        self.flush()
+
+
+class _PendingSums(object):
+
+    """
+    the pending sums of an IncrBuffer, apart from it so they can still be
+    flushed once the buffer is collected
+    """
+
+    def __init__(self, incr):
+        self._incr = incr
+        self._pending = {}
+        self._pending_count = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def add(self, counter, amount):
+        """
+        returns the number of increments pending
+        """
+        with self._lock:
+            self._pending[counter] = self._pending.get(counter, 0) + amount
+            self._pending_count += 1
+            return self._pending_count
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._pending_count = 0
+
+            written = 0
+            error = None
+            for (table_name, key, shard_count), amount in pending.iteritems():
+                if not amount:
+                    continue
+                try:
+                    self._incr(table_name, key, amount=amount, shard_count=shard_count)
+                    written += 1
+                except Exception as e:
+                    self._restore((table_name, key, shard_count), amount)
+                    if error is None:
+                        error = e
+            if error is not None:
+                raise error
+            return written
+
+    def pending(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def _restore(self, counter, amount):
+        with self._lock:
+            self._pending[counter] = self._pending.get(counter, 0) + amount
+            self._pending_count += 1
+
+
+def _run_timer(ref, method, interval, closed, now):
+    while now or not closed.wait(interval):
+        now = False
+        obj = ref()
+        if obj is None:
+            return
+        try:
+            getattr(obj, method)()
+        except Exception as e:
+            logger.warning('%s %s failed, will retry: %s', type(obj).__name__, method, e)
+        del obj
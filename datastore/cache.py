@@ -0,0 +1,135 @@
+'''
+In-process read-through cache for get_data
+'''
+import time
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+
+_DEFAULT_MAX_ENTRIES = 10000
+_DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+_DEFAULT_TTL = 60
+_GENERATION_STRIPES = 1024
+
+
+class LRUCache(object):
+
+    """
+    LRU cache of decoded values, bounded by entries and bytes
+
+    max_entries: max number of cached keys
+    max_bytes: max total size of cached values,
+               sizes are estimated with the pickled length of the value
+    ttl: seconds an entry stays valid
+    table_ttl: dict of table name to ttl, overrides ttl, 0 disables caching for the table
+
+    Values are cached decoded, a hit returns the same object to every caller,
+    so don't mutate what get() returns.
+
+    A read racing a write may get the old value after the write invalidated
+    the key, take generation() before the read and pass it to set(), which
+    skips the value if the key was invalidated since. Generations are kept
+    per stripe of keys, an invalidation also skips the reads of its stripe.
+    """
+
+    def __init__(self, max_entries=_DEFAULT_MAX_ENTRIES, max_bytes=_DEFAULT_MAX_BYTES,
+                 ttl=_DEFAULT_TTL, table_ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.table_ttl = table_ttl or {}
+        self._entries = OrderedDict()  # (table_name, key) -> (expires, size, value)
+        self._bytes = 0
+        self._generations = [0] * _GENERATION_STRIPES
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get_ttl(self, table_name):
+        return self.table_ttl.get(table_name, self.ttl)
+
+    def get(self, table_name, key):
+        """
+        returns (True, value) on hit and (False, None) on miss
+        """
+        cache_key = (table_name, key)
+        with self._lock:
+            entry = self._entries.pop(cache_key, None)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            expires, size, value = entry
+            if expires < time.time():
+                self._bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+            self._entries[cache_key] = entry  # move to the most recently used end
+            self.hits += 1
+            return True, value
+
+    def generation(self, table_name, key):
+        """
+        the invalidation generation of the key, to pass to set()
+        """
+        with self._lock:
+            return self._generations[hash((table_name, key)) % _GENERATION_STRIPES]
+
+    def set(self, table_name, key, value, generation=None):
+        """
+        generation: from generation() before the value was read, the value is
+                    not cached if the key was invalidated since
+        """
+        ttl = self.get_ttl(table_name)
+        if not ttl:
+            return False
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return False
+        cache_key = (table_name, key)
+        with self._lock:
+            if generation is not None and generation != self._generations[hash(cache_key) % _GENERATION_STRIPES]:
+                return False
+            old = self._entries.pop(cache_key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[cache_key] = (time.time() + ttl, size, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+        return True
+
+    def invalidate(self, table_name, key):
+        with self._lock:
+            self._generations[hash((table_name, key)) % _GENERATION_STRIPES] += 1
+            entry = self._entries.pop((table_name, key), None)
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    }
+
+
+def _sizeof(value):
+    if isinstance(value, basestring):
+        return len(value)
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except (pickle.PicklingError, TypeError):
+        return 0
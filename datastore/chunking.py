@@ -0,0 +1,102 @@
+'''
+Values larger than the item limit of the backend, stored as chunks behind a manifest
+'''
+import os
+import json
+import zlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+_MAGIC = '\x00ssc'
+_CHUNK_KEY_MARKER = '~chunk~'
+_CHUNK_KEY_FORMAT = '%s' + _CHUNK_KEY_MARKER + '%s~%06d'  # key, manifest id, chunk number
+_DEFAULT_MAX_WORKERS = 8
+
+
+class ChunkError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def is_manifest(value):
+    return isinstance(value, str) and value.startswith(_MAGIC)
+
+
+def is_chunk_key(key):
+    return isinstance(key, basestring) and _CHUNK_KEY_MARKER in key
+
+
+class ValueChunker(object):
+
+    """
+    split encoded values over chunk_size bytes into chunks
+
+    Settings, for the DynamoDB, Azure Table and memory engines
+    'chunked_values': {'chunk_size': 350 * 1024,  # DynamoDB items hold 400 KB, Azure properties 64 KB
+                       'max_workers': 8}          # threads reading the chunks of a value
+
+    Without a chunk_size values are not split, chunked values are still read.
+    Chunks are written first, under keys derived from the key and the id of
+    the write, then the manifest replaces the value of the key, so a reader
+    sees either the old value or all of the new one. Chunks of the value
+    replaced or deleted are deleted after the manifest.
+    """
+
+    def __init__(self, chunk_size=None, max_workers=_DEFAULT_MAX_WORKERS):
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def split(self, key, value):
+        """
+        returns (manifest, [(chunk key, chunk), ...]), (None, None) if the value fits
+        """
+        if not self.enabled or len(value) <= self.chunk_size:
+            return None, None
+        write_id = os.urandom(6).encode('hex')
+        chunks = [(_CHUNK_KEY_FORMAT % (key, write_id, i), value[offset:offset + self.chunk_size])
+                  for i, offset in enumerate(xrange(0, len(value), self.chunk_size))]
+        manifest = {'id': write_id, 'chunks': len(chunks), 'size': len(value), 'crc': zlib.crc32(value) & 0xffffffff}
+        return _MAGIC + json.dumps(manifest, separators=(',', ':')), chunks
+
+    @property
+    def enabled(self):
+        return self.chunk_size is not None
+
+    def chunk_keys(self, key, manifest):
+        manifest = _parse(manifest)
+        return [_CHUNK_KEY_FORMAT % (key, manifest['id'], i) for i in xrange(manifest['chunks'])]
+
+    def join(self, key, manifest, chunks):
+        """
+        chunks: dict of chunk key to chunk
+        raises ChunkError if a chunk is missing, e.g. the value was replaced meanwhile
+        """
+        try:
+            value = ''.join(chunks[chunk_key] for chunk_key in self.chunk_keys(key, manifest))
+        except KeyError as e:
+            raise ChunkError("chunk '%s' of '%s' is missing" % (e.args[0], key))
+        manifest = _parse(manifest)
+        if len(value) != manifest['size'] or zlib.crc32(value) & 0xffffffff != manifest['crc']:
+            raise ChunkError("chunks of '%s' don't match the manifest" % key)
+        return value
+
+    def map(self, func, args):
+        """
+        func(arg) of every arg, in parallel
+        """
+        if len(args) < 2:
+            return [func(arg) for arg in args]
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.max_workers)
+        return self._pool.map(func, args)
+
+
+def _parse(manifest):
+    return json.loads(manifest[len(_MAGIC):])
@@ -0,0 +1,405 @@
+'''
+Engine spreading keys over many engines with a consistent hash ring
+'''
+import bisect
+import struct
+import hashlib
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+from scan import RateLimiter, is_counter_item
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_VNODES = 100
+_DEFAULT_WORKERS = 8
+_DEFAULT_BATCH_SIZE = 25
+_POSITION = struct.Struct('>Q')
+
+# calls of (table_name, key, ...) sent to the node of the key, the shards
+# and the shard index of a counter live on the node of the counter key
+_BY_KEY = frozenset(['get_item', 'set_data', 'incr', 'incr_window', 'add_distinct', 'count_distinct'])
+# arguments of cas and update_if that pick the value get_versioned looks up
+_LOOKUP_ARGS = ('row_key', 'transform_time')
+# table calls sent to every node, the result is a dict of node name to result
+_ALL_NODES = frozenset(['create_table', 'delete_table', 'get_table', 'get_or_create_table', 'update_throughput'])
+
+
+class ClusterError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class HashRing(object):
+
+    """
+    consistent hashing with `vnodes` points per node, adding a node to a
+    ring of n nodes moves about 1 / (n + 1) of the keys, all to the new node
+    """
+
+    def __init__(self, nodes, vnodes=_DEFAULT_VNODES):
+        if not nodes:
+            raise ClusterError('a hash ring needs at least one node')
+        self.nodes = list(nodes)
+        self.vnodes = vnodes
+        points = sorted((_position('%s#%s' % (node, i)), node) for node in self.nodes for i in xrange(vnodes))
+        self._positions = [position for position, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, key):
+        index = bisect.bisect(self._positions, _position(key)) % len(self._positions)
+        return self._nodes[index]
+
+
+def _position(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return _POSITION.unpack(hashlib.md5(value).digest()[:_POSITION.size])[0]
+
+
+class ClusterStore(object):
+
+    """
+    every key is stored by the engine of one node, picked by a consistent hash ring
+
+    Cluster Example settings
+    'cluster': {
+        'engine': 'cluster',
+        'nodes': {'a': {'engine': 'dynamodb', 'region': 'ap-northeast-1', ...},
+                  'b': {'engine': 'dynamodb', 'region': 'us-west-2', ...},
+                  'c': {'engine': 'azure_table', 'account_name': ..., 'table_suffix': 'c'}},
+        'ring': ['a', 'b', 'c'],  # nodes on the ring, all nodes by default
+        'previous_ring': None,    # the ring before the last change, until rebalance is done
+        'vnodes': 100,            # points of every node on the ring
+        'workers': 8              # nodes called at the same time by batch calls
+    }
+
+    A node's 'table_suffix' is appended to its table names, so nodes can share
+    an account. To add a node, add it to 'nodes' and 'ring', keep the old ring
+    as 'previous_ring' and run rebalance(); to remove one, take it off 'ring'
+    only, rebalance, then drop it, then remove 'previous_ring'.
+
+    While 'previous_ring' is set, a key whose node changed is read from its new
+    node then from its old one, get_versioned, cas and update_if go to the node
+    holding the key, and deletes go to both. Writes go to the new node, so the
+    counts of a counter are split between both nodes until it is moved with
+    rebalance_counters(), get_count, get_counts and get_window sum them.
+    count_distinct only reads the new node.
+    """
+
+    def __init__(self, settings, create_engine):
+        self.settings = settings
+        if not settings.get('nodes'):
+            raise ClusterError('cluster engine needs node settings')
+        self.nodes = dict((name, create_engine(node_settings)) for name, node_settings in settings['nodes'].iteritems())
+        self.table_suffixes = dict((name, node_settings.get('table_suffix', ''))
+                                   for name, node_settings in settings['nodes'].iteritems())
+        vnodes = settings.get('vnodes', _DEFAULT_VNODES)
+        self.ring = HashRing(settings.get('ring') or sorted(self.nodes), vnodes)
+        self.previous_ring = None
+        if settings.get('previous_ring'):
+            self.previous_ring = HashRing(settings['previous_ring'], vnodes)
+        missing = set(self.ring.nodes + (self.previous_ring.nodes if self.previous_ring else [])) - set(self.nodes)
+        if missing:
+            raise ClusterError('nodes without settings: %s' % ', '.join(sorted(missing)))
+        self.workers = settings.get('workers', _DEFAULT_WORKERS)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def __getattr__(self, method):
+        if method.startswith('_') or 'nodes' not in self.__dict__:
+            raise AttributeError(method)
+        if method in _BY_KEY:
+            return lambda table_name, key, *args, **kwargs: self._call(self.ring.node(key), method,
+                                                                       table_name, key, *args, **kwargs)
+        if method in _ALL_NODES:
+            return lambda table_name, *args, **kwargs: dict(zip(
+                sorted(self.nodes), self._map(lambda name: self._call(name, method, table_name, *args, **kwargs),
+                                              sorted(self.nodes))))
+        raise ClusterError("'%s' is not supported by the cluster engine" % method)
+
+    def _call(self, name, method, table_name, *args, **kwargs):
+        return getattr(self.nodes[name], method)(table_name + self.table_suffixes[name], *args, **kwargs)
+
+    def _owners(self, key):
+        """
+        the node of the key, then its node of the previous ring if it is another one
+        """
+        owner = self.ring.node(key)
+        if self.previous_ring is None or self.previous_ring.node(key) == owner:
+            return [owner]
+        return [owner, self.previous_ring.node(key)]
+
+    def _moved(self, keys):
+        """
+        the keys whose node changed since the previous ring
+        """
+        if self.previous_ring is None:
+            return []
+        return [key for key in keys if self.previous_ring.node(key) != self.ring.node(key)]
+
+    def get_data(self, table_name, key, *args, **kwargs):
+        for name in self._owners(key):
+            data = self._call(name, 'get_data', table_name, key, *args, **kwargs)
+            if data is not None:
+                return data
+        return None
+
+    def get_versioned(self, table_name, key, *args, **kwargs):
+        for name in self._owners(key):
+            version, data = self._call(name, 'get_versioned', table_name, key, *args, **kwargs)
+            if version is not None:
+                break
+        return version, data
+
+    def cas(self, table_name, key, expected_version, data, *args, **kwargs):
+        return self._call(self._holder(table_name, key, kwargs), 'cas', table_name, key, expected_version, data,
+                          *args, **kwargs)
+
+    def update_if(self, table_name, key, func, *args, **kwargs):
+        return self._call(self._holder(table_name, key, kwargs), 'update_if', table_name, key, func, *args, **kwargs)
+
+    def _holder(self, table_name, key, kwargs):
+        """
+        the node of the previous ring if only it holds the key, else the node of the key
+        """
+        owners = self._owners(key)
+        if len(owners) > 1:
+            lookup = dict((name, value) for name, value in kwargs.iteritems() if name in _LOOKUP_ARGS)
+            if self._call(owners[0], 'get_versioned', table_name, key, **lookup)[0] is None \
+                    and self._call(owners[1], 'get_versioned', table_name, key, **lookup)[0] is not None:
+                return owners[1]
+        return owners[0]
+
+    def delete_data(self, table_name, key, *args, **kwargs):
+        return [self._call(name, 'delete_data', table_name, key, *args, **kwargs) for name in self._owners(key)][0]
+
+    def delete_counter(self, table_name, key, *args, **kwargs):
+        return [self._call(name, 'delete_counter', table_name, key, *args, **kwargs) for name in self._owners(key)][0]
+
+    def get_count(self, table_name, key, *args, **kwargs):
+        return _sum(self._call(name, 'get_count', table_name, key, *args, **kwargs) for name in self._owners(key))
+
+    def get_window(self, table_name, key, *args, **kwargs):
+        return _sum(self._call(name, 'get_window', table_name, key, *args, **kwargs) for name in self._owners(key))
+
+    def _group(self, keys, ring=None):
+        """
+        dict of node name to the keys it holds, on the ring by default
+        """
+        ring = ring or self.ring
+        groups = {}
+        for key in keys:
+            groups.setdefault(ring.node(key), []).append(key)
+        return groups
+
+    def _map(self, func, args):
+        """
+        func(arg) of every arg, in parallel
+        """
+        if len(args) < 2:
+            return [func(arg) for arg in args]
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+        return self._pool.map(func, args)
+
+    def _each_group(self, ring, method, table_name, keys, *args, **kwargs):
+        """
+        method(table_name, keys of the node, ...) on every node of the ring holding
+        some keys, returns the results merged into one dict
+        """
+        merged = {}
+        for result in self._map(lambda group: self._call(group[0], method, table_name, group[1], *args, **kwargs),
+                                self._group(keys, ring).items()):
+            merged.update(result or {})
+        return merged
+
+    def get_many(self, table_name, keys, *args, **kwargs):
+        keys = list(keys)
+        items = self._each_group(self.ring, 'get_many', table_name, keys, *args, **kwargs)
+        missing = self._moved(key for key in keys if items.get(key) is None)
+        if missing:
+            previous = self._each_group(self.previous_ring, 'get_many', table_name, missing, *args, **kwargs)
+            items.update((key, data) for key, data in previous.iteritems() if data is not None)
+        return items
+
+    def get_counts(self, table_name, keys, *args, **kwargs):
+        keys = list(keys)
+        counts = self._each_group(self.ring, 'get_counts', table_name, keys, *args, **kwargs)
+        moved = self._moved(keys)
+        if moved:
+            previous = self._each_group(self.previous_ring, 'get_counts', table_name, moved, *args, **kwargs)
+            for key, count in previous.iteritems():
+                counts[key] = _sum([counts.get(key), count])
+        return counts
+
+    def delete_many(self, table_name, keys, *args, **kwargs):
+        groups = {}
+        for key in keys:
+            for name in self._owners(key):
+                groups.setdefault(name, []).append(key)
+        self._map(lambda group: self._call(group[0], 'delete_many', table_name, group[1], *args, **kwargs),
+                  groups.items())
+        return True
+
+    def set_many(self, table_name, items, *args, **kwargs):
+        self._map(lambda group: self._call(group[0], 'set_many', table_name,
+                                           dict((key, items[key]) for key in group[1]), *args, **kwargs),
+                  self._group(items).items())
+
+    def scan(self, table_name, segments=1, page_size=None, max_units_per_second=None, checkpoint=None, **kwargs):
+        """
+        the scans of the nodes one after another, see the scan of the engines
+        checkpoint: the scan checkpoints of the nodes, their entries prefixed
+                    with the node name, e.g. {'a/segments': 1, 'a/0': 'done'}
+        """
+        if checkpoint is None:
+            checkpoint = {}
+        for name in sorted(self.nodes):
+            prefix = name + '/'
+            node_checkpoint = dict((entry[len(prefix):], value) for entry, value in checkpoint.iteritems()
+                                   if entry.startswith(prefix))
+            for item in self._call(name, 'scan', table_name, segments=segments, page_size=page_size,
+                                   max_units_per_second=max_units_per_second, checkpoint=node_checkpoint, **kwargs):
+                checkpoint.update((prefix + entry, value) for entry, value in node_checkpoint.iteritems())
+                yield item
+            checkpoint.update((prefix + entry, value) for entry, value in node_checkpoint.iteritems())
+
+    def list_tables(self):
+        """
+        the tables of every node, without the table suffixes
+        """
+        tables = set()
+        for name, engine in self.nodes.iteritems():
+            suffix = self.table_suffixes[name]
+            tables.update(table[:len(table) - len(suffix)] if suffix else table
+                          for table in engine.list_tables() if table.endswith(suffix))
+        return sorted(tables)
+
+    def get_throughput(self, table_name):
+        """
+        the throughput of the table on the first node
+        """
+        return self._call(sorted(self.nodes)[0], 'get_throughput', table_name)
+
+    def instrument(self, metrics):
+        for engine in self.nodes.itervalues():
+            engine.instrument(metrics)
+
+    def last_retries(self):
+        return sum(engine.last_retries() for engine in self.nodes.itervalues())
+
+    def retry_stats(self):
+        stats = {}
+        for engine in self.nodes.itervalues():
+            for operation, counts in engine.retry_stats().iteritems():
+                merged = stats.setdefault(operation, {})
+                for name, count in counts.iteritems():
+                    merged[name] = merged.get(name, 0) + count
+        return stats
+
+    def rebalance(self, table_name, nodes=None, batch_size=_DEFAULT_BATCH_SIZE, segments=1, page_size=None,
+                  max_units_per_second=None, checkpoint=None, progress=None):
+        """
+        move the values of the table that are not on their node of the ring,
+        inserted on the new node unless it has the key already, which is then
+        newer, and deleted from the old one
+        returns the number of keys inserted on their node
+        counter tables are refused, move counters with rebalance_counters()
+
+        nodes: the nodes to scan, all nodes by default, after adding a node
+               only the nodes of the previous ring hold keys to move
+        segments, page_size, max_units_per_second: see the scan of the engines
+        checkpoint: dict updated after every scanned page, pass it again to
+                    resume, keys of the page in progress may be moved twice
+        progress: called with the number of keys moved so far after every page
+        """
+        if checkpoint is None:
+            checkpoint = {}
+        moved = checkpoint.get('moved', 0)
+        for name in sorted(nodes or self.nodes):
+            node_checkpoint = checkpoint.setdefault('nodes', {}).setdefault(name, {})
+            scan_checkpoint = dict(node_checkpoint)
+            saved = dict(scan_checkpoint)
+            pending = {}
+            for key, data in self._call(name, 'scan', table_name, segments=segments, page_size=page_size,
+                                        max_units_per_second=max_units_per_second, checkpoint=scan_checkpoint):
+                if scan_checkpoint != saved:  # a page is done, move what it had before saving it
+                    moved += self._move(name, table_name, pending)
+                    saved = dict(scan_checkpoint)
+                    _save_rebalance(checkpoint, node_checkpoint, saved, moved, progress)
+                if is_counter_item(key, data):
+                    raise ClusterError("'%s' holds counters, move them with rebalance_counters()" % table_name)
+                if self.ring.node(key) != name:
+                    pending[key] = data
+                    if len(pending) >= batch_size:
+                        moved += self._move(name, table_name, pending)
+            moved += self._move(name, table_name, pending)
+            _save_rebalance(checkpoint, node_checkpoint, scan_checkpoint, moved, progress)
+        logger.info("Moved %s keys of '%s'", moved, table_name)
+        return moved
+
+    def _move(self, name, table_name, pending):
+        """
+        insert the pending items on their node where it doesn't have them,
+        delete them from node `name` and clear pending
+        returns the number of keys inserted
+        """
+        if not pending:
+            return 0
+        inserted = self._map(lambda item: self._call(self.ring.node(item[0]), 'cas', table_name, item[0], None,
+                                                     item[1]).ok,
+                             pending.items())
+        self._call(name, 'delete_many', table_name, pending.keys())
+        pending.clear()
+        return sum(1 for ok in inserted if ok)
+
+    def rebalance_counters(self, table_name, keys, sharded=False, shard_count=1, nodes=None, max_per_second=None):
+        """
+        move the given counters to their node of the ring, their count on
+        any other node is added to it and deleted from there
+        a scan can't tell the shards of a counter from values on every engine,
+        so the counter keys are given, e.g. from top_k
+        not idempotent, a counter interrupted between its incr and
+        delete_counter is counted twice
+        returns the number of counters moved
+        """
+        limiter = RateLimiter(max_per_second) if max_per_second else None
+        moved = 0
+        for key in keys:
+            owner = self.ring.node(key)
+            for name in sorted(nodes or self.nodes):
+                if name == owner:
+                    continue
+                if limiter is not None:
+                    limiter.acquire()
+                count = self._call(name, 'get_count', table_name, key, sharded=sharded)
+                if not count:
+                    continue
+                self._call(owner, 'incr', table_name, key, amount=int(count), shard_count=shard_count)
+                self._call(name, 'delete_counter', table_name, key)
+                moved += 1
+        return moved
+
+
+def _sum(counts):
+    """
+    the sum of the counts that are not None, None if none is
+    """
+    counts = [count for count in counts if count is not None]
+    if not counts:
+        return None
+    return sum(int(count) for count in counts)
+
+
+def _save_rebalance(checkpoint, node_checkpoint, scan_checkpoint, moved, progress):
+    node_checkpoint.clear()
+    node_checkpoint.update(scan_checkpoint)
+    checkpoint['moved'] = moved
+    if progress is not None:
+        progress(moved)
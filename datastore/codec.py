@@ -0,0 +1,194 @@
+'''
+Value codecs with optional compression
+
+An encoded value starts with a 6 byte header:
+    '\\x00ssd' + codec id + compression id
+so values written before a codec was configured, which never start
+with '\\x00', are still decoded the old way.
+'''
+import json
+import zlib
+import datetime
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4
+except ImportError:
+    lz4 = None
+
+_MAGIC = '\x00ssd'
+_HEADER_SIZE = len(_MAGIC) + 2
+_DEFAULT_COMPRESS_THRESHOLD = 1024
+_DEFAULT_COMPRESS_LEVEL = 6
+_MAX_RESOLVED = 1024  # table names whose codec is remembered, time sliced names keep coming
+_UNRESOLVED = object()
+
+
+class CodecError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def _raw_dumps(data):
+    if not isinstance(data, str):
+        raise CodecError('raw codec only stores str, got %s' % type(data).__name__)
+    return data
+
+
+def _msgpack_dumps(data):
+    if msgpack is None:
+        raise CodecError('msgpack codec needs the msgpack package')
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def _msgpack_loads(value):
+    if msgpack is None:
+        raise CodecError('msgpack codec needs the msgpack package')
+    return msgpack.unpackb(value, encoding='utf-8')
+
+
+def _lz4_compress(value, level):
+    if lz4 is None:
+        raise CodecError('lz4 compression needs the lz4 package')
+    return lz4.dumps(value)
+
+
+def _lz4_decompress(value):
+    if lz4 is None:
+        raise CodecError('lz4 compression needs the lz4 package')
+    return lz4.loads(value)
+
+
+# name: (id, dumps, loads)
+CODECS = {
+    'raw': (1, _raw_dumps, lambda value: value),
+    'pickle': (2, lambda data: pickle.dumps(data, pickle.HIGHEST_PROTOCOL), pickle.loads),
+    'json': (3, lambda data: json.dumps(data, separators=(',', ':')), json.loads),
+    'msgpack': (4, _msgpack_dumps, _msgpack_loads),
+}
+
+# name: (id, compress, decompress)
+COMPRESSIONS = {
+    None: (0, None, None),
+    'zlib': (1, zlib.compress, zlib.decompress),
+    'lz4': (2, _lz4_compress, _lz4_decompress),
+}
+
+_CODECS_BY_ID = dict((codec[0], codec) for codec in CODECS.itervalues())
+_COMPRESSIONS_BY_ID = dict((compression[0], compression) for compression in COMPRESSIONS.itervalues())
+
+
+class ValueCodec(object):
+
+    """
+    codec: 'raw', 'pickle' (highest protocol), 'json' or 'msgpack'
+    compression: None, 'zlib' or 'lz4', only used for values of at least
+                 compress_threshold bytes and only kept if it saves space
+    """
+
+    def __init__(self, codec='pickle', compression='zlib',
+                 compress_threshold=_DEFAULT_COMPRESS_THRESHOLD, compress_level=_DEFAULT_COMPRESS_LEVEL):
+        if codec not in CODECS:
+            raise CodecError("unknown codec '%s'" % codec)
+        if compression not in COMPRESSIONS:
+            raise CodecError("unknown compression '%s'" % compression)
+        self.codec = codec
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def encode(self, data):
+        codec_id, dumps, _ = CODECS[self.codec]
+        value = dumps(data)
+        compression_id = 0
+        if self.compression and len(value) >= self.compress_threshold:
+            compressed = COMPRESSIONS[self.compression][1](value, self.compress_level)
+            if len(compressed) < len(value):
+                compression_id = COMPRESSIONS[self.compression][0]
+                value = compressed
+        return _MAGIC + chr(codec_id) + chr(compression_id) + value
+
+
+def is_encoded(value):
+    return isinstance(value, str) and value.startswith(_MAGIC)
+
+
+def decode(value):
+    """
+    decode a value written by ValueCodec.encode, whatever codec it used
+    """
+    if not is_encoded(value):
+        raise CodecError('value has no codec header')
+    try:
+        loads = _CODECS_BY_ID[ord(value[len(_MAGIC)])][2]
+        decompress = _COMPRESSIONS_BY_ID[ord(value[len(_MAGIC) + 1])][2]
+    except (KeyError, IndexError):
+        raise CodecError('unknown codec header %r' % value[:_HEADER_SIZE])
+    value = value[_HEADER_SIZE:]
+    if decompress is not None:
+        value = decompress(value)
+    return loads(value)
+
+
+class CodecRegistry(object):
+
+    """
+    ValueCodec per table
+
+    Settings, for any engine
+    'codec': {'codec': 'pickle', 'compression': 'zlib', 'compress_threshold': 1024},
+    'table_codecs': {'config': {'codec': 'json'},
+                     'events_%Y%m%d': {'codec': 'msgpack', 'compression': 'lz4'}}
+
+    'codec' is the default of every table, without it tables not in
+    'table_codecs' keep the engine's original format.
+    Time formatted names match the tables they are formatted into.
+    """
+
+    def __init__(self, settings):
+        self.default = None
+        if settings.get('codec'):
+            self.default = ValueCodec(**settings['codec'])
+        self.tables = dict((table_name, ValueCodec(**options))
+                           for table_name, options in (settings.get('table_codecs') or {}).iteritems())
+        self._resolved = OrderedDict()  # LRU of table name -> codec
+        self._lock = threading.Lock()
+
+    def get(self, table_name):
+        """
+        the codec of the table, None for the original format
+        """
+        if table_name in self.tables:
+            return self.tables[table_name]
+        with self._lock:
+            codec = self._resolved.pop(table_name, _UNRESOLVED)
+            if codec is not _UNRESOLVED:
+                self._resolved[table_name] = codec  # move to the most recently used end
+                return codec
+        codec = self._match(table_name)
+        with self._lock:
+            self._resolved[table_name] = codec
+            while len(self._resolved) > _MAX_RESOLVED:
+                self._resolved.popitem(last=False)
+        return codec
+
+    def _match(self, table_name):
+        for pattern, codec in self.tables.iteritems():
+            if '%' in pattern:
+                try:
+                    datetime.datetime.strptime(table_name, pattern)
+                except ValueError:
+                    continue
+                return codec
+        return self.default
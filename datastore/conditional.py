@@ -0,0 +1,46 @@
+'''
+Compare-and-set on versioned values
+'''
+from collections import namedtuple
+from retry import RetryError
+
+
+class ConditionalError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+"""
+the result of a cas
+ok: the value was written
+version: the version of the value written, or of the current value on conflict
+value: the value written, or the current value on conflict, None if the key is missing
+"""
+CasResult = namedtuple('CasResult', 'ok version value')
+
+
+def update_if(engine, table_name, key, func, max_retries=None, **kwargs):
+    """
+    read-modify-write with the engine's get_versioned and cas
+
+    func(current value, None if missing) returns the new value,
+    or None to leave the value as it is
+    a conflict calls func again with the value cas returned, without another read
+    returns the CasResult of the last cas, not ok if func returned None
+    """
+    version, data = engine.get_versioned(table_name, key, **kwargs)
+    try:
+        for _ in engine.retry_policy.attempts('update_if', max_retries=max_retries):
+            new_data = func(data)
+            if new_data is None:
+                return CasResult(False, version, data)
+            result = engine.cas(table_name, key, version, new_data, **kwargs)
+            if result.ok:
+                return result
+            version, data = result.version, result.value
+    except RetryError as e:
+        raise ConditionalError("Failed to update '%s' in '%s'. %s" % (key, table_name, e.value))
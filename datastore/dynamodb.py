@@ -4,13 +4,38 @@ Created on 2014/1/23
 @author: sushih-wen
 '''
 import random
+import logging
 import datetime
+import threading
 import cPickle as pickle
-from functools import wraps
+from decimal import Decimal
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from functools import wraps, partial
 from boto import dynamodb2
 from boto.dynamodb2.fields import HashKey, RangeKey
-from boto.dynamodb2.exceptions import JSONResponseError, ValidationException
+from boto.dynamodb2.exceptions import JSONResponseError, ValidationException, ConditionalCheckFailedException
+from boto.dynamodb2.exceptions import ResourceNotFoundException
 from boto.dynamodb2.table import Table
+from boto.dynamodb2.items import Item
+from boto.dynamodb2.types import Dynamizer
+from boto.dynamodb.types import Binary
+from adaptive import AdaptiveShardCount
+from codec import CodecRegistry
+from retry import RetryPolicy, RetryError
+from timeslice import SliceLookup
+from pool import ClientPool, ClientProxy
+from scan import scan_pages, RateLimiter
+from chunking import ValueChunker, ChunkError
+from conditional import CasResult
+from window import Window
+import hyperloglog
+import chunking
+import conditional
+import codec
+import timeslice
+
+logger = logging.getLogger(__name__)
 
 
 class DynamoDBError(Exception):
@@ -45,10 +70,20 @@ _COUNTER_SHARD_SUFFIX = '_' + _COUNTER_DEFAULT_SHARD_FORMAT
 _COUNTER_SHARD_INDEX_TABLE_SUFFIX = '_shard_index'
 _COUNTER_SHARD_COUNT_TABLE_SUFFIX = '_shard_count'
 _DEFAULT_DATA_PROPERTY = 'data'
+_DEFAULT_VERSION_PROPERTY = 'version'
 _DEFAULT_HASH_KEY_NAME = 'key'
+_BATCH_GET_MAX_KEYS = 100
+_BATCH_WRITE_MAX_ITEMS = 25
+_BATCH_MAX_RETRY = 10
+_BATCH_GET_WORKERS = 8  # BatchGetItem requests of one call sent at the same time
+_MAX_CACHED_TABLES = 1000
+_CHUNK_SIZE = 350 * 1024
+_CHUNKS_PER_REQUEST = 16  # 16 MB per BatchGetItem response
+_NUMBER_TYPES = (int, long, Decimal)  # the data of counter items, e.g. read by a scan
 
 # ERROR
 _TABLE_DOES_NOT_EXIST = 'Looks like the table does not exist or the connection is wrong.'
+_BATCH_EXCEEDED_MAX_RETRY = 'Batch request exceeded max retry'
 
 
 def transform_table_name(f):
@@ -83,17 +118,21 @@ class DynamoDB(object):
         read/write throughtput: read/write capacity times per second
         refer: http://aws.amazon.com/dynamodb/pricing/
 
-        create layer2 connection
+        create layer2 connection, one per thread, see pool.ClientPool
         '''
         self.settings = settings
-        self.conn = dynamodb2.connect_to_region(settings.get('region', 'ap-northeast-1'),
-                                                aws_access_key_id=settings.get('aws_access_key_id'),
-                                                aws_secret_access_key=settings.get('aws_secret_access_key')
-                                                )
+        self.clients = ClientPool(self._connect, **(settings.get('client_pool') or {}))
+        self.conn = ClientProxy(self.clients)
         self.default_throughput = {'read': settings.get('default_throughput').get('read', 100),
                                    'write': settings.get('default_throughput').get('write', 100)
                                    }
-        self._tables = {}
+        #
+        # Table instances by name, the least recently used are dropped
+        # so time sliced names don't pile up
+        #
+        self._tables = OrderedDict()
+        self._tables_lock = threading.Lock()
+        self.max_cached_tables = settings.get('max_cached_tables', _MAX_CACHED_TABLES)
         #
         # hash_key_name is 'key', type is 'S' for string
         # no range key
@@ -101,9 +140,31 @@ class DynamoDB(object):
         self.hash_key_name = settings.get('hash_key_name', _DEFAULT_HASH_KEY_NAME)
         self.range_key_name = settings.get('range_key_name', None)
         self.data_property = settings.get('data_property', _DEFAULT_DATA_PROPERTY)
+        self.version_property = settings.get('version_property', _DEFAULT_VERSION_PROPERTY)
         self.default_schema = [HashKey(self.hash_key_name)]
         if self.range_key_name:
             self.default_schema.append(RangeKey(self.range_key_name))
+        self.max_batch_retry = settings.get('max_batch_retry', _BATCH_MAX_RETRY)
+        self.batch_get_workers = settings.get('batch_get_workers', _BATCH_GET_WORKERS)
+        self._batch_pool = None
+        self._batch_pool_lock = threading.Lock()
+        self.retry_policy = RetryPolicy(**(settings.get('retry') or {}))
+        self.slices = SliceLookup(**(settings.get('time_slices') or {}))
+        self._dynamizer = Dynamizer()
+        self.codecs = CodecRegistry(settings)
+        chunked_values = settings.get('chunked_values')
+        self.chunker = ValueChunker(**dict({'chunk_size': _CHUNK_SIZE if chunked_values else None},
+                                           **(chunked_values if isinstance(chunked_values, dict) else {})))
+        #
+        # fixed shard counters use shards 1..shard_count and the shard_count
+        # stored in the '<table>_shard_count' table instead of the shard index
+        #
+        self.fixed_shard_counters = settings.get('fixed_shard_counters', False)
+        self._shard_counts = {}  # (table_name, key) -> stored shard_count known to this process
+        self.adaptive = None
+        if settings.get('adaptive_shard_counters'):
+            self.adaptive = AdaptiveShardCount(**settings['adaptive_shard_counters'])
+        self.distinct_counters = settings.get('distinct_counters') or {}
 
     @transform_table_name
     def create_table(self, table_name, read=None, write=None, with_api_calls=True, transform_time=None):
@@ -132,7 +193,7 @@ class DynamoDB(object):
         if with_api_calls:
             try:
                 table = Table.create(table_name, **kwargs)
-                self._tables[table_name] = table
+                self._cache_table(table_name, table)
             except JSONResponseError as e:
                 if 'Duplicate' in str(e):  # if the table already exist
                     return self.get_table(table_name)
@@ -150,15 +211,63 @@ class DynamoDB(object):
         """
         get table
         """
-        if table_name in self._tables.keys():
-            return self._tables[table_name]
+        table = self._cached_table(table_name)
+        if table is not None:
+            return table
         if with_api_calls:
             table = Table(table_name, connection=self.conn)
-            self._tables[table_name] = table
+            self._cache_table(table_name, table)
         else:
             table = Table(table_name, connection=self.conn, schema=self.default_schema)
         return table
 
+    def _connect(self):
+        return dynamodb2.connect_to_region(self.settings.get('region', 'ap-northeast-1'),
+                                           aws_access_key_id=self.settings.get('aws_access_key_id'),
+                                           aws_secret_access_key=self.settings.get('aws_secret_access_key')
+                                           )
+
+    def _cached_table(self, table_name):
+        with self._tables_lock:
+            table = self._tables.pop(table_name, None)
+            if table is not None:
+                self._tables[table_name] = table  # most recently used
+            return table
+
+    def _cache_table(self, table_name, table):
+        with self._tables_lock:
+            self._tables.pop(table_name, None)
+            self._tables[table_name] = table
+            while len(self._tables) > self.max_cached_tables:
+                self._tables.popitem(last=False)
+
+    def list_tables(self):
+        """
+        names of all the tables of the account in the region
+        """
+        names = []
+        start = None
+        while True:
+            response = self.conn.list_tables(exclusive_start_table_name=start, limit=100)
+            names.extend(response.get('TableNames', []))
+            start = response.get('LastEvaluatedTableName')
+            if not start:
+                return names
+
+    @transform_table_name
+    def get_throughput(self, table_name):
+        """
+        {'read': n, 'write': n, 'status': 'ACTIVE'} of the table, None if it doesn't exist
+        """
+        try:
+            description = self.conn.describe_table(table_name)['Table']
+        except ResourceNotFoundException:
+            return None
+        throughput = description['ProvisionedThroughput']
+        return {'read': throughput['ReadCapacityUnits'],
+                'write': throughput['WriteCapacityUnits'],
+                'status': description['TableStatus']}
+
     def get_or_create_table(self, table_name):
         table = self.get_table(table_name)
         if not table:
@@ -175,32 +284,71 @@ class DynamoDB(object):
     @transform_table_name
     def delete_table(self, table_name):
         table = self.get_table(table_name)
+        with self._tables_lock:
+            self._tables.pop(table_name, None)
         return table.delete()
 
-    def get_item(self, table_name, key, timedelta_slice=1):
-        now = datetime.datetime.utcnow()
-        item = self._get_item_from_time_sliced_table(table_name, key, now)
-        if not item.keys() and timedelta_slice and '%' in table_name:  # if it's a time sliced table
-            last_time = now - datetime.timedelta(timedelta_slice)
-            item = self._get_item_from_time_sliced_table(table_name, key, last_time)
+    def get_item(self, table_name, key, timedelta_slice=1, lookback=None):
+        """
+        the item of the freshest time slice holding the key, see timeslice.SliceLookup
+        an empty Item of the current slice if none does
+        """
+        _, item = self.slices.lookup(table_name, key, self._get_slice_item, timedelta_slice, lookback)
+        if item is None:
+            return Item(self.get_table(table_name))
         return item
 
-    def get_data(self, table_name, key, timedelta_slice=1, pickled=True):
+    def _get_slice_item(self, table_name, key):
+        item = self._get_item_from_time_sliced_table(table_name, key)
+        if item.keys():
+            return item
+        return None
+
+    def get_data(self, table_name, key, timedelta_slice=1, pickled=True, lookback=None):
         """
-        get data from this or last time sliced table
+        get data from this or earlier time sliced tables
         timedelta_slice: time slice size, in timedelta
         timedelta_slice=1 means one day
+        lookback: number of earlier slices to look in, 1 by default, see timeslice.SliceLookup
 
         """
-        item = self.get_item(table_name, key, timedelta_slice=timedelta_slice)
+        item = self.get_item(table_name, key, timedelta_slice=timedelta_slice, lookback=lookback)
         if item:
-            if pickled and item.get(self.data_property, None):
-                return pickle.loads(str(item[self.data_property]))
-            else:
-                return item[self.data_property]
+            slice_table_name = item.table.table_name
+            try:
+                data = self._read_chunks(slice_table_name, key, item[self.data_property])
+            except ChunkError:
+                # replaced while its chunks were read, the new chunks are there before the new manifest
+                item = self.get_table(slice_table_name).get_item(consistent=True, **{self.hash_key_name: key})
+                data = self._read_chunks(slice_table_name, key, item.get(self.data_property))
+            return self._decode_data(data, pickled)
         else:
             return None
 
+    def _encode_data(self, table_name, data, pickled):
+        """
+        pickled data is encoded by the table's codec, stored as binary,
+        or with the default pickle protocol when the table has no codec
+        """
+        if not pickled:
+            return data
+        value_codec = self.codecs.get(table_name)
+        if value_codec is None:
+            return pickle.dumps(data)
+        return Binary(value_codec.encode(data))
+
+    def _decode_data(self, data, pickled):
+        """
+        only strings and binaries are unpickled, numbers are counters and sets
+        are shard indexes, they are returned as they are
+        """
+        if pickled and data and isinstance(data, (basestring, Binary)):
+            data = str(data)
+            if codec.is_encoded(data):
+                return codec.decode(data)
+            return pickle.loads(data)
+        return data
+
     @transform_table_name
     def set_data(self, table_name, key, data,
                  range_key=None, pickled=True, overwrite=True, transform_time=None):
@@ -215,8 +363,11 @@ class DynamoDB(object):
 
         Returns ``True`` on success.
         """
-        if pickled:
-            data = pickle.dumps(data)
+        data = self._encode_data(table_name, data, pickled)
+        if self.chunker.enabled and pickled and not range_key:
+            self._put_chunked(table_name, key, data,
+                              expected=None if overwrite else {self.hash_key_name: {'Exists': False}})
+            return True
         table = self.get_table(table_name)
         if not table:
             # this shouldn't happened,
@@ -231,13 +382,119 @@ class DynamoDB(object):
             raise DynamoDBError(e)
         except JSONResponseError as e:
             raise DynamoDBError(_TABLE_DOES_NOT_EXIST + ": '%s'. %s" % (table_name, e))
+        self.slices.forget(table_name, key)
         return item
 
-    def _get_item_from_time_sliced_table(self, table_name, key, dtime):
+    def _put_chunked(self, table_name, key, data, expected=None, version=None, chunked=True):
+        """
+        the chunks of a large value first, then the manifest or the small value
+        with a put returning the old value, then the chunks of the old value
+        a failed expected condition raises ConditionalCheckFailedException
+        """
+        manifest, chunks = self.chunker.split(key, str(data)) if chunked else (None, None)
+        if chunks:
+            self._batch_write_items(table_name, [self._put_request(chunk_key, Binary(chunk))
+                                                 for chunk_key, chunk in chunks])
+            data = Binary(manifest)
+        item = self._put_request(key, data)['PutRequest']['Item']
+        if version is not None:
+            item[self.version_property] = {'N': str(version)}
+        try:
+            response = self.conn.put_item(table_name, item, expected=expected, return_values='ALL_OLD')
+        except ConditionalCheckFailedException:
+            self._delete_chunks(table_name, key, data)
+            raise
+        except ValidationException as e:
+            raise DynamoDBError(e)
+        except JSONResponseError as e:
+            raise DynamoDBError(_TABLE_DOES_NOT_EXIST + ": '%s'. %s" % (table_name, e))
+        old = response.get('Attributes', {}).get(self.data_property)
+        if old is not None:
+            self._delete_chunks(table_name, key, self._dynamizer.decode(old))
+        self.slices.forget(table_name, key)
+
+    @transform_table_name
+    def get_versioned(self, table_name, key, pickled=True, transform_time=None):
+        """
+        (version, data) of the key with a consistent read, (None, None) if it's missing
+        the version is 0 for data written by set_data, a cas on 0 also overwrites
+        what set_data wrote meanwhile, so don't mix both on a key
+        """
+        item = self.get_table(table_name).get_item(consistent=True, **{self.hash_key_name: key})
+        if not item.keys():
+            return None, None
+        data = self._read_chunks(table_name, key, item.get(self.data_property))
+        return int(item.get(self.version_property) or 0), self._decode_data(data, pickled)
+
+    @transform_table_name
+    def cas(self, table_name, key, expected_version, data, pickled=True, transform_time=None):
+        """
+        write data if the version of the key is still expected_version,
+        None for a missing key, see get_versioned
+        one conditional put, on conflict the current value is read consistently,
+        returns a conditional.CasResult
         """
-        dtime: is a datetime instance, indicates the
+        if expected_version is None:
+            expected = {self.hash_key_name: {'Exists': False}}
+        elif expected_version == 0:  # written by set_data, the key must exist
+            expected = {self.version_property: {'Exists': False},
+                        self.hash_key_name: {'Value': self._dynamizer.encode(key)}}
+        else:
+            expected = {self.version_property: {'Value': {'N': str(expected_version)}}}
+        version = (expected_version or 0) + 1
+        try:
+            self._put_chunked(table_name, key, self._encode_data(table_name, data, pickled), expected, version, pickled)
+        except ConditionalCheckFailedException:
+            current_version, current = self.get_versioned(table_name, key, pickled)
+            return CasResult(False, current_version, current)
+        return CasResult(True, version, data)
+
+    @transform_table_name
+    def update_if(self, table_name, key, func, max_retries=None, pickled=True, transform_time=None):
+        """
+        cas func(current value) until it's written, see conditional.update_if
+        """
+        return conditional.update_if(self, table_name, key, func, max_retries=max_retries, pickled=pickled)
+
+    def _chunk_manifest(self, data):
+        if isinstance(data, Binary) and chunking.is_manifest(str(data)):
+            return str(data)
+        return None
+
+    def _read_chunks(self, table_name, key, data):
         """
-        table_name = dtime.strftime(table_name)
+        the value of a manifest, groups of its chunks are read in parallel
+        """
+        manifest = self._chunk_manifest(data)
+        if manifest is None:
+            return data
+        chunk_keys = self.chunker.chunk_keys(key, manifest)
+        groups = [chunk_keys[i:i + _CHUNKS_PER_REQUEST] for i in xrange(0, len(chunk_keys), _CHUNKS_PER_REQUEST)]
+        chunks = {}
+        for items in self.chunker.map(lambda group: self._batch_get_items(table_name, group, consistent=True), groups):
+            chunks.update((chunk_key, str(item[self.data_property])) for chunk_key, item in items.iteritems())
+        return self.chunker.join(key, manifest, chunks)
+
+    def _delete_chunks(self, table_name, key, old):
+        """
+        delete the chunks of a replaced or deleted value
+        """
+        manifest = self._chunk_manifest(old)
+        if manifest is not None:
+            self._batch_write_items(table_name, [{'DeleteRequest': {'Key': {self.hash_key_name: self._dynamizer.encode(chunk_key)}}}
+                                                 for chunk_key in self.chunker.chunk_keys(key, manifest)])
+
+    def _put_request(self, key, data):
+        return {'PutRequest': {'Item': {self.hash_key_name: self._dynamizer.encode(key),
+                                        self.data_property: self._dynamizer.encode(data)}}}
+
+    def _get_item_from_time_sliced_table(self, table_name, key, dtime=None):
+        """
+        dtime: is a datetime instance, indicates the time slice,
+        None if table_name is already the name of the slice
+        """
+        if dtime is not None:
+            table_name = dtime.strftime(table_name)
         table = self.get_table(table_name)
         if not table:
             # this shouldn't happened,
@@ -248,14 +505,241 @@ class DynamoDB(object):
         except ValidationException as e:
             raise DynamoDBError(e)
 
-    def delete_data(self, table_name, key, timedelta_slice=1):
-        item = self.get_item(table_name, key, timedelta_slice=timedelta_slice)
+    def delete_data(self, table_name, key, timedelta_slice=1, lookback=None):
+        item = self.get_item(table_name, key, timedelta_slice=timedelta_slice, lookback=lookback)
         if item.keys():
-
-            return item.delete()
+            deleted = item.delete()
+            self._delete_chunks(item.table.table_name, key, item.get(self.data_property))
+            return deleted
         else:
             return False
 
+    def get_many(self, table_name, keys, timedelta_slice=1, pickled=True):
+        """
+        get data of many keys with BatchGetItem
+        keys missing in this time sliced table are looked up in the earlier ones
+
+        returns a dict keyed by the input keys, missing keys are None
+        """
+        keys = list(keys)
+        results = dict.fromkeys(keys)
+        missing = set(keys)
+        for slice_table_name in self.slices.table_names(table_name, timedelta_slice):
+            if not missing:
+                break
+            items = self._batch_get_items(slice_table_name, missing)
+            for key, item in items.iteritems():
+                results[key] = self._decode_data(self._read_chunks(slice_table_name, key, item.get(self.data_property)),
+                                                 pickled)
+            missing.difference_update(items.keys())
+        return results
+
+    @transform_table_name
+    def set_many(self, table_name, items, pickled=True, transform_time=None):
+        """
+        put many items with BatchWriteItem
+        items: dict of key to data
+
+        Not an atomic operation, see delete_counter
+        with chunked values, the keys are read first to delete the chunks they replace
+        Returns ``True`` on success.
+        """
+        chunked = self.chunker.enabled and pickled
+        old = self._batch_get_items(table_name, items.keys()) if chunked else {}
+        requests = []
+        chunk_requests = []
+        for key, data in items.iteritems():
+            data = self._encode_data(table_name, data, pickled)
+            manifest, chunks = self.chunker.split(key, str(data)) if chunked else (None, None)
+            if chunks:
+                chunk_requests.extend(self._put_request(chunk_key, Binary(chunk)) for chunk_key, chunk in chunks)
+                data = Binary(manifest)
+            requests.append(self._put_request(key, data))
+        self._batch_write_items(table_name, chunk_requests)
+        self._batch_write_items(table_name, requests)
+        for key, item in old.iteritems():
+            self._delete_chunks(table_name, key, item.get(self.data_property))
+        for key in items:
+            self.slices.forget(table_name, key)
+        return True
+
+    def delete_many(self, table_name, keys, timedelta_slice=1):
+        """
+        delete many keys with BatchWriteItem
+        keys are deleted from this and the earlier time sliced tables
+        with chunked values, the keys are read first to delete their chunks
+
+        Returns ``True`` on success.
+        """
+        keys = set(keys)
+        requests = [{'DeleteRequest': {'Key': {self.hash_key_name: self._dynamizer.encode(key)}}}
+                    for key in keys]
+        for slice_table_name in self.slices.table_names(table_name, timedelta_slice):
+            old = self._batch_get_items(slice_table_name, keys) if self.chunker.enabled else {}
+            self._batch_write_items(slice_table_name, requests)
+            for key, item in old.iteritems():
+                self._delete_chunks(slice_table_name, key, item.get(self.data_property))
+        return True
+
+    @transform_table_name
+    def scan(self, table_name, segments=1, page_size=None, max_units_per_second=None,
+             checkpoint=None, keys_only=False, pickled=True, transform_time=None):
+        """
+        yield (key, data) of every item of the table, see scan.scan_pages
+        segments: parallel Scan segments, read by a thread each
+        page_size: items per Scan request, a request returns at most 1 MB anyway
+        max_units_per_second: read capacity units all segments may consume per second
+        checkpoint: dict updated while the scan goes, pass it again to resume
+        keys_only: only read the keys, data is None
+        chunks of chunked values are skipped, their manifests are read as the value
+        """
+        attributes = [self.hash_key_name] if keys_only else None
+        parallel = segments > 1
+
+        def fetch(segment, start):
+            try:
+                response = self.conn.scan(table_name, attributes_to_get=attributes, limit=page_size,
+                                          exclusive_start_key=start, return_consumed_capacity='TOTAL',
+                                          total_segments=segments if parallel else None,
+                                          segment=segment if parallel else None)
+            except ResourceNotFoundException as e:
+                raise DynamoDBError(_TABLE_DOES_NOT_EXIST + ": '%s'. %s" % (table_name, e))
+            except ValidationException as e:
+                raise DynamoDBError(e)
+            items = []
+            for raw_item in response.get('Items', []):
+                key = self._dynamizer.decode(raw_item[self.hash_key_name])
+                if chunking.is_chunk_key(key):
+                    continue
+                data = raw_item.get(self.data_property)
+                if data is not None:
+                    data = self._read_chunks(table_name, key, self._dynamizer.decode(data))
+                    try:
+                        data = self._decode_data(data, pickled)
+                    except Exception as e:  # not written pickled, e.g. by another client
+                        logger.debug("Scanned '%s' of '%s' as it is: %s", key, table_name, e)
+                items.append((key, data))
+            units = response.get('ConsumedCapacity', {}).get('CapacityUnits', len(response.get('Items', [])))
+            return items, response.get('LastEvaluatedKey'), units
+
+        limiter = RateLimiter(max_units_per_second) if max_units_per_second else None
+        for item in scan_pages(fetch, segments, checkpoint, limiter):
+            yield item
+
+    def _batch_get_items(self, table_name, keys, consistent=False):
+        """
+        returns a dict of key to decoded item attributes
+        """
+        return self._batch_get_tables({table_name: keys}, consistent).get(table_name, {})
+
+    def _batch_get_tables(self, table_keys, consistent=False):
+        """
+        table_keys: dict of table name to keys
+        consistent: strongly consistent reads
+        BatchGetItem:
+        - up to 100 keys per request, of one or more tables
+        - requests of more keys are sent in parallel, batch_get_workers at a time
+        - UnprocessedKeys are resent with backoff
+        returns a dict of table name to {key: decoded item attributes}
+        """
+        items = dict((table_name, {}) for table_name in table_keys)
+        pairs = [(table_name, key) for table_name, keys in table_keys.iteritems() for key in set(keys)]
+        requests = []
+        for i in xrange(0, len(pairs), _BATCH_GET_MAX_KEYS):
+            request_items = {}
+            for table_name, key in pairs[i:i + _BATCH_GET_MAX_KEYS]:
+                request_items.setdefault(table_name, {'Keys': [], 'ConsistentRead': consistent})['Keys'].append(
+                    {self.hash_key_name: self._dynamizer.encode(key)})
+            requests.append(request_items)
+        if len(requests) > 1:
+            responses = self._get_batch_pool().map(self._batch_get_request, requests)
+        else:
+            responses = [self._batch_get_request(request) for request in requests]
+        for response in responses:
+            for table_name, item in response:
+                items[table_name][item[self.hash_key_name]] = item
+        return items
+
+    def _batch_get_request(self, request_items):
+        """
+        one BatchGetItem and the resent UnprocessedKeys, returns [(table name, item), ...]
+        """
+        items = []
+        try:
+            for _ in self.retry_policy.attempts('batch_get', max_retries=self.max_batch_retry):
+                try:
+                    response = self.conn.batch_get_item(request_items)
+                except JSONResponseError as e:
+                    raise DynamoDBError(_TABLE_DOES_NOT_EXIST + ": '%s'. %s" % (', '.join(request_items), e))
+                for table_name, raw_items in response.get('Responses', {}).iteritems():
+                    for raw_item in raw_items:
+                        items.append((table_name,
+                                      dict((name, self._dynamizer.decode(value)) for name, value in raw_item.iteritems())))
+                request_items = response.get('UnprocessedKeys') or {}
+                if not request_items:
+                    return items
+        except RetryError as e:
+            raise DynamoDBError("%s, %s unprocessed. %s" % (_BATCH_EXCEEDED_MAX_RETRY, len(request_items), e.value))
+
+    def _get_batch_pool(self):
+        with self._batch_pool_lock:
+            if self._batch_pool is None:
+                self._batch_pool = ThreadPool(self.batch_get_workers)
+            return self._batch_pool
+
+    def _batch_write_items(self, table_name, requests):
+        """
+        BatchWriteItem:
+        - up to 25 put or delete requests per request
+        - UnprocessedItems are resent with backoff
+        """
+        for i in xrange(0, len(requests), _BATCH_WRITE_MAX_ITEMS):
+            request_items = requests[i:i + _BATCH_WRITE_MAX_ITEMS]
+            try:
+                for _ in self.retry_policy.attempts('batch_write', max_retries=self.max_batch_retry):
+                    try:
+                        response = self.conn.batch_write_item({table_name: request_items})
+                    except ValidationException as e:
+                        raise DynamoDBError(e)
+                    except JSONResponseError as e:
+                        raise DynamoDBError(_TABLE_DOES_NOT_EXIST + ": '%s'. %s" % (table_name, e))
+                    request_items = response.get('UnprocessedItems', {}).get(table_name, [])
+                    if not request_items:
+                        break
+            except RetryError as e:
+                raise DynamoDBError("%s, %s unprocessed. %s" % (_BATCH_EXCEEDED_MAX_RETRY, len(request_items), e.value))
+
+    def last_retries(self):
+        """
+        retries of the last retried call made by this thread
+        """
+        return self.retry_policy.last_retries()
+
+    def retry_stats(self):
+        return self.retry_policy.stats()
+
+    def instrument(self, metrics):
+        """
+        count the requests, retries and throttles of every operation in metrics
+        boto retries throttled requests itself, those are counted as throttles
+        """
+        def instrument_connection(conn):
+            conn.make_request = metrics.counting(conn.make_request)
+            retry_handler = conn._retry_handler
+
+            def counting_retry_handler(*args, **kwargs):
+                throttled = conn.throughput_exceeded_events
+                try:
+                    return retry_handler(*args, **kwargs)
+                finally:
+                    if conn.throughput_exceeded_events > throttled:
+                        metrics.throttled(conn.throughput_exceeded_events - throttled)
+
+            conn._retry_handler = counting_retry_handler
+
+        self.clients.setup(instrument_connection)
+        self.retry_policy.listener = metrics.retried
+
     def sharded_key(self, key, shard):
         return key + _COUNTER_SHARD_SUFFIX % shard
 
@@ -265,9 +749,30 @@ class DynamoDB(object):
         The strategy is try to increase first, if counter doesn't exist,
         create the shard index in the index table
         incr workds event the key doesn't previously exist
+
+        with adaptive shard counters, shard_count is the least shard count,
+        throttled increments grow the shard count of the counter
         """
         if shard_count < 1:
             shard_count = 1
+        self.slices.forget(table_name, key, timeslice.COUNT, timeslice.SHARDED_COUNT)
+        if self.adaptive is None:
+            return self._incr(table_name, key, amount, shard_count)
+
+        shard_count = max(shard_count, self.adaptive.shard_count(table_name, key))
+        # boto retries throttled requests itself and counts them on the connection
+        # of this thread, the last one too when it gives up
+        throttled = self.conn.throughput_exceeded_events
+        try:
+            return self._incr(table_name, key, amount, shard_count)
+        finally:
+            events = self.conn.throughput_exceeded_events - throttled
+            if events > 0:
+                self.adaptive.record(table_name, key, events)
+
+    def _incr(self, table_name, key, amount, shard_count):
+        if self.fixed_shard_counters:
+            return self._incr_fixed_shard(table_name, key, amount, shard_count)
         shard = str(random.randint(1, shard_count))
         sharded_key = self.sharded_key(key, shard)
 
@@ -282,6 +787,71 @@ class DynamoDB(object):
         if not before_update:  # if this is a new shard key, before_update would be {}
             self._update_counter_indice(table_name, key, shard)
 
+    def _incr_fixed_shard(self, table_name, key, amount, shard_count):
+        """
+        one update_item without return values and no shard index,
+        the shard_count is recorded once per counter per process
+        """
+        self.update_counter_shard_count(table_name, key, shard_count)
+        sharded_key = self.sharded_key(key, random.randint(1, shard_count))
+        self.conn.update_item(table_name,
+                              {self.hash_key_name: {"S": sharded_key}},
+                              {self.data_property:
+                               {"Action": "ADD", "Value": {"N": str(amount)}}
+                               }
+                              )
+
+    def get_counter_shard_count(self, table_name, key):
+        """
+        the stored shard_count of a fixed shard counter, 0 if there is none
+        """
+        shard_count_table_name = table_name + _COUNTER_SHARD_COUNT_TABLE_SUFFIX
+        try:
+            item = self.conn.get_item(shard_count_table_name,
+                                      {self.hash_key_name: {"S": key}},
+                                      consistent_read=True)
+        except JSONResponseError as e:
+            raise DynamoDBError(_TABLE_DOES_NOT_EXIST + ": '%s'. %s" % (shard_count_table_name, e))
+        count = int(self._dynamizer.decode(item['Item'][self.data_property])) if item.get('Item') else 0
+        self._remember_shard_count(table_name, key, count)
+        return count
+
+    def update_counter_shard_count(self, table_name, key, shard_count):
+        """
+        the stored shard_count only grows, shards beyond a smaller shard_count
+        would still hold counts
+        a conditional put makes concurrent writers agree on the largest one
+        """
+        if self._shard_counts.get((table_name, key), 0) >= shard_count:
+            return
+        shard_count_table_name = table_name + _COUNTER_SHARD_COUNT_TABLE_SUFFIX
+        try:
+            for _ in self.retry_policy.attempts('shard_count', max_retries=self.max_batch_retry):
+                stored = self.get_counter_shard_count(table_name, key)
+                if stored >= shard_count:
+                    return
+                if stored:
+                    expected = {self.data_property: {'Value': {'N': str(stored)}}}
+                else:
+                    expected = {self.data_property: {'Exists': False}}
+                try:
+                    self.conn.put_item(shard_count_table_name,
+                                       {self.hash_key_name: {"S": key},
+                                        self.data_property: {"N": str(shard_count)}},
+                                       expected=expected)
+                except ConditionalCheckFailedException:
+                    continue  # someone else updated it, read it again
+                except JSONResponseError as e:
+                    raise DynamoDBError(_TABLE_DOES_NOT_EXIST + ": '%s'. %s" % (shard_count_table_name, e))
+                self._remember_shard_count(table_name, key, shard_count)
+                return
+        except RetryError as e:
+            raise DynamoDBError("Failed to update shard count of '%s' in '%s'. %s" % (key, shard_count_table_name, e.value))
+
+    def _remember_shard_count(self, table_name, key, shard_count):
+        if shard_count > self._shard_counts.get((table_name, key), 0):
+            self._shard_counts[(table_name, key)] = shard_count
+
     def _update_counter_indice(self, table_name, key, shard, retry=3):
         """
         save/update counter shard indice to the seperated index table
@@ -289,36 +859,56 @@ class DynamoDB(object):
         http://docs.aws.amazon.com/amazondynamodb/latest/developerguide/DataModel.html#DataModel.DataTypes
         """
         index_table_name = table_name + _COUNTER_SHARD_INDEX_TABLE_SUFFIX
+        error = None
         try:
-            self.conn.update_item(index_table_name,
-                                  {self.hash_key_name: {"S": key}},
-                                  {self.data_property:
-                                   {"Action": "ADD", "Value": {"SS": [shard]}}  # string set
-                                   }
-                                  )
-        except JSONResponseError as e:
-            print index_table_name, key, shard
-            if retry <= 0:
-                raise DynamoDBError(e)
-            else:
-                self._update_counter_indice(table_name, key, shard, retry - 1)
+            for _ in self.retry_policy.attempts('update_index', max_retries=retry):
+                try:
+                    return self.conn.update_item(index_table_name,
+                                                 {self.hash_key_name: {"S": key}},
+                                                 {self.data_property:
+                                                  {"Action": "ADD", "Value": {"SS": [shard]}}  # string set
+                                                  }
+                                                 )
+                except JSONResponseError as e:
+                    logger.warning("Failed to add shard %s of '%s' to '%s', will retry: %s",
+                                   shard, key, index_table_name, e)
+                    error = e
+        except RetryError:
+            raise DynamoDBError(error)
 
-    @transform_table_name
-    def get_count(self, table_name, key, sharded=False):
+    def get_count(self, table_name, key, sharded=False, shard_count=None, timedelta_slice=1, lookback=0):
         """
         because we shard on the primary key, we need to know how many shards
         how many shard exists
+
+        shard_count: for fixed shard counters, skip looking up the stored shard_count
+        lookback: number of earlier time slices to look in when the counter is
+        missing from the current one, see timeslice.SliceLookup
+        adaptive shard counters increment random shards, they are always read sharded
         """
+        sharded = sharded or self.adaptive is not None
+        _, count = self.slices.lookup(table_name, key,
+                                      partial(self._get_count, sharded=sharded, shard_count=shard_count),
+                                      timedelta_slice, lookback, timeslice.SHARDED_COUNT if sharded else timeslice.COUNT)
+        if count is None and sharded:
+            return 0
+        return count
 
-        if sharded:
-            counter_sum = 0
+    def _get_count(self, table_name, key, sharded=False, shard_count=None):
+        """
+        returns None when the counter is missing
+        """
+        if sharded and self.fixed_shard_counters:
+            return self._get_fixed_shard_count(table_name, key, shard_count)
+        elif sharded:
+            counter_sum = None
             counter = None
             counters = self._get_counters_from_indice(table_name, key)
 
             if counters:
                 for counter in counters:
 
-                    counter_sum += int(counter.get(self.data_property, 0))
+                    counter_sum = (counter_sum or 0) + int(counter.get(self.data_property, 0))
             return counter_sum
         else:
             key = self.sharded_key(key, 1)  # only one shard
@@ -327,6 +917,129 @@ class DynamoDB(object):
                 return counter.get(self.data_property, None)
             return None
 
+    def _get_fixed_shard_count(self, table_name, key, shard_count=None):
+        return self._get_fixed_shard_counts(table_name, [key], shard_count)[key]
+
+    def _get_fixed_shard_counts(self, table_name, keys, shard_count=None):
+        """
+        read the shards 1..N known to this process together with the stored
+        shard_counts in one BatchGetItem, missing shards count as zero
+        only counters whose stored shard_count has grown get their new shards read again
+        returns a dict of key to count, None for missing counters
+        """
+        shard_count_table_name = table_name + _COUNTER_SHARD_COUNT_TABLE_SUFFIX
+        known = dict((key, shard_count or self._shard_counts.get((table_name, key), 0)) for key in keys)
+        shard_keys = dict((key, [self.sharded_key(key, shard) for shard in xrange(1, known[key] + 1)]) for key in keys)
+        table_keys = {table_name: [sharded_key for sharded_keys in shard_keys.itervalues() for sharded_key in sharded_keys]}
+        if not shard_count:
+            table_keys[shard_count_table_name] = keys
+        items = self._batch_get_tables(table_keys)
+        counters = items.get(table_name, {})
+        grown = []
+        for key, stored in items.get(shard_count_table_name, {}).iteritems():
+            stored = int(stored[self.data_property])
+            self._remember_shard_count(table_name, key, stored)
+            new_keys = [self.sharded_key(key, shard) for shard in xrange(known[key] + 1, stored + 1)]
+            shard_keys[key].extend(new_keys)
+            grown.extend(new_keys)
+        if grown:
+            counters.update(self._batch_get_items(table_name, grown))
+        return dict((key, self._sum_counters(counters, shard_keys[key])) for key in keys)
+
+    def _sum_counters(self, counters, sharded_keys):
+        """
+        counters: dict of sharded key to counter item
+        returns None if none of the shards exists
+        """
+        found = [counters[sharded_key] for sharded_key in sharded_keys if sharded_key in counters]
+        if not found:
+            return None
+        return sum(int(counter.get(self.data_property, 0)) for counter in found)
+
+    @transform_table_name
+    def get_counts(self, table_name, keys, sharded=False, shard_count=None, transform_time=None):
+        """
+        get_count of many counters, returns a dict of key to count
+        the shard indexes of all the counters are read at once, then all of
+        their shards, in BatchGetItem requests of 100 keys sent in parallel
+        """
+        keys = list(keys)
+        sharded = sharded or self.adaptive is not None
+        if sharded and self.fixed_shard_counters:
+            counts = self._get_fixed_shard_counts(table_name, keys, shard_count)
+        elif sharded:
+            indexes = self._batch_get_items(table_name + _COUNTER_SHARD_INDEX_TABLE_SUFFIX, keys)
+            shard_keys = dict((key, [self.sharded_key(key, shard)
+                                     for shard in indexes.get(key, {}).get(self.data_property) or ()])
+                              for key in keys)
+            counters = self._batch_get_items(table_name, [sharded_key for sharded_keys in shard_keys.itervalues()
+                                                          for sharded_key in sharded_keys])
+            counts = dict((key, self._sum_counters(counters, shard_keys[key])) for key in keys)
+        else:
+            counters = self._batch_get_items(table_name, [self.sharded_key(key, 1) for key in keys])
+            return dict((key, counters.get(self.sharded_key(key, 1), {}).get(self.data_property)) for key in keys)
+        return dict((key, count or 0) for key, count in counts.iteritems())
+
+    @transform_table_name
+    def incr_window(self, table_name, key, bucket_seconds, amount=1, retention=None, now=None, transform_time=None):
+        """
+        add amount to the current time bucket of a window counter, see window.Window
+        the buckets are attributes of one item under the key, the update_item
+        also removes the bucket that just went out of retention
+        buckets left behind by a pause of the counter are in the returned item,
+        those are removed by a second update_item
+        """
+        window = Window(bucket_seconds, retention, now)
+        item_key = {self.hash_key_name: {"S": key}}
+        response = self.conn.update_item(table_name, item_key,
+                                         {window.bucket: {"Action": "ADD", "Value": {"N": str(amount)}},
+                                          window.expired_bucket(): {"Action": "DELETE"}},
+                                         return_values='ALL_NEW')
+        expired = window.expired(response.get('Attributes', {}))
+        if expired:
+            self.conn.update_item(table_name, item_key, dict((name, {"Action": "DELETE"}) for name in expired))
+
+    @transform_table_name
+    def get_window(self, table_name, key, window_seconds, now=None, consistent=False, transform_time=None):
+        """
+        the count of the buckets that started in the last window_seconds,
+        one get_item of the counter item
+        """
+        response = self.conn.get_item(table_name, {self.hash_key_name: {"S": key}}, consistent_read=consistent)
+        buckets = dict((name, self._dynamizer.decode(value)) for name, value in (response.get('Item') or {}).iteritems())
+        return Window(now=now).total(buckets, window_seconds)
+
+    def add_distinct(self, table_name, key, members, shard_count=1, error_rate=None, transform_time=None):
+        """
+        add members to the distinct counter of the key, see hyperloglog.HyperLogLog
+        the sketch of the members is merged into a random shard with update_if,
+        a conditional put on the version of the shard, or no write at all if
+        it adds nothing to the stored sketch
+        """
+        sharded_key = self.sharded_key(key, random.randint(1, max(shard_count, 1)))
+        hyperloglog.add_distinct(self, table_name, sharded_key, members,
+                                 error_rate or self.distinct_counters.get('error_rate'), transform_time=transform_time)
+
+    def count_distinct(self, table_name, key, shard_count=1, timedelta_slice=1, lookback=0):
+        """
+        the estimated number of distinct members added to the key, the sketches of
+        its shards in the current and `lookback` earlier time slices are merged,
+        one BatchGetItem for up to 100 of them, slice tables that don't exist are skipped
+        """
+        keys = [self.sharded_key(key, shard) for shard in xrange(1, max(shard_count, 1) + 1)]
+        names = self.slices.table_names(table_name, timedelta_slice, lookback)
+        try:
+            items = self._batch_get_tables(dict((name, keys) for name in names))
+        except DynamoDBError:
+            # a missing table fails the whole BatchGetItem, read the slices that exist
+            existing = [name for name in names if self.get_throughput(name) is not None]
+            if len(existing) == len(names):
+                raise
+            items = self._batch_get_tables(dict((name, keys) for name in existing))
+        return hyperloglog.count_distinct(
+            self._decode_data(self._read_chunks(name, sharded_key, item.get(self.data_property)), True)
+            for name, slice_items in items.iteritems() for sharded_key, item in slice_items.iteritems())
+
     @transform_table_name
     def delete_counter(self, table_name, key):
         """
@@ -344,6 +1057,8 @@ class DynamoDB(object):
         - however BatchWriteItem as a whole is a "best-effort" operation and not an atomic operation.
         - That is, in a BatchWriteItem request, some operations might succeed and others might fail.
         """
+        if self.fixed_shard_counters:
+            return self._delete_fixed_shard_counter(table_name, key)
         sharded_keys = self._get_counter_keys(table_name, key)
         if sharded_keys:
             counter_table = self.get_table(table_name)
@@ -353,6 +1068,15 @@ class DynamoDB(object):
 
         self._delete_counter_indice(table_name, key)
 
+    def _delete_fixed_shard_counter(self, table_name, key):
+        shard_count = max(self.get_counter_shard_count(table_name, key),
+                          self._shard_counts.get((table_name, key), 0))
+        requests = [{'DeleteRequest': {'Key': {self.hash_key_name: {"S": self.sharded_key(key, shard)}}}}
+                    for shard in xrange(1, shard_count + 1)]
+        self._batch_write_items(table_name, requests)
+        self.conn.delete_item(table_name + _COUNTER_SHARD_COUNT_TABLE_SUFFIX, {self.hash_key_name: {"S": key}})
+        self._shard_counts.pop((table_name, key), None)
+
     def _get_counter_keys(self, table_name, key):
         table_name = table_name + _COUNTER_SHARD_INDEX_TABLE_SUFFIX
         shards = self.get_data(table_name, key, pickled=False) or []
@@ -377,15 +1101,6 @@ class DynamoDB(object):
         return counters
 
 
-#     def get_counter_shard_count(self, table_name, key):
-#         table_name = table_name + _COUNTER_SHARD_COUNT_TABLE_SUFFIX
-#         return self.get_data(key, pickled=False)
-#
-#     def update_counter_shard_count(self, table_name, key, shard_count):
-#         count = self.get_counter_shard_count(table_name, key)
-#         shard_count_table_name = table_name + _COUNTER_SHARD_COUNT_TABLE_SUFFIX
-#         if not count or count > shard_count:
-#             self.set_data(shard_count_table_name, key, shard_count, pickled=False)
 #     def _create_all_counter_shards(self, table_name, key, shard_count=1):
 #         """
 #         create all counter shards,
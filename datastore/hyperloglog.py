@@ -0,0 +1,152 @@
+'''
+Distinct counters, HyperLogLog sketches stored as values and merged on write
+'''
+import math
+import zlib
+import base64
+import hashlib
+
+_MAGIC = 'hll1:'
+_DEFAULT_ERROR_RATE = 0.01  # 16384 registers
+_MIN_PRECISION = 4
+_MAX_PRECISION = 16
+_HASH_BITS = 64
+
+
+class HyperLogLogError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class HyperLogLog(object):
+
+    """
+    a sketch of 2 ** precision registers estimating the number of distinct members
+
+    Settings, for the DynamoDB, Azure Table and memory engines
+    'distinct_counters': {'error_rate': 0.01}  # standard error of count_distinct
+
+    The error rate picks the precision, 1.04 / sqrt(2 ** precision) <= error_rate.
+    A stored sketch takes 2 ** precision bytes before compression, whatever the
+    number of members. Sketches of different precisions merge into the lower one.
+    """
+
+    def __init__(self, error_rate=_DEFAULT_ERROR_RATE, precision=None):
+        if precision is None:
+            if not 0 < error_rate < 1:
+                raise HyperLogLogError('error_rate must be between 0 and 1, not %s' % error_rate)
+            precision = int(math.ceil(math.log((1.04 / error_rate) ** 2, 2)))
+        self.precision = min(max(precision, _MIN_PRECISION), _MAX_PRECISION)
+        self.registers = bytearray(1 << self.precision)
+
+    def add(self, member):
+        if isinstance(member, unicode):
+            member = member.encode('utf-8')
+        elif not isinstance(member, str):
+            member = str(member)
+        x = int(hashlib.sha1(member).hexdigest()[:_HASH_BITS / 4], 16)
+        bits = _HASH_BITS - self.precision
+        index, rest = x >> bits, x & ((1 << bits) - 1)
+        rank = bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        """
+        merge other into this sketch, folded to the lower precision of both
+        returns True if a register changed
+        """
+        if other.precision < self.precision:
+            self.registers = self._fold(other.precision)
+            self.precision = other.precision
+            changed = True
+        else:
+            changed = False
+        registers = other._fold(self.precision) if other.precision > self.precision else other.registers
+        for index, rank in enumerate(registers):
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+                changed = True
+        return changed
+
+    def _fold(self, precision):
+        """
+        the registers at a lower precision, the index bits dropped lead the rest of the hash
+        """
+        shift = self.precision - precision
+        registers = bytearray(1 << precision)
+        for index, rank in enumerate(self.registers):
+            if not rank:
+                continue
+            low = index & ((1 << shift) - 1)
+            rank = shift - low.bit_length() + 1 if low else shift + rank
+            if rank > registers[index >> shift]:
+                registers[index >> shift] = rank
+        return registers
+
+    def count(self):
+        m = len(self.registers)
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count('\x00')
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)  # linear counting of small cardinalities
+        return int(round(estimate))
+
+    def dumps(self):
+        """
+        printable, so Azure Table stores it as a string property without a codec
+        """
+        return _MAGIC + base64.b64encode(zlib.compress(chr(self.precision) + str(self.registers)))
+
+    @classmethod
+    def loads(cls, value):
+        if not isinstance(value, basestring) or not value.startswith(_MAGIC):
+            raise HyperLogLogError('not a HyperLogLog sketch: %r' % (value[:20] if isinstance(value, basestring) else value))
+        raw = zlib.decompress(base64.b64decode(value[len(_MAGIC):]))
+        sketch = cls(precision=ord(raw[0]))
+        sketch.registers = bytearray(raw[1:])
+        return sketch
+
+
+def add_distinct(engine, table_name, key, members, error_rate=None, **kwargs):
+    """
+    merge the sketch of members into the stored sketch of the key with the
+    engine's update_if, nothing is written if no register grows
+    """
+    sketch = HyperLogLog(error_rate or _DEFAULT_ERROR_RATE)
+    for member in members:
+        sketch.add(member)
+
+    def merge(current):
+        if current is None:
+            return sketch.dumps()
+        stored = HyperLogLog.loads(current)
+        if not stored.update(sketch):
+            return None
+        return stored.dumps()
+
+    engine.update_if(table_name, key, merge, **kwargs)
+
+
+def count_distinct(values):
+    """
+    the estimated number of distinct members of the stored sketches merged, None values are skipped
+    """
+    merged = None
+    for value in values:
+        if value is None:
+            continue
+        sketch = HyperLogLog.loads(value)
+        if merged is None:
+            merged = sketch
+        else:
+            merged.update(sketch)
+    return merged.count() if merged is not None else 0
@@ -0,0 +1,140 @@
+'''
+Background lifecycle of time sliced tables: create ahead, tune throughput, expire
+'''
+import logging
+import datetime
+import threading
+from buffer import start_timer
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_INTERVAL = 600.0
+_DEFAULT_AHEAD = 1
+
+
+class TableLifecycle(object):
+
+    """
+    keep time sliced tables, e.g. 'events_%Y%m%d', ready before they are used
+
+    Settings, for the DynamoDB and memory engines
+    'table_lifecycle': {
+        'interval': 600,   # seconds between runs, 0 to only call run() yourself
+        'tables': {
+            'events_%Y%m%d': {'timedelta_slice': 1,                  # days per slice
+                              'ahead': 1,                            # upcoming slices created in advance
+                              'current': {'read': 100, 'write': 100},  # throughput of current and upcoming slices
+                              'past': {'read': 10, 'write': 1},        # throughput of past slices
+                              'retention': 30},                      # slices kept, older ones are deleted
+        }
+    }
+
+    Creating a DynamoDB table takes a while, so the slice of tomorrow is
+    created today instead of by the first request after midnight.
+    Every run is idempotent, a failed step is logged and tried again next run.
+    """
+
+    def __init__(self, engine, tables, interval=_DEFAULT_INTERVAL):
+        self.engine = engine
+        self.tables = tables
+        self.interval = interval
+        self._run_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._timer = None
+        if self.interval:
+            self._timer = start_timer(self, 'run', self.interval, self._closed, now=True)
+
+    def run(self, now=None):
+        """
+        create, update and delete the slices due now
+        returns {'created': [...], 'updated': [...], 'deleted': [...], 'failed': [...]} of table names
+        """
+        now = now or datetime.datetime.utcnow()
+        actions = {'created': [], 'updated': [], 'deleted': [], 'failed': []}
+        with self._run_lock:
+            existing = None
+            for pattern, options in self.tables.iteritems():
+                delta = datetime.timedelta(options.get('timedelta_slice', 1))
+                for i in xrange(options.get('ahead', _DEFAULT_AHEAD) + 1):
+                    self._prepare(now + delta * i, pattern, options.get('current'), actions)
+                if options.get('past') or options.get('retention'):
+                    if existing is None:
+                        existing = self._list_tables(actions)
+                    self._expire(now, pattern, delta, options, existing, actions)
+        for action in ('created', 'updated', 'deleted'):
+            if actions[action]:
+                logger.info('TableLifecycle %s %s', action, ', '.join(actions[action]))
+        return actions
+
+    def close(self):
+        self._closed.set()
+        if self._timer is not None and self._timer is not threading.current_thread():
+            self._timer.join(1)
+
+    def _prepare(self, dtime, pattern, throughput, actions):
+        """
+        create the slice of dtime, or bring it to `throughput`
+        """
+        table_name = dtime.strftime(pattern)
+        throughput = throughput or {}
+        try:
+            current = self.engine.get_throughput(table_name)
+            if current is None:
+                self.engine.create_table(table_name, read=throughput.get('read'), write=throughput.get('write'))
+                actions['created'].append(table_name)
+            else:
+                self._update(table_name, current, throughput, actions)
+        except Exception as e:
+            logger.warning("TableLifecycle failed to prepare '%s', will retry: %s", table_name, e)
+            actions['failed'].append(table_name)
+
+    def _expire(self, now, pattern, delta, options, existing, actions):
+        """
+        lower the throughput of past slices and delete those out of retention
+        """
+        current_slice = _parse(now.strftime(pattern), pattern)
+        oldest_kept = None
+        if options.get('retention'):
+            oldest_kept = _parse((now - delta * (options['retention'] - 1)).strftime(pattern), pattern)
+        for table_name in existing:
+            dtime = _parse(table_name, pattern)
+            if dtime is None or dtime >= current_slice:
+                continue
+            try:
+                if oldest_kept is not None and dtime < oldest_kept:
+                    self.engine.delete_table(table_name)
+                    actions['deleted'].append(table_name)
+                elif options.get('past'):
+                    current = self.engine.get_throughput(table_name)
+                    if current is not None:
+                        self._update(table_name, current, options['past'], actions)
+            except Exception as e:
+                logger.warning("TableLifecycle failed to expire '%s', will retry: %s", table_name, e)
+                actions['failed'].append(table_name)
+
+    def _update(self, table_name, current, throughput, actions):
+        if current.get('status', 'ACTIVE') != 'ACTIVE':
+            return  # being created or updated, next run
+        read = throughput.get('read') or current['read']
+        write = throughput.get('write') or current['write']
+        if (read, write) != (current['read'], current['write']):
+            self.engine.update_throughput(table_name, read, write)
+            actions['updated'].append(table_name)
+
+    def _list_tables(self, actions):
+        try:
+            return self.engine.list_tables()
+        except Exception as e:
+            logger.warning('TableLifecycle failed to list tables, will retry: %s', e)
+            actions['failed'].append('*')
+            return []
+
+
+def _parse(table_name, pattern):
+    """
+    the datetime a slice name was formatted from, None if it isn't a slice of pattern
+    """
+    try:
+        return datetime.datetime.strptime(table_name, pattern)
+    except ValueError:
+        return None
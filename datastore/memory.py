@@ -0,0 +1,647 @@
+'''
+In-process datastore engine, for tests and benchmarks without cloud credentials
+'''
+import time
+import random
+import zlib
+import threading
+from functools import partial
+import cPickle as pickle
+from collections import Counter
+from dynamodb import transform_table_name
+from adaptive import AdaptiveShardCount
+from codec import CodecRegistry
+from timeslice import SliceLookup
+from scan import scan_pages, RateLimiter
+from chunking import ValueChunker
+from conditional import CasResult
+from retry import RetryPolicy
+from window import Window
+import hyperloglog
+import chunking
+import conditional
+import codec
+import timeslice
+
+_COUNTER_DEFAULT_SHARD_FORMAT = 'shard_%s'
+_COUNTER_SHARD_SUFFIX = '_' + _COUNTER_DEFAULT_SHARD_FORMAT
+_SCAN_PAGE_SIZE = 100
+_BATCH_GET_MAX_KEYS = 100
+_CHUNK_SIZE = 350 * 1024
+_CHUNKS_PER_REQUEST = 16
+
+# ERROR
+_TABLE_DOES_NOT_EXIST = 'Table does not exist'
+_ITEM_ALREADY_EXISTS = 'Item already exists'
+_THROUGHPUT_EXCEEDED = 'Provisioned throughput exceeded'
+
+
+class MemoryStoreError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class MemoryStoreThrottled(MemoryStoreError):
+    pass
+
+
+class MemoryTable(object):
+
+    def __init__(self, table_name, read=None, write=None):
+        self.table_name = table_name
+        self.name = table_name
+        self.throughput = {'read': read, 'write': write}
+        self.items = {}
+        self.shards = {}  # counter key -> set of shards
+        self.shard_counts = {}  # counter key -> stored shard_count of fixed shard counters
+        self.versions = {}  # key -> version of values written by cas
+        self.windows = {}  # window counter key -> {bucket name: count}
+        self.item_tokens = {}  # counter item key -> (tokens, refilled) of hot_key_throughput
+        self.tokens = float((read or 0) + (write or 0))
+        self.refilled = time.time()
+
+
+class MemoryStore(object):
+
+    """
+    thread-safe in-process engine with the same API as DynamoDB
+
+    Memory Example settings
+    'memory': {
+        'engine': 'memory',
+        'latency': 0.005,          # seconds slept per backend call, or a (min, max) range
+        'throttle': True,          # raise MemoryStoreThrottled when a table goes over
+                                   # its read + write throughput per second
+        'default_throughput': {'read': 5, 'write': 5},
+        'auto_create_table': False,
+        'hot_key_throughput': 0,       # max updates per second of a counter item, 0 for no limit
+        'fixed_shard_counters': False,  # see DynamoDB
+        'adaptive_shard_counters': {},  # see adaptive.AdaptiveShardCount, throttles grow the shard count
+        'chunked_values': {}            # see chunking.ValueChunker
+    }
+
+    Every call that would be a request to a real backend is counted in `calls`,
+    sharded counters cost what they cost on DynamoDB: a new shard is one more
+    call for the shard index, a sharded read is an index read plus a batch get.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.latency = settings.get('latency', 0)
+        self.throttle = settings.get('throttle', False)
+        default_throughput = settings.get('default_throughput') or {}
+        self.default_throughput = {'read': default_throughput.get('read', 100),
+                                   'write': default_throughput.get('write', 100)
+                                   }
+        self.auto_create_table = settings.get('auto_create_table', False)
+        self.hot_key_throughput = settings.get('hot_key_throughput', 0)
+        self.fixed_shard_counters = settings.get('fixed_shard_counters', False)
+        self._shard_counts = {}  # (table_name, key) -> stored shard_count known to this process
+        self.adaptive = None
+        if settings.get('adaptive_shard_counters'):
+            self.adaptive = AdaptiveShardCount(**settings['adaptive_shard_counters'])
+        self.codecs = CodecRegistry(settings)
+        self.slices = SliceLookup(**(settings.get('time_slices') or {}))
+        chunked_values = settings.get('chunked_values')
+        self.chunker = ValueChunker(**dict({'chunk_size': _CHUNK_SIZE if chunked_values else None},
+                                           **(chunked_values if isinstance(chunked_values, dict) else {})))
+        self.retry_policy = RetryPolicy(**(settings.get('retry') or {}))
+        self.distinct_counters = settings.get('distinct_counters') or {}
+        self.calls = Counter()
+        self._tables = {}
+        self._lock = threading.RLock()
+
+    @transform_table_name
+    def create_table(self, table_name, read=None, write=None, transform_time=None):
+        with self._lock:
+            if table_name not in self._tables:
+                self._tables[table_name] = MemoryTable(table_name,
+                                                       read or self.default_throughput['read'],
+                                                       write or self.default_throughput['write'])
+            return self._tables[table_name]
+
+    @transform_table_name
+    def get_table(self, table_name):
+        """
+        returns None if the table doesn't exist
+        """
+        return self._tables.get(table_name)
+
+    def list_tables(self):
+        with self._lock:
+            self.calls['list_tables'] += 1
+            return self._tables.keys()
+
+    @transform_table_name
+    def get_throughput(self, table_name):
+        """
+        returns None if the table doesn't exist
+        """
+        with self._lock:
+            self.calls['describe_table'] += 1
+            table = self._tables.get(table_name)
+        if table is None:
+            return None
+        return dict(table.throughput, status='ACTIVE')
+
+    def get_or_create_table(self, table_name):
+        table = self.get_table(table_name)
+        if not table:
+            table = self.create_table(table_name)
+        return table
+
+    @transform_table_name
+    def update_throughput(self, table_name, read, write):
+        table = self._request('update_table', table_name)
+        table.throughput = {'read': int(read), 'write': int(write)}
+        return table
+
+    @transform_table_name
+    def delete_table(self, table_name):
+        self._request('delete_table', table_name)
+        with self._lock:
+            return self._tables.pop(table_name, None) is not None
+
+    def get_item(self, table_name, key, timedelta_slice=1, lookback=None):
+        """
+        returns (table, encoded data) of the freshest time slice holding the key,
+        (None, None) when the key is missing
+        """
+        _, found = self.slices.lookup(table_name, key, self._get_slice_item, timedelta_slice, lookback)
+        if found is None:
+            return None, None
+        return found
+
+    def _get_slice_item(self, table_name, key):
+        table = self._request('get_item', table_name)
+        with self._lock:
+            if key in table.items:
+                return table, table.items[key]
+        return None
+
+    def get_data(self, table_name, key, timedelta_slice=1, pickled=True, lookback=None):
+        table, data = self.get_item(table_name, key, timedelta_slice=timedelta_slice, lookback=lookback)
+        return self._decode_data(self._read_chunks(table, key, data), pickled)
+
+    @transform_table_name
+    def set_data(self, table_name, key, data, pickled=True, overwrite=True, transform_time=None):
+        """
+        Returns ``True`` on success.
+        """
+        data = self._encode_data(table_name, data, pickled)
+        manifest, chunks = self.chunker.split(key, data) if pickled else (None, None)
+        if chunks:
+            self._write_chunks(table_name, chunks)
+            data = manifest
+        table = self._request('put_item', table_name)
+        with self._lock:
+            exists = key in table.items
+            if overwrite or not exists:
+                old = table.items.get(key)
+                table.items[key] = data
+                table.versions.pop(key, None)
+        if exists and not overwrite:
+            self._delete_chunks(table, key, manifest)
+            raise MemoryStoreError("%s: '%s'" % (_ITEM_ALREADY_EXISTS, key))
+        self._delete_chunks(table, key, old)
+        self.slices.forget(table_name, key)
+        return True
+
+    def delete_data(self, table_name, key, timedelta_slice=1, lookback=None):
+        table, _ = self.get_item(table_name, key, timedelta_slice=timedelta_slice, lookback=lookback)
+        if table is None:
+            return False
+        self._request('delete_item', table.table_name)
+        with self._lock:
+            old = table.items.pop(key, None)
+            table.versions.pop(key, None)
+        self._delete_chunks(table, key, old)
+        return old is not None
+
+    def get_many(self, table_name, keys, timedelta_slice=1, pickled=True):
+        keys = list(keys)
+        results = dict.fromkeys(keys)
+        missing = set(keys)
+        for slice_table_name in self.slices.table_names(table_name, timedelta_slice):
+            if not missing:
+                break
+            table = self._request('batch_get', slice_table_name, len(missing))
+            with self._lock:
+                found = dict((key, table.items[key]) for key in missing if key in table.items)
+            for key, data in found.iteritems():
+                results[key] = self._decode_data(self._read_chunks(table, key, data), pickled)
+            missing.difference_update(found)
+        return results
+
+    @transform_table_name
+    def set_many(self, table_name, items, pickled=True, transform_time=None):
+        encoded = {}
+        for key, data in items.iteritems():
+            data = self._encode_data(table_name, data, pickled)
+            manifest, chunks = self.chunker.split(key, data) if pickled else (None, None)
+            if chunks:
+                self._write_chunks(table_name, chunks)
+                data = manifest
+            encoded[key] = data
+        table = self._request('batch_write', table_name, len(items))
+        with self._lock:
+            old = dict((key, table.items.get(key)) for key in encoded)
+            table.items.update(encoded)
+            for key in encoded:
+                table.versions.pop(key, None)
+        for key in items:
+            self._delete_chunks(table, key, old[key])
+            self.slices.forget(table_name, key)
+        return True
+
+    def delete_many(self, table_name, keys, timedelta_slice=1):
+        keys = set(keys)
+        for slice_table_name in self.slices.table_names(table_name, timedelta_slice):
+            table = self._request('batch_write', slice_table_name, len(keys))
+            with self._lock:
+                old = dict((key, table.items.pop(key, None)) for key in keys)
+                for key in keys:
+                    table.versions.pop(key, None)
+            for key in keys:
+                self._delete_chunks(table, key, old[key])
+        return True
+
+    @transform_table_name
+    def scan(self, table_name, segments=1, page_size=None, max_units_per_second=None,
+             checkpoint=None, keys_only=False, pickled=True, transform_time=None):
+        """
+        see DynamoDB.scan, a key is in the segment of its crc32, pages are in key order
+        a page is one request of one unit per item, chunks of chunked values are skipped
+        """
+        page_size = page_size or _SCAN_PAGE_SIZE
+
+        def fetch(segment, start):
+            table = self._request('scan', table_name)
+            with self._lock:
+                keys = sorted(key for key in table.items
+                              if zlib.crc32(key) % segments == segment and (start is None or key > start))
+                page = [(key, table.items[key]) for key in keys[:page_size]]
+            items = [(key, None if keys_only else self._decode_data(self._read_chunks(table, key, data), pickled))
+                     for key, data in page if not chunking.is_chunk_key(key)]
+            return items, page[-1][0] if len(keys) > page_size else None, len(page)
+
+        limiter = RateLimiter(max_units_per_second) if max_units_per_second else None
+        for item in scan_pages(fetch, segments, checkpoint, limiter):
+            yield item
+
+    @transform_table_name
+    def get_versioned(self, table_name, key, pickled=True, transform_time=None):
+        """
+        see DynamoDB.get_versioned
+        """
+        table = self._request('get_item', table_name)
+        with self._lock:
+            if key not in table.items:
+                return None, None
+            version, data = table.versions.get(key, 0), table.items[key]
+        return version, self._decode_data(self._read_chunks(table, key, data), pickled)
+
+    @transform_table_name
+    def cas(self, table_name, key, expected_version, data, pickled=True, transform_time=None):
+        """
+        see DynamoDB.cas
+        """
+        encoded = self._encode_data(table_name, data, pickled)
+        manifest, chunks = self.chunker.split(key, encoded) if pickled else (None, None)
+        if chunks:
+            self._write_chunks(table_name, chunks)
+            encoded = manifest
+        table = self._request('put_item', table_name)
+        with self._lock:
+            current = table.versions.get(key, 0) if key in table.items else None
+            ok = current == expected_version
+            if ok:
+                old = table.items.get(key)
+                table.items[key] = encoded
+                table.versions[key] = (expected_version or 0) + 1
+        if not ok:
+            self._delete_chunks(table, key, manifest)
+            current_version, current = self.get_versioned(table_name, key, pickled)
+            return CasResult(False, current_version, current)
+        self._delete_chunks(table, key, old)
+        self.slices.forget(table_name, key)
+        return CasResult(True, (expected_version or 0) + 1, data)
+
+    @transform_table_name
+    def update_if(self, table_name, key, func, max_retries=None, pickled=True, transform_time=None):
+        """
+        see conditional.update_if
+        """
+        return conditional.update_if(self, table_name, key, func, max_retries=max_retries, pickled=pickled)
+
+    def sharded_key(self, key, shard):
+        return key + _COUNTER_SHARD_SUFFIX % shard
+
+    @transform_table_name
+    def incr(self, table_name, key, amount=1, shard_count=1):
+        if shard_count < 1:
+            shard_count = 1
+        self.slices.forget(table_name, key, timeslice.COUNT, timeslice.SHARDED_COUNT)
+        if self.adaptive is None:
+            return self._incr(table_name, key, amount, shard_count)
+        shard_count = max(shard_count, self.adaptive.shard_count(table_name, key))
+        try:
+            return self._incr(table_name, key, amount, shard_count)
+        except MemoryStoreThrottled:
+            self.adaptive.record(table_name, key)
+            raise
+
+    def _incr(self, table_name, key, amount, shard_count):
+        if self.fixed_shard_counters:
+            return self._incr_fixed_shard(table_name, key, amount, shard_count)
+        shard = str(random.randint(1, shard_count))
+        sharded_key = self.sharded_key(key, shard)
+        table = self._request('update_item', table_name)
+        with self._lock:
+            self._add_to_counter_item(table, sharded_key, amount)
+            shards = table.shards.setdefault(key, set())
+            new_shard = shard not in shards
+            shards.add(shard)
+        if new_shard:
+            self._request('update_index', table_name)
+
+    def _incr_fixed_shard(self, table_name, key, amount, shard_count):
+        if self._shard_counts.get((table_name, key), 0) < shard_count:
+            table = self._request('get_shard_count', table_name)
+            with self._lock:
+                stored = table.shard_counts.get(key, 0)
+            if stored < shard_count:
+                self._request('put_shard_count', table_name)
+                with self._lock:
+                    stored = table.shard_counts[key] = max(table.shard_counts.get(key, 0), shard_count)
+            self._shard_counts[(table_name, key)] = stored
+        sharded_key = self.sharded_key(key, random.randint(1, shard_count))
+        table = self._request('update_item', table_name)
+        with self._lock:
+            self._add_to_counter_item(table, sharded_key, amount)
+
+    def _add_to_counter_item(self, table, sharded_key, amount):
+        """
+        with hot_key_throughput, a counter item takes at most that many
+        updates per second, like a hot key on a single DynamoDB partition
+        """
+        if self.hot_key_throughput:
+            now = time.time()
+            tokens, refilled = table.item_tokens.get(sharded_key, (self.hot_key_throughput, now))
+            tokens = min(self.hot_key_throughput, tokens + (now - refilled) * self.hot_key_throughput)
+            if tokens < 1:
+                table.item_tokens[sharded_key] = (tokens, now)
+                self.calls['throttled'] += 1
+                raise MemoryStoreThrottled("%s: '%s'" % (_THROUGHPUT_EXCEEDED, sharded_key))
+            table.item_tokens[sharded_key] = (tokens - 1, now)
+        table.items[sharded_key] = table.items.get(sharded_key, 0) + amount
+
+    def get_count(self, table_name, key, sharded=False, shard_count=None, timedelta_slice=1, lookback=0):
+        """
+        see DynamoDB.get_count, adaptive shard counters are always read sharded
+        """
+        sharded = sharded or self.adaptive is not None
+        _, count = self.slices.lookup(table_name, key,
+                                      partial(self._get_count, sharded=sharded, shard_count=shard_count),
+                                      timedelta_slice, lookback, timeslice.SHARDED_COUNT if sharded else timeslice.COUNT)
+        if count is None and sharded:
+            return 0
+        return count
+
+    def _get_count(self, table_name, key, sharded=False, shard_count=None):
+        if sharded and self.fixed_shard_counters:
+            known = shard_count or self._shard_counts.get((table_name, key), 0)
+            table = self._request('batch_get', table_name, known + 1)
+            with self._lock:
+                stored = 0 if shard_count else table.shard_counts.get(key, 0)
+            if stored > known:
+                self._shard_counts[(table_name, key)] = stored
+                self._request('batch_get', table_name, stored - known)
+            with self._lock:
+                counts = [table.items[self.sharded_key(key, shard)] for shard in xrange(1, max(known, stored) + 1)
+                          if self.sharded_key(key, shard) in table.items]
+            return sum(counts) if counts else None
+        elif sharded:
+            table = self._request('get_index', table_name)
+            with self._lock:
+                shards = list(table.shards.get(key, ()))
+            if not shards:
+                return None
+            self._request('batch_get', table_name, len(shards))
+            with self._lock:
+                return sum(table.items.get(self.sharded_key(key, shard), 0) for shard in shards)
+        else:
+            table = self._request('get_item', table_name)
+            with self._lock:
+                return table.items.get(self.sharded_key(key, 1))
+
+    @transform_table_name
+    def get_counts(self, table_name, keys, sharded=False, shard_count=None, transform_time=None):
+        """
+        see DynamoDB.get_counts, the shard indexes and the shards cost
+        one batch_get per 100 keys each
+        """
+        keys = list(keys)
+        sharded = sharded or self.adaptive is not None
+        if not sharded:
+            table = self._batch_get(table_name, len(keys))
+            with self._lock:
+                return dict((key, table.items.get(self.sharded_key(key, 1))) for key in keys)
+        if self.fixed_shard_counters:
+            known = dict((key, shard_count or self._shard_counts.get((table_name, key), 0)) for key in keys)
+            table = self._batch_get(table_name, sum(known.itervalues()) + (0 if shard_count else len(keys)))
+            with self._lock:
+                stored = dict((key, 0 if shard_count else table.shard_counts.get(key, 0)) for key in keys)
+            grown = [key for key in keys if stored[key] > known[key]]
+            for key in grown:
+                self._shard_counts[(table_name, key)] = stored[key]
+            self._batch_get(table_name, sum(stored[key] - known[key] for key in grown))
+            shards = dict((key, range(1, max(known[key], stored[key]) + 1)) for key in keys)
+        else:
+            table = self._batch_get(table_name, len(keys))  # the shard indexes
+            with self._lock:
+                shards = dict((key, list(table.shards.get(key, ()))) for key in keys)
+            self._batch_get(table_name, sum(len(key_shards) for key_shards in shards.itervalues()))
+        with self._lock:
+            return dict((key, sum(table.items.get(self.sharded_key(key, shard), 0) for shard in shards[key]))
+                        for key in keys)
+
+    def _batch_get(self, table_name, units):
+        """
+        account the BatchGetItem requests of `units` keys, returns the table
+        """
+        table = self.get_table(table_name)
+        for i in xrange(0, units, _BATCH_GET_MAX_KEYS):
+            table = self._request('batch_get', table_name, min(units - i, _BATCH_GET_MAX_KEYS))
+        return table
+
+    @transform_table_name
+    def incr_window(self, table_name, key, bucket_seconds, amount=1, retention=None, now=None, transform_time=None):
+        """
+        see DynamoDB.incr_window, one update_item
+        """
+        window = Window(bucket_seconds, retention, now)
+        table = self._request('update_item', table_name)
+        with self._lock:
+            buckets = table.windows.setdefault(key, {})
+            buckets[window.bucket] = buckets.get(window.bucket, 0) + amount
+            for name in window.expired(buckets):
+                del buckets[name]
+
+    @transform_table_name
+    def get_window(self, table_name, key, window_seconds, now=None, consistent=False, transform_time=None):
+        """
+        see DynamoDB.get_window, one get_item
+        """
+        table = self._request('get_item', table_name)
+        with self._lock:
+            buckets = dict(table.windows.get(key, {}))
+        return Window(now=now).total(buckets, window_seconds)
+
+    def add_distinct(self, table_name, key, members, shard_count=1, error_rate=None, transform_time=None):
+        """
+        see DynamoDB.add_distinct
+        """
+        sharded_key = self.sharded_key(key, random.randint(1, max(shard_count, 1)))
+        hyperloglog.add_distinct(self, table_name, sharded_key, members,
+                                 error_rate or self.distinct_counters.get('error_rate'), transform_time=transform_time)
+
+    def count_distinct(self, table_name, key, shard_count=1, timedelta_slice=1, lookback=0):
+        """
+        see DynamoDB.count_distinct, one batch_get of the slice tables that exist
+        """
+        keys = [self.sharded_key(key, shard) for shard in xrange(1, max(shard_count, 1) + 1)]
+        with self._lock:
+            names = [name for name in self.slices.table_names(table_name, timedelta_slice, lookback)
+                     if name in self._tables]
+        if not names:
+            return 0
+        self._request('batch_get', names[0], len(names) * len(keys))
+        found = []
+        with self._lock:
+            for name in names:
+                table = self._tables.get(name)
+                if table is not None:
+                    found.extend((table, sharded_key, table.items[sharded_key]) for sharded_key in keys
+                                 if sharded_key in table.items)
+        return hyperloglog.count_distinct(self._decode_data(self._read_chunks(table, sharded_key, data), True)
+                                          for table, sharded_key, data in found)
+
+    @transform_table_name
+    def delete_counter(self, table_name, key):
+        if self.fixed_shard_counters:
+            table = self._request('get_shard_count', table_name)
+            self._request('batch_write', table_name)
+            self._request('delete_shard_count', table_name)
+            with self._lock:
+                shard_count = max(table.shard_counts.pop(key, 0), self._shard_counts.pop((table_name, key), 0))
+                for shard in xrange(1, shard_count + 1):
+                    table.items.pop(self.sharded_key(key, shard), None)
+            return
+        table = self._request('get_index', table_name)
+        with self._lock:
+            shards = table.shards.pop(key, set())
+        if shards:
+            self._request('batch_write', table_name, len(shards))
+            with self._lock:
+                for shard in shards:
+                    table.items.pop(self.sharded_key(key, shard), None)
+        self._request('delete_index', table_name)
+
+    def _encode_data(self, table_name, data, pickled):
+        if not pickled:
+            return data
+        value_codec = self.codecs.get(table_name)
+        if value_codec is None:
+            return pickle.dumps(data)
+        return value_codec.encode(data)
+
+    def _write_chunks(self, table_name, chunks):
+        table = self._request('batch_write', table_name, len(chunks))
+        with self._lock:
+            table.items.update(chunks)
+
+    def _read_chunks(self, table, key, data):
+        """
+        the value of a manifest, its chunks are read in parallel
+        """
+        if not chunking.is_manifest(data):
+            return data
+        chunk_keys = self.chunker.chunk_keys(key, data)
+
+        def read(group):
+            self._request('batch_get', table.table_name, len(group))
+            with self._lock:
+                return [(chunk_key, table.items[chunk_key]) for chunk_key in group if chunk_key in table.items]
+
+        groups = [chunk_keys[i:i + _CHUNKS_PER_REQUEST] for i in xrange(0, len(chunk_keys), _CHUNKS_PER_REQUEST)]
+        return self.chunker.join(key, data, dict(chunk for found in self.chunker.map(read, groups) for chunk in found))
+
+    def _delete_chunks(self, table, key, old):
+        """
+        delete the chunks of a replaced or deleted value
+        """
+        if not chunking.is_manifest(old):
+            return
+        chunk_keys = self.chunker.chunk_keys(key, old)
+        self._request('batch_write', table.table_name, len(chunk_keys))
+        with self._lock:
+            for chunk_key in chunk_keys:
+                table.items.pop(chunk_key, None)
+
+    def _decode_data(self, data, pickled):
+        """
+        only strings are unpickled, numbers are counters and sets are shard
+        indexes, they are returned as they are
+        """
+        if pickled and data and isinstance(data, basestring):
+            if codec.is_encoded(data):
+                return codec.decode(data)
+            return pickle.loads(data)
+        return data
+
+    def instrument(self, metrics):
+        """
+        count the requests of every operation in metrics
+        """
+        self._request = metrics.counting(self._request)
+
+    def _request(self, operation, table_name, units=1):
+        """
+        account one backend request: count it, sleep the injected latency
+        and take `units` of throughput from the table
+        returns the table
+        """
+        with self._lock:
+            self.calls[operation] += 1
+        if self.latency:
+            if isinstance(self.latency, (tuple, list)):
+                time.sleep(random.uniform(*self.latency))
+            else:
+                time.sleep(self.latency)
+        with self._lock:
+            table = self._tables.get(table_name)
+            if table is None:
+                if not self.auto_create_table:
+                    raise MemoryStoreError("%s: '%s'" % (_TABLE_DOES_NOT_EXIST, table_name))
+                table = self.create_table(table_name)
+            if self.throttle:
+                self._take_throughput(table, units)
+            return table
+
+    def _take_throughput(self, table, units):
+        """
+        token bucket of read + write capacity per second, one second of burst
+        """
+        capacity = float(table.throughput['read'] + table.throughput['write'])
+        now = time.time()
+        table.tokens = min(capacity, table.tokens + (now - table.refilled) * capacity)
+        table.refilled = now
+        if table.tokens < units:
+            self.calls['throttled'] += 1
+            raise MemoryStoreThrottled("%s: '%s'" % (_THROUGHPUT_EXCEEDED, table.table_name))
+        table.tokens -= units
@@ -0,0 +1,244 @@
+'''
+Operation metrics of a Datastore: counts, errors, throttles, retries,
+backend calls and latency histograms per operation and table
+'''
+import re
+import time
+import bisect
+import socket
+import logging
+import threading
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds, the last bucket is everything slower
+_DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_THROTTLE_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'MemoryStoreThrottled')
+_STATSD_NAME = re.compile(r'[^A-Za-z0-9_\-]')
+
+
+class _OperationStats(object):
+
+    __slots__ = ('count', 'errors', 'throttles', 'retries', 'backend_calls', 'latency_sum', 'buckets')
+
+    def __init__(self, bucket_count):
+        self.count = 0
+        self.errors = 0
+        self.throttles = 0
+        self.retries = 0
+        self.backend_calls = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (bucket_count + 1)
+
+
+class Metrics(object):
+
+    """
+    Settings, for any engine
+    'metrics': {'buckets': [0.001, 0.01, 0.1, 1],  # latency histogram upper bounds, in seconds
+                'statsd': {'host': 'localhost', 'port': 8125, 'prefix': 'datastore'},
+                'sinks': [callable]}
+    or 'metrics': True for the defaults
+
+    a sink is called after every operation with
+    sink(operation, table_name, elapsed, outcome)
+    outcome: {'error': bool, 'throttles': n, 'retries': n, 'backend_calls': n}
+
+    Engines count their own backend calls, retries and throttles of the current
+    operation with backend_call(), retried() and throttled(), see instrument()
+    of each engine.
+    """
+
+    def __init__(self, buckets=None, sinks=None, statsd=None):
+        self.buckets = tuple(sorted(buckets or _DEFAULT_BUCKETS))
+        self.sinks = list(sinks or [])
+        if statsd:
+            self.sinks.append(StatsdSink(**statsd))
+        self._operations = {}  # (operation, table_name) -> _OperationStats
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def backend_call(self):
+        self._local.backend_calls = getattr(self._local, 'backend_calls', 0) + 1
+
+    def retried(self, *args):
+        self._local.retries = getattr(self._local, 'retries', 0) + 1
+
+    def throttled(self, events=1):
+        self._local.throttles = getattr(self._local, 'throttles', 0) + events
+
+    def counting(self, func):
+        """
+        wrap a backend request function to count its calls
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            self.backend_call()
+            return func(*args, **kwargs)
+        return wrapper
+
+    def measure(self, operation, table_name, func, *args, **kwargs):
+        """
+        call func and record it as one operation on table_name
+        """
+        local = self._local
+        outer = (getattr(local, 'backend_calls', 0), getattr(local, 'retries', 0), getattr(local, 'throttles', 0))
+        local.backend_calls = local.retries = local.throttles = 0
+        error = None
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.time() - start
+            backend_calls, retries, throttles = local.backend_calls, local.retries, local.throttles
+            # an operation made inside another one counts for both
+            local.backend_calls, local.retries, local.throttles = (outer[0] + backend_calls, outer[1] + retries,
+                                                                   outer[2] + throttles)
+            if error is not None and type(error).__name__ in _THROTTLE_ERRORS:
+                throttles = max(throttles, 1)  # unless the engine counted it already
+            self.record(operation, table_name, elapsed, error is not None, throttles, retries, backend_calls)
+
+    def record(self, operation, table_name, elapsed, error=False, throttles=0, retries=0, backend_calls=0):
+        with self._lock:
+            stats = self._operations.get((operation, table_name))
+            if stats is None:
+                stats = self._operations[(operation, table_name)] = _OperationStats(len(self.buckets))
+            stats.count += 1
+            stats.errors += bool(error)
+            stats.throttles += throttles
+            stats.retries += retries
+            stats.backend_calls += backend_calls
+            stats.latency_sum += elapsed
+            stats.buckets[bisect.bisect_left(self.buckets, elapsed)] += 1
+        if self.sinks:
+            outcome = {'error': bool(error), 'throttles': throttles, 'retries': retries,
+                       'backend_calls': backend_calls}
+            for sink in self.sinks:
+                try:
+                    sink(operation, table_name, elapsed, outcome)
+                except Exception:
+                    logger.exception('metrics sink %r failed', sink)
+
+    def stats(self):
+        """
+        returns {operation: {table_name: {'count', 'errors', 'throttles', 'retries',
+                                          'backend_calls', 'backend_calls_per_op', 'latency_sum',
+                                          'histogram', 'p50', 'p95', 'p99'}}}
+        histogram is [(upper bound in seconds, count)], None is the bound of the last bucket,
+        percentiles are the upper bound of their bucket
+        """
+        with self._lock:
+            snapshot = dict((name, (stats.count, stats.errors, stats.throttles, stats.retries,
+                                    stats.backend_calls, stats.latency_sum, list(stats.buckets)))
+                            for name, stats in self._operations.iteritems())
+        result = {}
+        bounds = list(self.buckets) + [None]
+        for (operation, table_name), (count, errors, throttles, retries, calls, latency_sum, buckets) \
+                in snapshot.iteritems():
+            result.setdefault(operation, {})[table_name] = {
+                'count': count,
+                'errors': errors,
+                'throttles': throttles,
+                'retries': retries,
+                'backend_calls': calls,
+                'backend_calls_per_op': float(calls) / count,
+                'latency_sum': latency_sum,
+                'histogram': zip(bounds, buckets),
+                'p50': _bucket_percentile(bounds, buckets, count, 50),
+                'p95': _bucket_percentile(bounds, buckets, count, 95),
+                'p99': _bucket_percentile(bounds, buckets, count, 99),
+            }
+        return result
+
+    def prometheus_text(self, prefix='datastore'):
+        """
+        the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        stats = self.stats()
+        rows = [(operation, table_name, values)
+                for operation, tables in sorted(stats.iteritems())
+                for table_name, values in sorted(tables.iteritems())]
+        for name, field in (('operations', 'count'), ('errors', 'errors'), ('throttles', 'throttles'),
+                            ('retries', 'retries'), ('backend_calls', 'backend_calls')):
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            for operation, table_name, values in rows:
+                lines.append('%s_%s_total{%s} %s' % (prefix, name, _labels(operation, table_name), values[field]))
+        lines.append('# TYPE %s_latency_seconds histogram' % prefix)
+        for operation, table_name, values in rows:
+            labels = _labels(operation, table_name)
+            cumulative = 0
+            for bound, count in values['histogram']:
+                cumulative += count
+                le = '+Inf' if bound is None else repr(float(bound))
+                lines.append('%s_latency_seconds_bucket{%s,le="%s"} %s' % (prefix, labels, le, cumulative))
+            lines.append('%s_latency_seconds_sum{%s} %r' % (prefix, labels, values['latency_sum']))
+            lines.append('%s_latency_seconds_count{%s} %s' % (prefix, labels, values['count']))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._operations = {}
+
+
+class StatsdSink(object):
+
+    """
+    send every operation to StatsD over UDP
+    <prefix>.<operation>.<table>.count, .errors, .throttles, .retries, .backend_calls and .latency (ms)
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='datastore'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, operation, table_name, elapsed, outcome):
+        name = '.'.join(_STATSD_NAME.sub('_', str(part)) for part in (self.prefix, operation, table_name or '_'))
+        lines = ['%s.count:1|c' % name, '%s.latency:%.3f|ms' % (name, elapsed * 1000)]
+        if outcome['error']:
+            lines.append('%s.errors:1|c' % name)
+        for field in ('throttles', 'retries', 'backend_calls'):
+            if outcome[field]:
+                lines.append('%s.%s:%s|c' % (name, field, outcome[field]))
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            pass  # metrics are best effort
+
+
+def measured(f):
+    """
+    record a Datastore method in self.metrics, table_name should be the first argument
+    """
+    @wraps(f)
+    def wrapper(self, *args, **kwargs):
+        if self.metrics is None:
+            return f(self, *args, **kwargs)
+        table_name = args[0] if args and isinstance(args[0], basestring) else None
+        return self.metrics.measure(f.__name__, table_name, f, self, *args, **kwargs)
+    return wrapper
+
+
+def _bucket_percentile(bounds, buckets, count, p):
+    if not count:
+        return None
+    rank = p / 100.0 * count
+    cumulative = 0
+    for bound, bucket_count in zip(bounds, buckets):
+        cumulative += bucket_count
+        if cumulative >= rank:
+            return bound
+    return None
+
+
+def _labels(operation, table_name):
+    return 'operation="%s",table="%s"' % (_escape_label(operation), _escape_label(table_name or ''))
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
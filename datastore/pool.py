@@ -0,0 +1,144 @@
+'''
+Pool of backend clients, one per thread
+'''
+import time
+import weakref
+import threading
+
+_DEFAULT_POOL_SIZE = None  # no limit
+_DEFAULT_TIMEOUT = None  # wait forever
+
+
+class ClientPoolError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class _Lease(object):
+
+    """
+    the client of a thread, kept in the thread's locals only, the pool holds
+    a weak reference to it and takes the client back once it's gone
+
+    no __del__, the engine, its pool and the factory form a cycle that Python 2
+    doesn't collect when one of them has a __del__
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+
+class ClientPool(object):
+
+    """
+    every thread gets its own client made by `factory`, clients of finished
+    threads are reused by new ones, so their HTTP connections stay alive
+
+    Settings, for the DynamoDB and Azure Table engines
+    'client_pool': {'size': 20,      # max clients at a time, None for no limit
+                    'timeout': 30}   # seconds a thread waits for a client, None to wait forever
+
+    Boto connections and Azure TableServices keep state per request
+    (batches, retry counts), a client is only used by one thread at a time.
+    """
+
+    def __init__(self, factory, size=_DEFAULT_POOL_SIZE, timeout=_DEFAULT_TIMEOUT):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.created = 0
+        self._idle = []
+        self._setups = []
+        self._clients = []  # every client made, for setups added later
+        self._cond = threading.Condition(threading.Lock())
+        self._local = threading.local()
+        self._leases = {}  # weakref of a lease -> its client
+
+    def get(self):
+        """
+        the client of the current thread
+        """
+        lease = getattr(self._local, 'lease', None)
+        if lease is None:
+            client = self._acquire()
+            lease = self._local.lease = _Lease(client)
+            with self._cond:
+                self._leases[weakref.ref(lease, self._return)] = client
+        return lease.client
+
+    def release(self):
+        """
+        give the client of the current thread back before the thread ends
+        """
+        lease = getattr(self._local, 'lease', None)
+        if lease is not None:
+            del self._local.lease
+
+    def setup(self, func):
+        """
+        call func(client) on every client, made or to be made
+        """
+        with self._cond:
+            self._setups.append(func)
+            clients = list(self._clients)
+        for client in clients:
+            func(client)
+
+    def stats(self):
+        with self._cond:
+            return {'size': self.size, 'created': self.created, 'idle': len(self._idle)}
+
+    def _acquire(self):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        with self._cond:
+            while not self._idle and self.size and self.created >= self.size:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise ClientPoolError('no client available after %s seconds, pool size %s'
+                                          % (self.timeout, self.size))
+                self._cond.wait(remaining)
+            if self._idle:
+                return self._idle.pop()
+            self.created += 1
+            setups = list(self._setups)
+        try:
+            client = self.factory()
+            for func in setups:
+                func(client)
+        except Exception:
+            with self._cond:
+                self.created -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._clients.append(client)
+            missed = self._setups[len(setups):]  # added while the client was made
+        for func in missed:
+            func(client)
+        return client
+
+    def _return(self, lease_ref):
+        """
+        the lease is gone, its thread ended or released it
+        """
+        with self._cond:
+            self._idle.append(self._leases.pop(lease_ref))
+            self._cond.notify()
+
+
+class ClientProxy(object):
+
+    """
+    stands for the client of the current thread, so it can be shared
+    e.g. by boto Table handles cached for all threads
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._pool.get(), name)
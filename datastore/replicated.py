@@ -0,0 +1,341 @@
+'''
+Engine replicating a primary engine to a secondary one, with hedged reads
+'''
+import Queue
+import logging
+import threading
+import weakref
+from collections import Counter
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from buffer import close_at_exit
+from retry import RetryPolicy, RetryError
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_HEDGE_DELAY = 0.05
+_DEFAULT_HEDGE_WORKERS = 20
+_DEFAULT_QUEUE_SIZE = 10000
+_DEFAULT_REPLICATION_WORKERS = 1
+_DEFAULT_DRAIN_TIMEOUT = 10
+
+# reads answered by whichever engine answers first
+_HEDGED = frozenset(['get_data', 'get_many', 'get_count', 'get_counts', 'get_window', 'count_distinct'])
+# writes applied to the primary, then queued for the secondary
+_REPLICATED = frozenset(['create_table', 'delete_table', 'set_data', 'delete_data', 'set_many', 'delete_many',
+                         'incr', 'delete_counter', 'incr_window', 'add_distinct'])
+# writes of a whole table, applied once every worker is done with the writes queued before
+_TABLE_WRITES = frozenset(['create_table', 'delete_table'])
+# writes of several keys, split by key between the workers
+_MANY_WRITES = frozenset(['set_many', 'delete_many'])
+# writes that count twice when a failed attempt was applied, not retried
+_NOT_RETRIED = frozenset(['incr', 'incr_window', 'add_distinct'])
+# arguments of cas and update_if that apply to the replicated set_data
+_SET_DATA_ARGS = ('pickled', 'row_key', 'transform_time')
+
+
+class ReplicatedStoreError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class ReplicatedStore(object):
+
+    """
+    writes go to the primary engine, then to the secondary through a bounded
+    queue in the background, reads go to the primary and, once it takes longer
+    than hedge_delay, to the secondary as well, the first answer wins
+
+    Replicated Example settings
+    'replicated': {
+        'engine': 'replicated',
+        'primary': {'engine': 'dynamodb', ...},
+        'secondary': {'engine': 'azure_table', ...},
+        'hedge_delay': 0.05,      # seconds before the secondary is asked too, None never asks it
+        'hedge_workers': 20,      # threads running the reads, per engine
+        'queue_size': 10000,      # writes waiting for the secondary, per worker
+        'block': True,            # writes wait for room in a full queue, False drops them
+        'replication_workers': 1,
+        'retry': {}               # see retry.RetryPolicy, for writes to the secondary
+    }
+
+    The secondary is behind the primary by the queue, so a hedged read may
+    answer with an older value. A read failing on one engine is answered by
+    the other one. Writes failing on the secondary are logged and counted in
+    replication_stats(), incr, incr_window and add_distinct are not retried
+    since a failed attempt may have been applied. cas and update_if are
+    decided by the primary and replicated as a set_data of the value written.
+    Other calls only go to the primary.
+
+    Each worker has its own queue, the writes of a key always go to the same
+    one so they reach the secondary in order. create_table and delete_table
+    wait for every worker to apply the writes queued before them.
+    """
+
+    def __init__(self, settings, create_engine):
+        self.settings = settings
+        if not settings.get('primary') or not settings.get('secondary'):
+            raise ReplicatedStoreError('replicated engine needs primary and secondary engine settings')
+        self.primary = create_engine(settings['primary'])
+        self.secondary = create_engine(settings['secondary'])
+        self.hedge_delay = settings.get('hedge_delay', _DEFAULT_HEDGE_DELAY)
+        self.block = settings.get('block', True)
+        self.retry_policy = RetryPolicy(**(settings.get('retry') or {}))
+        self.counts = Counter()
+        self._counts_lock = threading.Lock()
+        hedge_workers = settings.get('hedge_workers', _DEFAULT_HEDGE_WORKERS)
+        # a slow engine only holds up the threads of its own pool
+        self._hedge_pools = {'primary': ThreadPool(hedge_workers), 'secondary': ThreadPool(hedge_workers)}
+        queue_size = settings.get('queue_size', _DEFAULT_QUEUE_SIZE)
+        self._queues = [Queue.Queue(queue_size)
+                        for _ in xrange(max(settings.get('replication_workers', _DEFAULT_REPLICATION_WORKERS), 1))]
+        self._put_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._workers = []
+        ref = weakref.ref(self, partial(_stop, self._queues, self._hedge_pools.values()))
+        for i, queue in enumerate(self._queues):
+            worker = threading.Thread(target=_run_worker, args=(ref, queue), name='ReplicatedStore-%s' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        close_at_exit(self)
+
+    def __getattr__(self, method):
+        if method.startswith('_') or 'primary' not in self.__dict__:
+            raise AttributeError(method)
+        if method in _HEDGED:
+            return lambda *args, **kwargs: self._hedged(method, args, kwargs)
+        if method in _REPLICATED:
+            return lambda *args, **kwargs: self._replicated(method, args, kwargs)
+        return getattr(self.primary, method)
+
+    def cas(self, table_name, key, expected_version, data, *args, **kwargs):
+        result = self.primary.cas(table_name, key, expected_version, data, *args, **kwargs)
+        if result.ok:
+            self._replicate('set_data', (table_name, key, result.value), _set_data_kwargs(kwargs))
+        return result
+
+    def update_if(self, table_name, key, func, *args, **kwargs):
+        result = self.primary.update_if(table_name, key, func, *args, **kwargs)
+        if result.ok:
+            self._replicate('set_data', (table_name, key, result.value), _set_data_kwargs(kwargs))
+        return result
+
+    def instrument(self, metrics):
+        """
+        count the requests of both engines in metrics
+        """
+        self.primary.instrument(metrics)
+        self.secondary.instrument(metrics)
+
+    def _hedged(self, method, args, kwargs):
+        if self.hedge_delay is None:
+            return getattr(self.primary, method)(*args, **kwargs)
+        answers = Queue.Queue()
+        self._ask(answers, self.primary, method, args, kwargs)
+        pending, hedged, error = 1, False, None
+        while True:
+            try:
+                ok, value = answers.get(timeout=None if hedged else self.hedge_delay)
+            except Queue.Empty:
+                ok = None  # the primary is slow
+            if ok:
+                return value
+            if ok is False:
+                pending -= 1
+                error = error or value
+            if not hedged:
+                hedged = True
+                self._count('hedged')
+                self._ask(answers, self.secondary, method, args, kwargs)
+                pending += 1
+            elif not pending:
+                raise error
+
+    def _ask(self, answers, engine, method, args, kwargs):
+        def call():
+            try:
+                value = getattr(engine, method)(*args, **kwargs)
+            except Exception as e:
+                answers.put((False, e))
+            else:
+                if engine is self.secondary:
+                    self._count('secondary_answers')
+                answers.put((True, value))
+
+        self._hedge_pools['secondary' if engine is self.secondary else 'primary'].apply_async(call)
+
+    def _replicated(self, method, args, kwargs):
+        result = getattr(self.primary, method)(*args, **kwargs)
+        self._replicate(method, args, kwargs)
+        return result
+
+    def _replicate(self, method, args, kwargs):
+        try:
+            if method in _TABLE_WRITES or not args:
+                self._put_all(_TableWrite(method, args, kwargs, len(self._queues)))
+            elif method in _MANY_WRITES and len(self._queues) > 1 and len(args) > 1:
+                self._put_many(method, args, kwargs)
+            else:
+                self._queue_of(args[0], args[1] if len(args) > 1 else None).put((method, args, kwargs), self.block)
+        except Queue.Full:
+            self._count('dropped')
+            logger.warning("Replication queue is full, dropped %s of '%s'", method, args[0] if args else None)
+        else:
+            self._count('queued')
+
+    def _queue_of(self, table_name, key):
+        if len(self._queues) == 1:
+            return self._queues[0]
+        return self._queues[hash((table_name, key)) % len(self._queues)]
+
+    def _put_many(self, method, args, kwargs):
+        """
+        split set_many or delete_many by the queue of each key
+        """
+        table_name, items = args[0], args[1]
+        groups = {}
+        for key in items:
+            groups.setdefault(id(self._queue_of(table_name, key)), []).append(key)
+        for keys in groups.itervalues():
+            part = dict((key, items[key]) for key in keys) if isinstance(items, dict) else keys
+            self._queue_of(table_name, keys[0]).put((method, (table_name, part) + args[2:], kwargs), self.block)
+
+    def _put_all(self, write):
+        """
+        queue a table write to every worker, in the same order for all of them
+        """
+        with self._put_lock:
+            if not self.block and any(queue.full() for queue in self._queues):
+                raise Queue.Full()
+            for queue in self._queues:
+                queue.put(write)
+
+    def _apply(self, method, args, kwargs):
+        """
+        one write to the secondary, retried unless it is in _NOT_RETRIED
+        """
+        error = None
+        try:
+            for _ in self.retry_policy.attempts('replicate', max_retries=0 if method in _NOT_RETRIED else None):
+                try:
+                    getattr(self.secondary, method)(*args, **kwargs)
+                    self._count('replicated')
+                    return
+                except Exception as e:
+                    error = e
+        except RetryError:
+            self._count('failed')
+            logger.warning("Failed to replicate %s of '%s': %s", method, args[0] if args else None, error)
+
+    def _count(self, name):
+        with self._counts_lock:
+            self.counts[name] += 1
+
+    def replication_stats(self):
+        """
+        {'queued': 0, 'replicated': 0, 'dropped': 0, 'failed': 0, 'pending': 0,
+         'hedged': 0, 'secondary_answers': 0}
+        """
+        with self._counts_lock:
+            stats = dict((name, self.counts[name]) for name in ('queued', 'replicated', 'dropped', 'failed',
+                                                                'hedged', 'secondary_answers'))
+        stats['pending'] = sum(queue.qsize() for queue in self._queues)
+        return stats
+
+    def drain(self, timeout=_DEFAULT_DRAIN_TIMEOUT):
+        """
+        wait until the queued writes are applied to the secondary
+        returns False if some are still pending after timeout seconds
+        """
+        done = threading.Event()
+
+        def join():
+            for queue in self._queues:
+                queue.join()
+            done.set()
+
+        waiter = threading.Thread(target=join, name='ReplicatedStore-drain')
+        waiter.daemon = True
+        waiter.start()
+        return done.wait(timeout)
+
+    def close(self):
+        """
+        wait for the queued writes, at most the drain timeout, and stop the workers
+        """
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if not self.drain():
+            logger.warning('%s writes were not replicated', sum(queue.qsize() for queue in self._queues))
+        _stop(self._queues, self._hedge_pools.values())
+
+
+class _TableWrite(object):
+
+    """
+    a write queued to every worker, the last worker to reach it applies it
+    and the others wait, so it comes after the writes queued before it
+    """
+
+    def __init__(self, method, args, kwargs, workers):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self._waiting = workers
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def apply(self, store):
+        with self._lock:
+            self._waiting -= 1
+            last = not self._waiting
+        if last:
+            try:
+                store._apply(self.method, self.args, self.kwargs)
+            finally:
+                self._done.set()
+        else:
+            self._done.wait()
+
+
+def _run_worker(ref, queue):
+    """
+    apply the writes of the queue to the secondary, the store is only held
+    while applying one so the worker doesn't keep it, None stops the worker
+    """
+    while True:
+        write = queue.get()
+        try:
+            store = ref()
+            if write is None or store is None:
+                return
+            if isinstance(write, _TableWrite):
+                write.apply(store)
+            else:
+                store._apply(*write)
+            del store
+        finally:
+            queue.task_done()
+
+
+def _stop(queues, pools, ref=None):
+    """
+    stop the workers and the hedge pools, when the store is closed or collected
+    """
+    for queue in queues:
+        try:
+            queue.put_nowait(None)
+        except Queue.Full:
+            pass  # the worker stops once it finds the store collected
+    for pool in pools:
+        pool.close()
+
+
+def _set_data_kwargs(kwargs):
+    return dict((name, value) for name, value in kwargs.iteritems() if name in _SET_DATA_ARGS)
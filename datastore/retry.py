@@ -0,0 +1,183 @@
+'''
+Retry policy shared by the engines
+
+- full jitter exponential backoff
+- a deadline per call
+- a retry budget shared by the whole process
+'''
+import math
+import time
+import random
+import threading
+
+_DEFAULT_MAX_RETRIES = 10
+_DEFAULT_BASE_BACKOFF = 0.05
+_DEFAULT_MAX_BACKOFF = 60.0
+_DEFAULT_BUDGET_RATIO = 0.1
+_DEFAULT_BUDGET_MIN_PER_SECOND = 10.0
+_DEFAULT_BUDGET_HALF_LIFE = 10.0
+_MAX_EXPONENT = 32
+
+
+class RetryError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def full_jitter_backoff(retries, base=_DEFAULT_BASE_BACKOFF, cap=_DEFAULT_MAX_BACKOFF):
+    """
+    retries: times of retry, from 1
+    return: time in second to wait, uniform in [0, min(cap, base * 2 ** (retries - 1))]
+    """
+    retries = max(int(retries), 1)
+    return random.uniform(0, min(cap, base * 2 ** min(retries - 1, _MAX_EXPONENT)))
+
+
+class RetryBudget(object):
+
+    """
+    retries allowed to the whole process
+
+    Every call deposits `ratio` of a retry and every retry withdraws one,
+    deposits halve every `half_life` seconds. On top of that `min_per_second`
+    retries a second are always allowed, so a quiet process can still retry.
+    When the backend is overloaded and most calls fail, retries stay around
+    `ratio` of the calls instead of multiplying the load by max_retries.
+    """
+
+    def __init__(self, ratio=_DEFAULT_BUDGET_RATIO, min_per_second=_DEFAULT_BUDGET_MIN_PER_SECOND,
+                 half_life=_DEFAULT_BUDGET_HALF_LIFE):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.half_life = half_life
+        self.balance = 0.0
+        self.reserve = float(min_per_second)
+        self.rejected = 0
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._refill(time.time())
+            self.balance += self.ratio
+
+    def withdraw(self):
+        """
+        returns False when the budget is used up, the retry should not be made
+        """
+        with self._lock:
+            self._refill(time.time())
+            if self.reserve >= 1:
+                self.reserve -= 1
+                return True
+            if self.balance >= 1:
+                self.balance -= 1
+                return True
+            self.rejected += 1
+            return False
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self.reserve = min(self.reserve + elapsed * self.min_per_second, float(self.min_per_second))
+            if self.half_life:
+                self.balance *= math.pow(0.5, elapsed / self.half_life)
+        self._updated = now
+
+
+PROCESS_BUDGET = RetryBudget()
+
+
+class RetryPolicy(object):
+
+    """
+    Settings, for any engine
+    'retry': {'max_retries': 10, 'base_backoff': 0.05, 'max_backoff': 60,
+              'deadline': None, 'budget': True}
+
+    deadline: seconds a call may take including its retries, None for no limit
+    budget: True to share PROCESS_BUDGET, False for no budget, or a RetryBudget
+
+    for attempt in policy.attempts('incr'):
+        ...  # return or break when done, continue to retry
+
+    the loop raises RetryError instead of starting a retry it is not allowed to make
+    """
+
+    def __init__(self, max_retries=_DEFAULT_MAX_RETRIES, base_backoff=_DEFAULT_BASE_BACKOFF,
+                 max_backoff=_DEFAULT_MAX_BACKOFF, deadline=None, budget=True):
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        if budget is True:
+            budget = PROCESS_BUDGET
+        self.budget = budget or None
+        self.counts = {}  # (operation, 'calls' | 'retries' | 'gave_up') -> count
+        self.listener = None  # called with the operation before every retry
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def backoff(self, retries):
+        return full_jitter_backoff(retries, self.base_backoff, self.max_backoff)
+
+    def attempts(self, operation='call', max_retries=None, deadline=None):
+        """
+        yields 0 for the first attempt, then the retry number after waiting the backoff
+        max_retries, deadline: override the policy for this call
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        if deadline is None:
+            deadline = self.deadline
+        start = time.time()
+        self._local.retries = 0
+        self._count(operation, 'calls')
+        if self.budget is not None:
+            self.budget.deposit()
+        yield 0
+
+        retries = 0
+        while True:
+            retries += 1
+            wait = self.backoff(retries)
+            if retries > max_retries:
+                self._give_up(operation, '%s exceeded max retry %s' % (operation, max_retries))
+            if deadline is not None and time.time() + wait - start > deadline:
+                self._give_up(operation, '%s exceeded deadline of %s seconds' % (operation, deadline))
+            if self.budget is not None and not self.budget.withdraw():
+                self._give_up(operation, '%s exceeded the retry budget' % operation)
+            self._count(operation, 'retries')
+            self._local.retries = retries
+            if self.listener is not None:
+                self.listener(operation)
+            time.sleep(wait)
+            yield retries
+
+    def last_retries(self):
+        """
+        retries of the last call made by this thread
+        """
+        return getattr(self._local, 'retries', 0)
+
+    def stats(self):
+        """
+        returns {operation: {'calls': n, 'retries': n, 'gave_up': n}}
+        """
+        with self._lock:
+            stats = {}
+            for (operation, name), count in self.counts.iteritems():
+                stats.setdefault(operation, {'calls': 0, 'retries': 0, 'gave_up': 0})[name] = count
+            return stats
+
+    def _count(self, operation, name):
+        with self._lock:
+            self.counts[(operation, name)] = self.counts.get((operation, name), 0) + 1
+
+    def _give_up(self, operation, message):
+        self._count(operation, 'gave_up')
+        raise RetryError(message)
@@ -0,0 +1,161 @@
+'''
+Streaming scans of a table, page by page across parallel segments
+'''
+import re
+import sys
+import time
+import Queue
+import numbers
+import threading
+
+_QUEUED_PAGES_PER_SEGMENT = 2
+_PUT_TIMEOUT = 0.1
+_DONE = 'done'
+_SHARD_KEY = re.compile(r'_shard_\d+$')  # a counter shard, see the sharded_key of the engines
+
+
+class ScanError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class RateLimiter(object):
+
+    """
+    token bucket of `rate` units per second, one second of burst
+
+    The units a Scan request consumes are only known from its response,
+    so wait() blocks while the bucket is empty and take() charges the units
+    afterwards, the bucket may go below zero.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.refilled = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens > 0:
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def take(self, units):
+        with self._lock:
+            self._refill()
+            self.tokens -= units
+
+    def acquire(self, units=1):
+        self.wait()
+        self.take(units)
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+
+def is_counter_item(key, data):
+    """
+    a scanned counter shard, scans return counts as numbers, Decimal on DynamoDB
+    """
+    return isinstance(data, numbers.Number) and bool(_SHARD_KEY.search(key))
+
+
+def scan_pages(fetch, segments=1, checkpoint=None, limiter=None):
+    """
+    yield the items of every page of every segment
+
+    fetch(segment, start) returns (items, start of the next page or None
+    when the segment is done, units consumed), start is None for the first page
+
+    More than one segment are fetched by a thread each, at most two pages
+    per segment wait in memory for the consumer.
+
+    checkpoint: dict of str(segment) to the start of its next page, or 'done',
+    updated once all the items of a page are yielded, passing it again resumes
+    the scan. Items of a page cut short are yielded again on resume.
+    """
+    if checkpoint is None:
+        checkpoint = {}
+    if checkpoint.setdefault('segments', segments) != segments:
+        raise ScanError('checkpoint of %s segments, resumed with %s' % (checkpoint['segments'], segments))
+    pending = [segment for segment in xrange(segments) if checkpoint.get(str(segment)) != _DONE]
+    if len(pending) == 1:
+        return _scan_segment(fetch, pending[0], checkpoint, limiter)
+    return _scan_parallel(fetch, pending, checkpoint, limiter)
+
+
+def _scan_segment(fetch, segment, checkpoint, limiter):
+    start = checkpoint.get(str(segment))
+    while True:
+        items, start, units = _fetch(fetch, segment, start, limiter)
+        for item in items:
+            yield item
+        checkpoint[str(segment)] = _DONE if start is None else start
+        if start is None:
+            return
+
+
+def _scan_parallel(fetch, segments, checkpoint, limiter):
+    pages = Queue.Queue(_QUEUED_PAGES_PER_SEGMENT * len(segments))
+    stop = threading.Event()
+    for segment in segments:
+        thread = threading.Thread(target=_fetch_segment,
+                                  args=(fetch, segment, checkpoint.get(str(segment)), limiter, pages, stop),
+                                  name='Scan-%s' % segment)
+        thread.daemon = True
+        thread.start()
+    remaining = len(segments)
+    try:
+        while remaining:
+            segment, items, start, error = pages.get()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            for item in items:
+                yield item
+            checkpoint[str(segment)] = _DONE if start is None else start
+            if start is None:
+                remaining -= 1
+    finally:
+        stop.set()  # also when the consumer stops early
+
+
+def _fetch_segment(fetch, segment, start, limiter, pages, stop):
+    try:
+        while not stop.is_set():
+            items, start, units = _fetch(fetch, segment, start, limiter)
+            if not _put(pages, stop, (segment, items, start, None)) or start is None:
+                return
+    except Exception:
+        _put(pages, stop, (segment, None, None, sys.exc_info()))
+
+
+def _fetch(fetch, segment, start, limiter):
+    if limiter is not None:
+        limiter.wait()
+    items, start, units = fetch(segment, start)
+    if limiter is not None:
+        limiter.take(units)
+    return items, start, units
+
+
+def _put(pages, stop, page):
+    """
+    returns False when the consumer stopped
+    """
+    while not stop.is_set():
+        try:
+            pages.put(page, timeout=_PUT_TIMEOUT)
+            return True
+        except Queue.Full:
+            pass
+    return False
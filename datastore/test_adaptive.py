@@ -0,0 +1,39 @@
+'''
+Tests for the adaptive shard count, no backend needed
+'''
+
+import time
+import unittest
+from adaptive import AdaptiveShardCount
+
+
+class TestAdaptiveShardCountTestCase(unittest.TestCase):
+
+    def test_grow(self):
+        adaptive = AdaptiveShardCount(max_shards=8, grow_threshold=3)
+        self.assertEqual(adaptive.shard_count('test', 'k'), 1)
+        adaptive.record('test', 'k', 2)
+        self.assertEqual(adaptive.shard_count('test', 'k'), 1)
+        adaptive.record('test', 'k', 2)
+        self.assertEqual(adaptive.shard_count('test', 'k'), 2)
+        for _ in xrange(10):
+            adaptive.record('test', 'k', 3)
+        self.assertEqual(adaptive.shard_count('test', 'k'), 8)
+        self.assertEqual(adaptive.shard_count('test', 'other'), 1)
+
+    def test_shrink(self):
+        adaptive = AdaptiveShardCount(grow_threshold=1, half_life=0.01, cooldown=0.01)
+        adaptive.record('test', 'k')
+        adaptive.record('test', 'k')
+        self.assertEqual(adaptive.shard_count('test', 'k'), 4)
+        time.sleep(0.1)
+        self.assertEqual(adaptive.shard_count('test', 'k'), 2)
+        time.sleep(0.02)
+        self.assertEqual(adaptive.shard_count('test', 'k'), 1)
+        time.sleep(0.02)
+        self.assertEqual(adaptive.shard_count('test', 'k'), 1)
+        self.assertEqual(adaptive.stats(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
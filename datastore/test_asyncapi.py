@@ -0,0 +1,54 @@
+'''
+Tests for the non-blocking client against the memory engine
+'''
+
+import time
+import unittest
+from asyncapi import AsyncDatastore
+
+
+class TestAsyncDatastoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = AsyncDatastore({'engine': 'memory', 'latency': 0.05}, max_concurrency=10)
+        self.db.datastore.create_table('test')
+        self.db.datastore.create_table('test_counter')
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_get_and_set(self):
+        self.assertTrue(self.db.set_data('test', 'k', 'value').get(5))
+        self.assertEqual(self.db.get_data('test', 'k').get(5), 'value')
+        self.db.delete_data('test', 'k').get(5)
+        self.assertEqual(self.db.get_data('test', 'k').get(5), None)
+
+    def test_concurrent_calls(self):
+        start = time.time()
+        results = [self.db.incr('test_counter', 'k', shard_count=5) for _ in xrange(10)]
+        for result in results:
+            result.get(5)
+        self.assertTrue(time.time() - start < 0.05 * 10)
+        self.assertEqual(self.db.get_count('test_counter', 'k', sharded=True).get(5), 10)
+
+    def test_fan_out(self):
+        keys = ['k%s' % i for i in xrange(30)]
+        self.db.datastore.set_many('test', dict((key, key) for key in keys))
+        result = self.db.get_many('test', keys, chunk_size=10)
+        self.assertEqual(result.get(5), dict((key, key) for key in keys))
+        counts = self.db.get_counts('test_counter', ['a', 'b']).get(5)
+        self.assertEqual(counts, {'a': None, 'b': None})
+
+    def test_fan_out_timeout(self):
+        db = AsyncDatastore({'engine': 'memory', 'latency': 0.05}, max_concurrency=1)
+        db.datastore.create_table('test')
+        result = db.get_many('test', ['k%s' % i for i in xrange(10)], chunk_size=1)  # 10 chunks one after another
+        start = time.time()
+        result.wait(0.1)
+        self.assertTrue(time.time() - start < 0.2)
+        self.assertFalse(result.ready())
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -33,6 +33,15 @@ class TestAzureTableTestCase(unittest.TestCase):
         self.db.set_data('test', 'test_partition', 'data')
         self.assertEqual(self.db.get_data('test', 'test_partition'), 'data')
 
+    def test_batch(self):
+        keys = [str(uuid4()) for _ in xrange(60)]
+        self.db.set_many('test', dict((key, key[:8]) for key in keys))
+        results = self.db.get_many('test', keys + ['missing'])
+        self.assertEqual(results[keys[42]], keys[42][:8])
+        self.assertEqual(results['missing'], None)
+        self.db.delete_many('test', keys)
+        self.assertEqual(self.db.get_many('test', keys[:3]), dict.fromkeys(keys[:3]))
+
     def test_incr(self):
         key = str(uuid4())
         count_ori = self.db.get_count('testcounter', key) or 0
@@ -104,5 +113,37 @@ class TestAzureTableTestCase(unittest.TestCase):
         self.db.delete_counter('testcounter', key)
 
 
+class TestAzureTableWriterShardCounterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = dict(DB_SETTINGS['azure_table'], writer_shard_counters=True)
+        self.db = AzureTable(self.settings)
+        self.db.create_table('testcounter')
+
+    def test_multithread_counter(self):
+        count = 10
+        key = str(uuid4())
+
+        def incr_counter():
+            for _ in xrange(5):
+                self.db.incr('testcounter', key)
+
+        threadlist = []
+        for _ in xrange(0, count):
+            thread = Thread(target=incr_counter)
+            thread.start()
+            threadlist.append(thread)
+
+        for t in threadlist:
+            t.join(60)
+
+        self.assertEqual(self.db.get_count('testcounter', key), count * 5)
+        self.assertEqual(self.db.get_count('testcounter', key, sharded=True), count * 5)
+        self.db.delete_counter('testcounter', key)
+        self.db.incr('testcounter', key)
+        self.assertEqual(self.db.get_count('testcounter', key), 1)
+        self.db.delete_counter('testcounter', key)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,38 @@
+'''
+Tests for the benchmark harness against the memory engine
+'''
+
+import random
+import unittest
+from benchmark import BenchmarkError, config_from_args, key_sampler, parse_args, parse_mix, run
+
+
+class TestBenchmarkTestCase(unittest.TestCase):
+
+    def test_parse_mix(self):
+        self.assertEqual(parse_mix('get=3,incr=1'), [('get', 3.0), ('incr', 1.0)])
+        self.assertRaises(BenchmarkError, parse_mix, 'scan=1')
+
+    def test_zipf_is_skewed(self):
+        sample = key_sampler('zipf', 100, random.Random(1))
+        keys = [sample() for _ in xrange(2000)]
+        self.assertTrue(keys.count('key_0') > keys.count('key_50') * 10)
+
+    def test_reproducible(self):
+        sample1 = key_sampler('uniform', 100, random.Random(7))
+        sample2 = key_sampler('uniform', 100, random.Random(7))
+        self.assertEqual([sample1() for _ in xrange(50)], [sample2() for _ in xrange(50)])
+
+    def test_run(self):
+        args = parse_args(['--ops', '200', '--threads', '2', '--shard-count', '4', '--distribution', 'zipf'])
+        result = run(config_from_args(args))
+        self.assertEqual(result['ops'], 200)
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(set(result['operations'].keys()), set(['get', 'set', 'incr', 'count']))
+        self.assertTrue(result['backend_calls_per_op'] >= 1)
+        for stats in result['operations'].itervalues():
+            self.assertTrue(stats['p50_ms'] <= stats['p95_ms'] <= stats['p99_ms'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+'''
+Tests for the write-behind incr buffer, no backend needed
+'''
+
+import gc
+import weakref
+import unittest
+from threading import Thread
+from buffer import IncrBuffer
+
+
+class FakeCounter(object):
+
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+
+    def incr(self, table_name, key, amount=1, shard_count=1):
+        if self.fail:
+            raise IOError('backend is down')
+        self.calls.append((table_name, key, amount, shard_count))
+
+
+class TestIncrBufferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = FakeCounter()
+        self.buffer = IncrBuffer(self.backend.incr, max_size=1000, interval=0)
+
+    def tearDown(self):
+        self.backend.fail = False
+        self.buffer.close()
+
+    def test_flush_sums_per_counter(self):
+        for _ in xrange(10):
+            self.buffer.incr('test_counter', 'a')
+        self.buffer.incr('test_counter', 'b', 3)
+        self.buffer.incr('test_counter', 'a', 5, shard_count=10)
+        self.assertEqual(self.backend.calls, [])
+        self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual(sorted(self.backend.calls), [('test_counter', 'a', 5, 10),
+                                                      ('test_counter', 'a', 10, 1),
+                                                      ('test_counter', 'b', 3, 1)])
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_flush_on_max_size(self):
+        buf = IncrBuffer(self.backend.incr, max_size=5, interval=0)
+        for _ in xrange(5):
+            buf.incr('test_counter', 'a')
+        self.assertEqual(self.backend.calls, [('test_counter', 'a', 5, 1)])
+        buf.close()
+
+    def test_failed_flush_keeps_pending(self):
+        self.buffer.incr('test_counter', 'a', 2)
+        self.backend.fail = True
+        self.assertRaises(IOError, self.buffer.flush)
+        self.assertEqual(self.buffer.pending(), {('test_counter', 'a', 1): 2})
+        self.backend.fail = False
+        self.buffer.incr('test_counter', 'a', 1)
+        self.buffer.flush()
+        self.assertEqual(self.backend.calls, [('test_counter', 'a', 3, 1)])
+
+    def test_failed_flush_on_max_size(self):
+        buf = IncrBuffer(self.backend.incr, max_size=2, interval=0)
+        self.backend.fail = True
+        buf.incr('test_counter', 'a')
+        buf.incr('test_counter', 'a')  # the flush fails, the caller doesn't see it
+        self.assertEqual(buf.pending(), {('test_counter', 'a', 1): 2})
+        self.backend.fail = False
+        buf.close()
+        self.assertEqual(self.backend.calls, [('test_counter', 'a', 2, 1)])
+
+    def test_collected(self):
+        buf = IncrBuffer(self.backend.incr, interval=60)
+        ref = weakref.ref(buf)  # neither the timer nor the exit hook keep it
+        buf.incr('test_counter', 'a', 2)
+        del buf
+        gc.collect()
+        self.assertIsNone(ref())
+        self.assertEqual(self.backend.calls, [('test_counter', 'a', 2, 1)])  # flushed when collected
+
+    def test_multithread_incr(self):
+        count = 20
+
+        def incr_counter():
+            for _ in xrange(50):
+                self.buffer.incr('test_counter', 'a')
+
+        threadlist = [Thread(target=incr_counter) for _ in xrange(count)]
+        for t in threadlist:
+            t.start()
+        for t in threadlist:
+            t.join(60)
+        self.buffer.close()
+        self.assertEqual(sum(c[2] for c in self.backend.calls), count * 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
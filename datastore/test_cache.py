@@ -0,0 +1,61 @@
+'''
+Tests for the read-through cache, no backend needed
+'''
+
+import time
+import unittest
+from cache import LRUCache
+
+
+class TestLRUCacheTestCase(unittest.TestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache()
+        self.assertEqual(cache.get('test', 'k'), (False, None))
+        cache.set('test', 'k', {'a': 1})
+        self.assertEqual(cache.get('test', 'k'), (True, {'a': 1}))
+        cache.set('test', 'none', None)
+        self.assertEqual(cache.get('test', 'none'), (True, None))
+        cache.invalidate('test', 'k')
+        self.assertEqual(cache.get('test', 'k'), (False, None))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (2, 2, 1))
+
+    def test_generation(self):
+        cache = LRUCache()
+        generation = cache.generation('test', 'k')
+        cache.invalidate('test', 'k')  # a write while the value was read
+        self.assertFalse(cache.set('test', 'k', 'old', generation))
+        self.assertEqual(cache.get('test', 'k'), (False, None))
+        self.assertTrue(cache.set('test', 'k', 'new', cache.generation('test', 'k')))
+
+    def test_lru_eviction_by_entries(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('test', 'a', 1)
+        cache.set('test', 'b', 2)
+        cache.get('test', 'a')
+        cache.set('test', 'c', 3)
+        self.assertEqual(cache.get('test', 'b'), (False, None))
+        self.assertEqual(cache.get('test', 'a'), (True, 1))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_eviction_by_bytes(self):
+        cache = LRUCache(max_bytes=10)
+        cache.set('test', 'a', 'x' * 6)
+        cache.set('test', 'b', 'x' * 6)
+        self.assertEqual(cache.get('test', 'a'), (False, None))
+        self.assertEqual(cache.stats()['bytes'], 6)
+        self.assertFalse(cache.set('test', 'c', 'x' * 11))
+
+    def test_table_ttl(self):
+        cache = LRUCache(ttl=60, table_ttl={'short': 0.01, 'nocache': 0})
+        cache.set('short', 'k', 1)
+        self.assertFalse(cache.set('nocache', 'k', 1))
+        time.sleep(0.02)
+        self.assertEqual(cache.get('short', 'k'), (False, None))
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(cache.get('nocache', 'k'), (False, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+'''
+Tests for chunked values, runs without cloud credentials
+'''
+
+import os
+import unittest
+from api import Datastore
+from chunking import ValueChunker, ChunkError
+import chunking
+
+
+class TestValueChunkerTestCase(unittest.TestCase):
+
+    def test_split_and_join(self):
+        chunker = ValueChunker(chunk_size=10)
+        self.assertEqual(chunker.split('key', 'small'), (None, None))
+        value = os.urandom(95)
+        manifest, chunks = chunker.split('key', value)
+        self.assertTrue(chunking.is_manifest(manifest))
+        self.assertEqual(len(chunks), 10)
+        self.assertTrue(all(chunking.is_chunk_key(chunk_key) for chunk_key, _ in chunks))
+        self.assertEqual([chunk_key for chunk_key, _ in chunks], chunker.chunk_keys('key', manifest))
+        self.assertEqual(chunker.join('key', manifest, dict(chunks)), value)
+        self.assertRaises(ChunkError, chunker.join, 'key', manifest, dict(chunks[1:]))
+        chunks[0] = (chunks[0][0], 'x' * 10)
+        self.assertRaises(ChunkError, chunker.join, 'key', manifest, dict(chunks))
+
+    def test_disabled(self):
+        self.assertEqual(ValueChunker().split('key', 'x' * 10 ** 6), (None, None))
+
+
+class TestMemoryStoreChunkingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Datastore({'engine': 'memory', 'chunked_values': {'chunk_size': 1000}})
+        self.db.create_table('test_chunks')
+        self.table = self.db.get_table('test_chunks')
+        self.large = {'blob': os.urandom(20000)}
+
+    def chunk_keys(self):
+        return [key for key in self.table.items if chunking.is_chunk_key(key)]
+
+    def test_set_and_get(self):
+        self.db.set_data('test_chunks', 'key', self.large)
+        self.assertTrue(len(self.chunk_keys()) > 20)
+        self.assertTrue(chunking.is_manifest(self.table.items['key']))
+        self.assertEqual(self.db.get_data('test_chunks', 'key'), self.large)
+        self.assertEqual(self.db.get_many('test_chunks', ['key', 'missing']), {'key': self.large, 'missing': None})
+        self.assertEqual(dict(self.db.scan('test_chunks')), {'key': self.large})
+
+    def test_overwrite(self):
+        self.db.set_data('test_chunks', 'key', self.large)
+        self.db.set_data('test_chunks', 'key', {'blob': os.urandom(5000)})
+        first = set(self.chunk_keys())
+        self.db.set_data('test_chunks', 'key', 'small')
+        self.assertEqual(self.chunk_keys(), [])
+        self.assertEqual(self.db.get_data('test_chunks', 'key'), 'small')
+        self.db.set_data('test_chunks', 'key', self.large)
+        self.assertFalse(first & set(self.chunk_keys()))
+
+    def test_delete(self):
+        self.db.set_data('test_chunks', 'key', self.large)
+        self.db.delete_data('test_chunks', 'key')
+        self.assertEqual(self.table.items, {})
+        self.db.set_many('test_chunks', {'key1': self.large, 'key2': self.large, 'key3': 'small'})
+        self.assertEqual(self.db.get_many('test_chunks', ['key1', 'key2', 'key3']),
+                         {'key1': self.large, 'key2': self.large, 'key3': 'small'})
+        self.db.delete_many('test_chunks', ['key1', 'key2', 'key3'])
+        self.assertEqual(self.table.items, {})
+
+    def test_codec(self):
+        db = Datastore({'engine': 'memory', 'chunked_values': {'chunk_size': 1000},
+                        'codec': {'codec': 'pickle', 'compression': 'zlib'}})
+        db.create_table('test_chunks')
+        db.set_data('test_chunks', 'key', self.large)
+        self.assertEqual(db.get_data('test_chunks', 'key'), self.large)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+'''
+Tests for the cluster engine, runs without cloud credentials
+'''
+
+import unittest
+from decimal import Decimal
+from api import Datastore
+from cluster import HashRing, ClusterError
+
+
+def cluster_settings(ring, previous_ring=None):
+    return {'engine': 'cluster',
+            'nodes': {'a': {'engine': 'memory'},
+                      'b': {'engine': 'memory', 'table_suffix': '_b'},
+                      'c': {'engine': 'memory'}},
+            'ring': ring,
+            'previous_ring': previous_ring}
+
+
+class TestHashRingTestCase(unittest.TestCase):
+
+    def test_spread(self):
+        ring = HashRing(['a', 'b', 'c'])
+        keys = ['key%s' % i for i in xrange(3000)]
+        nodes = [ring.node(key) for key in keys]
+        for node in 'abc':
+            self.assertTrue(700 < nodes.count(node) < 1300)
+        bigger = HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key, node in zip(keys, nodes) if bigger.node(key) != node]
+        self.assertTrue(500 < len(moved) < 1000)
+        self.assertEqual(set(bigger.node(key) for key in moved), set(['d']))
+        self.assertRaises(ClusterError, HashRing, [])
+
+
+class TestClusterStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Datastore(cluster_settings(['a', 'b']))
+        self.db.create_table('test_table')
+        self.db.create_table('test_counter')
+        self.db.create_table('test_counter_shard_index')
+        self.items = dict(('key%s' % i, i) for i in xrange(100))
+
+    def node_keys(self, db, name, table_name='test_table'):
+        node = db.db.nodes[name]
+        return set(node.get_table(table_name + db.db.table_suffixes[name]).items)
+
+    def test_data(self):
+        self.db.set_data('test_table', 'key', 'value')
+        self.assertEqual(self.db.get_data('test_table', 'key'), 'value')
+        self.db.set_many('test_table', self.items)
+        self.assertEqual(self.db.get_many('test_table', self.items.keys()), self.items)
+        self.assertTrue(self.node_keys(self.db, 'a') and self.node_keys(self.db, 'b'))
+        self.assertFalse(self.node_keys(self.db, 'a') & self.node_keys(self.db, 'b'))
+        self.assertEqual(self.db.get_table('test_table')['b'].table_name, 'test_table_b')
+        self.assertEqual(dict(self.db.scan('test_table')), dict(self.items, key='value'))
+        self.db.delete_many('test_table', self.items.keys())
+        self.assertEqual(self.db.get_many('test_table', ['key1', 'key2']), {'key1': None, 'key2': None})
+
+    def test_counters(self):
+        for i in xrange(20):
+            self.db.incr('test_counter', 'counter%s' % (i % 4), shard_count=3)
+        self.assertEqual(self.db.get_count('test_counter', 'counter1', sharded=True), 5)
+        self.assertEqual(self.db.get_counts('test_counter', ['counter%s' % i for i in xrange(5)], sharded=True),
+                         {'counter0': 5, 'counter1': 5, 'counter2': 5, 'counter3': 5, 'counter4': 0})
+
+    def test_scan_checkpoint(self):
+        self.db.set_many('test_table', self.items)
+        checkpoint = {}
+        self.assertEqual(len(list(self.db.scan('test_table', page_size=10, checkpoint=checkpoint))), 100)
+        self.assertEqual(set(checkpoint), set(['a/segments', 'a/0', 'b/segments', 'b/0', 'c/segments', 'c/0']))
+        self.assertEqual(list(self.db.scan('test_table', checkpoint=checkpoint)), [])
+
+    def test_rebalance(self):
+        self.db.set_many('test_table', self.items)
+        self.db.incr('test_counter', 'counter', 7)
+        bigger = Datastore(cluster_settings(['a', 'b', 'c'], previous_ring=['a', 'b']))
+        for name in 'ab':
+            bigger.db.nodes[name] = self.db.db.nodes[name]  # the same backends
+        bigger.create_table('test_table')
+        self.assertEqual(bigger.get_many('test_table', ['key1']).keys(), ['key1'])
+        self.assertEqual(dict((key, bigger.get_data('test_table', key)) for key in self.items), self.items)
+
+        newer, deleted, updated = [key for key in sorted(self.items) if bigger.db.ring.node(key) == 'c'][:3]
+        bigger.set_data('test_table', newer, 'newer')  # written to 'c' before the old value moves
+        bigger.delete_data('test_table', deleted)
+        self.assertEqual(bigger.get_many('test_table', [deleted]), {deleted: None})
+        version, _ = bigger.get_versioned('test_table', updated)
+        self.assertTrue(bigger.cas('test_table', updated, version, 'cas').ok)  # on the node holding it
+        bigger.update_if('test_table', updated, lambda value: value + '!')
+        self.assertNotIn(updated, self.node_keys(bigger, 'c'))
+        expected = dict(self.items, **{newer: 'newer', updated: 'cas!'})
+        del expected[deleted]
+
+        checkpoint = {}
+        moved = bigger.rebalance('test_table', nodes=['a', 'b'], page_size=10, checkpoint=checkpoint)
+        self.assertTrue(10 < moved < 60)
+        self.assertEqual(len(self.node_keys(bigger, 'c')), moved + 1)
+        self.assertEqual(checkpoint['moved'], moved)
+        self.assertEqual(bigger.get_many('test_table', self.items.keys()), dict(expected, **{deleted: None}))
+        self.assertEqual(bigger.rebalance('test_table'), 0)
+
+        bigger.create_table('test_counter')
+        self.assertEqual(bigger.get_count('test_counter', 'counter'), 7)  # still on 'b', moves to 'c'
+        bigger.incr('test_counter', 'counter', 2)
+        self.assertEqual(bigger.get_counts('test_counter', ['counter', 'hits']), {'counter': 9, 'hits': None})
+        self.assertRaises(ClusterError, bigger.rebalance, 'test_counter')
+        self.assertEqual(bigger.rebalance_counters('test_counter', ['counter', 'hits']), 1)
+        self.assertEqual(bigger.get_count('test_counter', 'counter'), 9)
+        self.assertFalse(self.node_keys(bigger, 'b', 'test_counter'))
+        self.assertRaises(ClusterError, getattr, bigger.db, 'top_k')
+
+    def test_rebalance_decimal_counters(self):
+        # counter shards as the DynamoDB scan returns them
+        shards = dict(('counter%s_shard_1' % i, Decimal(i)) for i in xrange(20))
+        self.db.set_many('test_counter', shards)
+        bigger = Datastore(cluster_settings(['a', 'b', 'c'], previous_ring=['a', 'b']))
+        for name in 'ab':
+            bigger.db.nodes[name] = self.db.db.nodes[name]
+        bigger.create_table('test_counter')
+        self.assertRaises(ClusterError, bigger.rebalance, 'test_counter')
+        self.assertEqual(bigger.get_many('test_counter', shards.keys()), shards)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+'''
+Tests for value codecs, no backend needed
+'''
+
+import datetime
+import unittest
+import cPickle as pickle
+from codec import CodecError, CodecRegistry, ValueCodec, decode, is_encoded
+from test_config import SomeRecord
+
+
+class TestValueCodecTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = {'a': [1, 2, 3], 'b': 'text'}
+        for name in ('pickle', 'json'):
+            value = ValueCodec(name).encode(data)
+            self.assertTrue(is_encoded(value))
+            self.assertEqual(decode(value), data)
+        self.assertEqual(decode(ValueCodec('raw').encode('bytes')), 'bytes')
+        self.assertRaises(CodecError, ValueCodec('raw').encode, {'a': 1})
+        record = decode(ValueCodec('pickle').encode(SomeRecord()))
+        self.assertEqual(record.answer, SomeRecord().answer)
+
+    def test_compression(self):
+        data = 'x' * 10000
+        small = ValueCodec('raw', compression='zlib', compress_threshold=1024)
+        self.assertTrue(len(small.encode(data)) < 1000)
+        self.assertEqual(decode(small.encode(data)), data)
+        self.assertEqual(len(small.encode('x' * 100)), 106)  # header only, under the threshold
+        uncompressed = ValueCodec('raw', compression=None)
+        self.assertEqual(len(uncompressed.encode(data)), 10006)
+
+    def test_legacy_values(self):
+        self.assertFalse(is_encoded(pickle.dumps({'a': 1})))
+        self.assertFalse(is_encoded('plain text'))
+        self.assertRaises(CodecError, decode, 'plain text')
+        self.assertRaises(CodecError, ValueCodec, 'yaml')
+
+    def test_registry(self):
+        registry = CodecRegistry({'table_codecs': {'config': {'codec': 'json'},
+                                                   'events_%Y%m%d': {'codec': 'raw'}}})
+        self.assertEqual(registry.get('config').codec, 'json')
+        self.assertEqual(registry.get('events_20140123').codec, 'raw')
+        self.assertEqual(registry.get('events_old'), None)
+        self.assertEqual(registry.get('other'), None)
+        registry = CodecRegistry({'codec': {'codec': 'pickle'}})
+        self.assertEqual(registry.get('other').codec, 'pickle')
+
+    def test_registry_bounded(self):
+        registry = CodecRegistry({'table_codecs': {'events_%Y%m%d': {'codec': 'raw'}}})
+        for day in xrange(2000):
+            date = datetime.date(2014, 1, 1) + datetime.timedelta(days=day)
+            self.assertEqual(registry.get(date.strftime('events_%Y%m%d')).codec, 'raw')
+        self.assertEqual(len(registry._resolved), 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
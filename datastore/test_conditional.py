@@ -0,0 +1,65 @@
+'''
+Tests for compare-and-set, runs without cloud credentials
+'''
+
+import threading
+import unittest
+from api import Datastore
+from conditional import ConditionalError
+
+
+class TestMemoryStoreCasTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Datastore({'engine': 'memory', 'cache': {'ttl': 60},
+                             'retry': {'base_backoff': 0.001, 'budget': False}})
+        self.db.create_table('test_cas')
+
+    def test_cas(self):
+        self.assertEqual(self.db.get_versioned('test_cas', 'key'), (None, None))
+        self.assertEqual(self.db.cas('test_cas', 'key', None, 'a'), (True, 1, 'a'))
+        self.assertEqual(self.db.cas('test_cas', 'key', None, 'b'), (False, 1, 'a'))
+        self.assertEqual(self.db.cas('test_cas', 'key', 1, 'b'), (True, 2, 'b'))
+        self.assertEqual(self.db.cas('test_cas', 'key', 1, 'c'), (False, 2, 'b'))
+        self.assertEqual(self.db.get_versioned('test_cas', 'key'), (2, 'b'))
+
+    def test_unversioned(self):
+        self.db.set_data('test_cas', 'key', 'a')
+        self.assertEqual(self.db.get_versioned('test_cas', 'key'), (0, 'a'))
+        self.assertEqual(self.db.cas('test_cas', 'key', None, 'b').ok, False)
+        self.assertEqual(self.db.cas('test_cas', 'key', 0, 'b'), (True, 1, 'b'))
+        self.assertEqual(self.db.cas('test_cas', 'missing', 0, 'b'), (False, None, None))
+
+    def test_cache(self):
+        self.db.cas('test_cas', 'key', None, 'a')
+        self.assertEqual(self.db.get_data('test_cas', 'key'), 'a')
+        self.db.cas('test_cas', 'key', 1, 'b')
+        self.assertEqual(self.db.get_data('test_cas', 'key'), 'b')
+
+    def test_update_if(self):
+        def add(count):
+            return (count or 0) + 1
+
+        threads = [threading.Thread(target=lambda: [self.db.update_if('test_cas', 'count', add) for _ in xrange(20)])
+                   for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.db.get_versioned('test_cas', 'count'), (80, 80))
+
+    def test_update_if_skip(self):
+        self.db.cas('test_cas', 'key', None, 5)
+        self.assertEqual(self.db.update_if('test_cas', 'key', lambda value: None), (False, 1, 5))
+
+        def conflicting(value):
+            version, current = self.db.get_versioned('test_cas', 'key')
+            self.db.cas('test_cas', 'key', version, current * 10)  # another writer
+            return value + 1
+
+        self.assertRaises(ConditionalError, self.db.update_if, 'test_cas', 'key', conflicting, max_retries=1)
+        self.assertEqual(self.db.get_data('test_cas', 'key'), 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
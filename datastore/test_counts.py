@@ -0,0 +1,42 @@
+'''
+Tests for multi-key counter reads, runs without cloud credentials
+'''
+
+import unittest
+from api import Datastore
+
+
+class TestMemoryStoreGetCountsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Datastore({'engine': 'memory'})
+        self.db.create_table('test_counter')
+        self.keys = ['counter%s' % i for i in xrange(150)]
+        for i, key in enumerate(self.keys[:120]):
+            self.db.incr('test_counter', key, amount=i, shard_count=5)
+            self.db.incr('test_counter', key, amount=1, shard_count=5)
+
+    def test_sharded(self):
+        calls = self.db.db.calls['batch_get']
+        counts = self.db.get_counts('test_counter', self.keys, sharded=True)
+        self.assertTrue(self.db.db.calls['batch_get'] - calls <= 2 + 3)  # 150 indexes, at most 240 shards
+        self.assertEqual(counts, dict((key, self.db.get_count('test_counter', key, sharded=True)) for key in self.keys))
+        self.assertEqual(counts['counter10'], 11)
+        self.assertEqual(counts['counter130'], 0)
+
+    def test_not_sharded(self):
+        self.db.incr('test_counter', 'single', 3)
+        self.assertEqual(self.db.get_counts('test_counter', ['single', 'missing']), {'single': 3, 'missing': None})
+
+    def test_fixed_shards(self):
+        db = Datastore({'engine': 'memory', 'fixed_shard_counters': True})
+        db.create_table('test_counter')
+        db.incr('test_counter', 'a', 2, shard_count=3)
+        db.incr('test_counter', 'b', 5, shard_count=8)
+        counts = {'a': 2, 'b': 5, 'missing': 0}
+        self.assertEqual(db.get_counts('test_counter', counts.keys(), sharded=True), counts)
+        self.assertEqual(db.get_counts('test_counter', counts.keys(), sharded=True, shard_count=8), counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
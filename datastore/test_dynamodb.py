@@ -83,6 +83,25 @@ class TestDynamoDBTestCase(unittest.TestCase):
         self.db.delete_data('test_%Y%m%d', 'ky')
         self.assertEqual(self.db.get_data("test_%Y%m%d", "ky"), None)
 
+    def test_batch(self):
+        keys = [str(uuid4()) for _ in xrange(130)]
+        items = dict((key, {'n': i}) for i, key in enumerate(keys))
+        self.assertTrue(self.db.set_many('test', items))
+        results = self.db.get_many('test', keys + ['missing'])
+        self.assertEqual(len(results), 131)
+        self.assertEqual(results[keys[42]], {'n': 42})
+        self.assertEqual(results['missing'], None)
+        self.assertTrue(self.db.delete_many('test', keys))
+        self.assertEqual(self.db.get_many('test', keys[:3]), dict.fromkeys(keys[:3]))
+
+    def test_timesliced_batch(self):
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(1)
+        self.db.set_many("test_%Y%m%d", {"ky": "dy"}, transform_time=yesterday)
+        self.db.set_many("test_%Y%m%d", {"kt": "dt"})
+        self.assertEqual(self.db.get_many("test_%Y%m%d", ["ky", "kt"]), {"ky": "dy", "kt": "dt"})
+        self.db.delete_many('test_%Y%m%d', ['ky', 'kt'])
+        self.assertEqual(self.db.get_many("test_%Y%m%d", ["ky", "kt"]), {"ky": None, "kt": None})
+
 
 class TestDynamoDBCounterTestCase(unittest.TestCase):
 
@@ -168,5 +187,31 @@ class TestDynamoDBCounterTestCase(unittest.TestCase):
         self.db.delete_counter(table_name, key)
 
 
+class TestDynamoDBFixedShardCounterTestCase(unittest.TestCase):
+
+    """
+    Create table 'test_counter' and 'test_counter_shard_count' before you run this test
+    """
+
+    def setUp(self):
+        self.settings = dict(DB_SETTINGS['dynamodb'], fixed_shard_counters=True)
+        self.db = DynamoDB(self.settings)
+        self.db.create_table('test_counter', 5, 5)
+        self.db.create_table('test_counter_shard_count', 5, 5)
+
+    def test_shard_counter(self):
+        table_name = 'test_counter'
+        key = str(uuid4())
+        self.db.incr(table_name, key, 1, shard_count=10)
+        self.db.incr(table_name, key, 2, shard_count=10)
+        self.assertEqual(self.db.get_counter_shard_count(table_name, key), 10)
+        self.assertEqual(self.db.get_count(table_name, key, sharded=True), 3)
+        self.assertEqual(self.db.get_count(table_name, key, sharded=True, shard_count=10), 3)
+        self.db.incr(table_name, key, 3, shard_count=20)
+        self.assertEqual(DynamoDB(self.settings).get_count(table_name, key, sharded=True), 6)
+        self.db.delete_counter(table_name, key)
+        self.assertEqual(self.db.get_count(table_name, key, sharded=True), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,80 @@
+'''
+Tests for HyperLogLog distinct counters, runs without cloud credentials
+'''
+
+import datetime
+import unittest
+from api import Datastore
+from hyperloglog import HyperLogLog, HyperLogLogError
+import hyperloglog
+
+
+class TestHyperLogLogTestCase(unittest.TestCase):
+
+    def sketch(self, members, error_rate=0.01):
+        sketch = HyperLogLog(error_rate)
+        for member in members:
+            sketch.add(member)
+        return sketch
+
+    def test_count(self):
+        self.assertEqual(HyperLogLog().count(), 0)
+        self.assertEqual(self.sketch(['a', u'b', 3, 'a']).count(), 3)
+        for n in (1000, 50000):
+            self.assertAlmostEqual(self.sketch('member%s' % i for i in xrange(n)).count(), n, delta=n * 0.03)
+
+    def test_merge(self):
+        sketch = self.sketch('member%s' % i for i in xrange(20000))
+        other = self.sketch(('member%s' % i for i in xrange(10000, 30000)), error_rate=0.02)
+        self.assertTrue(sketch.update(other))
+        self.assertEqual(sketch.precision, other.precision)
+        self.assertAlmostEqual(sketch.count(), 30000, delta=30000 * 0.06)
+        self.assertFalse(sketch.update(self.sketch(['member1'])))
+
+    def test_dumps(self):
+        sketch = self.sketch('member%s' % i for i in xrange(1000))
+        loaded = HyperLogLog.loads(sketch.dumps())
+        self.assertEqual((loaded.precision, loaded.registers), (sketch.precision, sketch.registers))
+        self.assertEqual(hyperloglog.count_distinct([None, sketch.dumps(), None]), sketch.count())
+        self.assertRaises(HyperLogLogError, HyperLogLog.loads, 'value')
+        self.assertRaises(HyperLogLogError, HyperLogLog, 0)
+
+
+class TestMemoryStoreDistinctTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Datastore({'engine': 'memory', 'distinct_counters': {'error_rate': 0.02}})
+        self.db.create_table('test_distinct')
+
+    def test_add_and_count(self):
+        for i in xrange(0, 1000, 100):
+            self.db.add_distinct('test_distinct', 'visitors', ['user%s' % j for j in xrange(i, i + 200)], shard_count=4)
+        self.assertAlmostEqual(self.db.count_distinct('test_distinct', 'visitors', shard_count=4), 1100, delta=50)
+        self.assertEqual(self.db.count_distinct('test_distinct', 'missing', shard_count=4), 0)
+
+    def test_no_change(self):
+        self.db.add_distinct('test_distinct', 'visitors', ['user1', 'user2'])
+        calls = self.db.db.calls['put_item']
+        self.db.add_distinct('test_distinct', 'visitors', ['user2'])
+        self.assertEqual(self.db.db.calls['put_item'], calls)
+        self.assertEqual(self.db.count_distinct('test_distinct', 'visitors'), 2)
+
+    def test_time_slices(self):
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(1)
+        for transform_time in (None, yesterday):
+            self.db.create_table('test_distinct_%Y%m%d', transform_time=transform_time)
+        self.db.add_distinct('test_distinct_%Y%m%d', 'visitors', ['user1', 'user2'], transform_time=yesterday)
+        self.db.add_distinct('test_distinct_%Y%m%d', 'visitors', ['user2', 'user3'])
+        self.assertEqual(self.db.count_distinct('test_distinct_%Y%m%d', 'visitors'), 2)
+        self.assertEqual(self.db.count_distinct('test_distinct_%Y%m%d', 'visitors', lookback=1), 3)
+
+    def test_missing_current_slice(self):
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(1)
+        self.db.create_table('test_distinct_%Y%m%d', transform_time=yesterday)
+        self.db.add_distinct('test_distinct_%Y%m%d', 'visitors', ['user1', 'user2'], transform_time=yesterday)
+        self.assertEqual(self.db.count_distinct('test_distinct_%Y%m%d', 'visitors', lookback=1), 2)
+        self.assertEqual(self.db.count_distinct('test_distinct_%Y%m%d', 'visitors'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+'''
+Tests for the lifecycle of time sliced tables, runs without cloud credentials
+'''
+
+import gc
+import time
+import datetime
+import unittest
+import weakref
+from api import Datastore
+from dynamodb import DynamoDB
+from memory import MemoryStore
+from lifecycle import TableLifecycle
+
+NOW = datetime.datetime(2014, 3, 10, 23, 50)
+
+
+class TestTableLifecycleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryStore({'engine': 'memory'})
+        self.tables = {'events_%Y%m%d': {'ahead': 1, 'retention': 3,
+                                         'current': {'read': 50, 'write': 50},
+                                         'past': {'read': 5, 'write': 1}}}
+
+    def test_create_ahead(self):
+        lifecycle = TableLifecycle(self.db, self.tables, interval=0)
+        actions = lifecycle.run(NOW)
+        self.assertEqual(sorted(actions['created']), ['events_20140310', 'events_20140311'])
+        self.assertEqual(self.db.get_throughput('events_20140311'), {'read': 50, 'write': 50, 'status': 'ACTIVE'})
+        self.assertEqual(lifecycle.run(NOW), {'created': [], 'updated': [], 'deleted': [], 'failed': []})
+
+    def test_expire(self):
+        for day in ('20140301', '20140307', '20140308', '20140309'):
+            self.db.create_table('events_' + day, read=50, write=50)
+        self.db.create_table('other_20140301')
+        actions = TableLifecycle(self.db, self.tables, interval=0).run(NOW)
+        self.assertEqual(sorted(actions['deleted']), ['events_20140301', 'events_20140307'])
+        self.assertEqual(sorted(actions['updated']), ['events_20140308', 'events_20140309'])
+        self.assertEqual(self.db.get_throughput('events_20140309'), {'read': 5, 'write': 1, 'status': 'ACTIVE'})
+        self.assertTrue(self.db.get_table('other_20140301') is not None)
+
+    def test_failure(self):
+        db = self.db
+
+        class FailingStore(object):
+
+            def __getattr__(self, name):
+                return getattr(db, name)
+
+            def create_table(self, table_name, **kwargs):
+                if table_name == 'events_20140311':
+                    raise Exception('limit exceeded')
+                return db.create_table(table_name, **kwargs)
+
+        actions = TableLifecycle(FailingStore(), self.tables, interval=0).run(NOW)
+        self.assertEqual((actions['created'], actions['failed']), (['events_20140310'], ['events_20140311']))
+
+    def test_datastore(self):
+        store = Datastore({'engine': 'memory', 'table_lifecycle': {'tables': self.tables, 'interval': 60}})
+        store.close()
+        self.assertTrue(store.get_table(datetime.datetime.utcnow().strftime('events_%Y%m%d')) is not None)
+
+    def test_collected(self):
+        lifecycle = TableLifecycle(self.db, self.tables, interval=60)
+        ref = weakref.ref(lifecycle)  # the timer only holds it during a run
+        del lifecycle
+        for _ in xrange(100):
+            gc.collect()
+            if ref() is None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(ref())
+
+
+class TestDynamoDBTableRegistryTestCase(unittest.TestCase):
+
+    def test_bounded(self):
+        db = DynamoDB({'default_throughput': {}, 'max_cached_tables': 2,
+                       'aws_access_key_id': 'id', 'aws_secret_access_key': 'secret'})
+        first = db.get_table('t1')
+        db.get_table('t2')
+        self.assertTrue(db.get_table('t1') is first)
+        db.get_table('t3')
+        self.assertEqual(db._tables.keys(), ['t1', 't3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,268 @@
+'''
+Tests for the memory engine, runs without cloud credentials
+'''
+
+import time
+import datetime
+import unittest
+from api import Datastore
+from memory import MemoryStore, MemoryStoreError, MemoryStoreThrottled
+from test_config import SomeRecord
+from threading import Thread
+from uuid import uuid4
+
+MEMORY_SETTINGS = {'engine': 'memory'}
+
+
+class TestMemoryStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryStore(MEMORY_SETTINGS)
+        self.db.create_table('test')
+        self.db.create_table('test_%Y%m%d')
+        self.db.create_table('test_%Y%m%d', transform_time=datetime.datetime.utcnow() - datetime.timedelta(1))
+
+    def test_table(self):
+        self.assertEqual(self.db.get_table('test').table_name, 'test')
+        self.assertEqual(self.db.get_table('missing'), None)
+        self.assertRaises(MemoryStoreError, self.db.set_data, 'missing', 'k', 'v')
+        self.assertTrue(self.db.delete_table('test'))
+        self.assertEqual(self.db.get_table('test'), None)
+
+    def test_create_delete_data(self):
+        self.assertTrue(self.db.set_data('test', 'k', 'v'))
+        self.assertEqual(self.db.get_data('test', 'k'), 'v')
+
+        c = SomeRecord()
+        self.db.set_data('test', c.key, c)
+        new_c = self.db.get_data('test', c.key)
+        self.assertEqual((new_c.key, new_c.answer, new_c.number), (c.key, c.answer, c.number))
+
+        self.db.set_data('test', 'k2', set(['a', 'b']), pickled=False)
+        self.assertEqual(self.db.get_data('test', 'k2', pickled=False), set(['a', 'b']))
+        self.assertRaises(MemoryStoreError, self.db.set_data, 'test', 'k2', 1, overwrite=False)
+
+        self.assertTrue(self.db.delete_data('test', 'k'))
+        self.assertFalse(self.db.delete_data('test', 'k'))
+        self.assertEqual(self.db.get_data('test', 'k'), None)
+
+    def test_timesliced_table(self):
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(1)
+        self.db.set_data("test_%Y%m%d", "ky", "dy", transform_time=yesterday)
+        self.assertEqual(self.db.get_data("test_%Y%m%d", "ky"), "dy")
+        self.assertEqual(self.db.get_data("test_%Y%m%d", "ky", timedelta_slice=0), None)
+        self.db.delete_data('test_%Y%m%d', 'ky')
+        self.assertEqual(self.db.get_data("test_%Y%m%d", "ky"), None)
+
+    def test_batch(self):
+        keys = [str(uuid4()) for _ in xrange(130)]
+        self.db.set_many('test', dict((key, {'n': i}) for i, key in enumerate(keys)))
+        results = self.db.get_many('test', keys + ['missing'])
+        self.assertEqual(results[keys[42]], {'n': 42})
+        self.assertEqual(results['missing'], None)
+        self.db.delete_many('test', keys)
+        self.assertEqual(self.db.get_many('test', keys[:3]), dict.fromkeys(keys[:3]))
+
+    def test_codec(self):
+        db = MemoryStore({'engine': 'memory', 'table_codecs': {'test': {'codec': 'json'}}})
+        db.create_table('test')
+        db._tables['test'].items['old'] = self.db._encode_data('other', {'n': 1}, True)
+        db.set_data('test', 'new', {'n': 2})
+        self.assertEqual(db.get_many('test', ['old', 'new']), {'old': {'n': 1}, 'new': {'n': 2}})
+        self.assertEqual(db._tables['test'].items['new'][6:], '{"n":2}')
+
+    def test_latency(self):
+        db = MemoryStore({'engine': 'memory', 'latency': 0.02})
+        db.create_table('test')
+        start = time.time()
+        db.get_data('test', 'k')
+        self.assertTrue(time.time() - start >= 0.02)
+
+    def test_throttle(self):
+        db = MemoryStore({'engine': 'memory', 'throttle': True})
+        db.create_table('test', read=1, write=1)
+        db.get_data('test', 'k')
+        db.get_data('test', 'k')
+        self.assertRaises(MemoryStoreThrottled, db.get_data, 'test', 'k')
+        self.assertEqual(db.calls['throttled'], 1)
+
+
+class TestMemoryStoreTimeSliceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.days = [datetime.datetime.utcnow() - datetime.timedelta(i) for i in xrange(3)]
+
+    def create_store(self, time_slices):
+        db = MemoryStore({'engine': 'memory', 'time_slices': time_slices})
+        for day in self.days:
+            db.create_table('test_%Y%m%d', transform_time=day)
+        return db
+
+    def test_lookback(self):
+        db = self.create_store({'lookback': 2, 'parallel': True})
+        db.set_data('test_%Y%m%d', 'k', 'old', transform_time=self.days[2])
+        self.assertEqual(db.get_data('test_%Y%m%d', 'k'), 'old')
+        self.assertEqual(db.get_data('test_%Y%m%d', 'k', lookback=1), None)
+        db.set_data('test_%Y%m%d', 'k', 'new', transform_time=self.days[1])
+        self.assertEqual(db.get_data('test_%Y%m%d', 'k'), 'new')
+        self.assertTrue(db.delete_data('test_%Y%m%d', 'k'))
+        self.assertEqual(db.get_data('test_%Y%m%d', 'k'), 'old')
+
+    def test_negative_cache(self):
+        db = self.create_store({'lookback': 2, 'negative_cache': {'ttl': 60}})
+        self.assertEqual(db.get_data('test_%Y%m%d', 'k'), None)
+        db.calls.clear()
+        self.assertEqual(db.get_data('test_%Y%m%d', 'k'), None)
+        self.assertEqual(db.calls['get_item'], 1)  # only the current slice
+        db.set_data('test_%Y%m%d', 'k', 'v', transform_time=self.days[1])
+        self.assertEqual(db.get_data('test_%Y%m%d', 'k'), 'v')
+
+    def test_negative_cache_per_kind(self):
+        db = self.create_store({'lookback': 1, 'negative_cache': {'ttl': 60}})
+        db.incr(self.days[1].strftime('test_%Y%m%d'), 'counter', 3)
+        self.assertEqual(db.get_data('test_%Y%m%d', 'counter'), None)  # no value, only a counter
+        self.assertEqual(db.get_count('test_%Y%m%d', 'counter', lookback=1), 3)
+        self.assertEqual(db.get_count('test_%Y%m%d', 'other', lookback=1), None)
+        db.incr(self.days[1].strftime('test_%Y%m%d'), 'other')
+        self.assertEqual(db.get_count('test_%Y%m%d', 'other', lookback=1), 1)
+
+    def test_count_lookback(self):
+        db = self.create_store({})
+        db.create_table('test_counter_%Y%m%d', transform_time=self.days[1])
+        db.create_table('test_counter_%Y%m%d')
+        db.incr(self.days[1].strftime('test_counter_%Y%m%d'), 'k')
+        self.assertEqual(db.get_count('test_counter_%Y%m%d', 'k'), None)
+        self.assertEqual(db.get_count('test_counter_%Y%m%d', 'k', lookback=1), 1)
+        self.assertEqual(db.get_count('test_counter_%Y%m%d', 'k', sharded=True, lookback=1), 1)
+
+
+class TestMemoryStoreCounterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryStore(MEMORY_SETTINGS)
+        self.db.create_table('test_counter')
+        self.db.create_table('test_counter_%Y%m%d')
+
+    def test_incr(self):
+        key = str(uuid4())
+        self.assertEqual(self.db.get_count('test_counter', key), None)
+        self.db.incr('test_counter', key)
+        self.assertEqual(self.db.get_count('test_counter', key), 1)
+        self.db.incr('test_counter', key, 2)
+        self.db.incr('test_counter', key, -1)
+        self.assertEqual(self.db.get_count('test_counter', key), 2)
+        self.db.incr('test_counter_%Y%m%d', key)
+        self.assertEqual(self.db.get_count('test_counter_%Y%m%d', key), 1)
+        self.db.delete_counter('test_counter', key)
+        self.assertEqual(self.db.get_count('test_counter', key), None)
+
+    def test_multithread_shard_counter(self):
+        count = 50
+        key = str(uuid4())
+
+        def incr_counter():
+            self.db.incr('test_counter', key, shard_count=60)
+
+        threadlist = [Thread(target=incr_counter) for _ in xrange(count)]
+        for t in threadlist:
+            t.start()
+        for t in threadlist:
+            t.join(60)
+
+        self.assertEqual(self.db.get_count('test_counter', key, sharded=True), count)
+        self.db.delete_counter('test_counter', key)
+        self.assertEqual(self.db.get_count('test_counter', key, sharded=True), 0)
+
+
+class TestMemoryStoreFixedShardCounterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryStore({'engine': 'memory', 'fixed_shard_counters': True})
+        self.db.create_table('test_counter')
+
+    def test_incr_single_call(self):
+        key = str(uuid4())
+        self.db.incr('test_counter', key, shard_count=10)
+        self.db.calls.clear()
+        for _ in xrange(20):
+            self.db.incr('test_counter', key, shard_count=10)
+        self.assertEqual(dict(self.db.calls), {'update_item': 20})
+        self.assertEqual(self.db.get_count('test_counter', key, sharded=True), 21)
+        self.assertEqual(self.db.calls['batch_get'], 1)
+
+    def test_shard_count_grows(self):
+        key = str(uuid4())
+        self.db.incr('test_counter', key, shard_count=2)
+        self.db.incr('test_counter', key, 5, shard_count=20)
+        self.db.incr('test_counter', key, shard_count=4)
+        reader = MemoryStore({'engine': 'memory', 'fixed_shard_counters': True})
+        reader._tables = self.db._tables
+        self.assertEqual(reader.get_count('test_counter', key, sharded=True), 7)
+        self.assertEqual(reader.get_count('test_counter', key, sharded=True, shard_count=20), 7)
+        self.db.delete_counter('test_counter', key)
+        self.assertEqual(reader.get_count('test_counter', key, sharded=True), 0)
+
+
+class TestMemoryStoreAdaptiveShardCounterTestCase(unittest.TestCase):
+
+    def test_hot_counter_grows(self):
+        db = MemoryStore({'engine': 'memory', 'hot_key_throughput': 5,
+                          'adaptive_shard_counters': {'max_shards': 16, 'grow_threshold': 2}})
+        db.create_table('test_counter')
+        key = str(uuid4())
+        done = 0
+        for _ in xrange(100):
+            try:
+                db.incr('test_counter', key)
+                done += 1
+            except MemoryStoreThrottled:
+                pass
+        self.assertTrue(db.adaptive.shard_count('test_counter', key) > 1)
+        self.assertEqual(db.get_count('test_counter', key, sharded=True), done)
+        self.assertEqual(db.get_count('test_counter', key), done)
+        self.assertEqual(db.get_counts('test_counter', [key]), {key: done})
+
+
+class TestMemoryDatastoreTestCase(unittest.TestCase):
+
+    def test_get_and_set(self):
+        db = Datastore({'engine': 'memory', 'cache': {'ttl': 60}})
+        db.create_table('test')
+        db.set_data('test', 'k', 'value')
+        self.assertEqual(db.get_data('test', 'k'), 'value')
+        self.assertEqual(db.get_data('test', 'k'), 'value')
+        self.assertEqual(db.db.calls['get_item'], 1)
+        db.set_data('test', 'k', 'new value')
+        self.assertEqual(db.get_data('test', 'k'), 'new value')
+        self.assertEqual(db.cache_stats()['hits'], 1)
+
+    def test_cache_read_racing_write(self):
+        db = Datastore({'engine': 'memory', 'cache': {'ttl': 60}})
+        db.create_table('test')
+        db.set_data('test', 'k', 'old')
+        get_data = db.db.get_data
+
+        def racing_get_data(table_name, key):
+            data = get_data(table_name, key)
+            db.set_data(table_name, key, 'new')  # after the read, before the value is cached
+            return data
+
+        db.db.get_data = racing_get_data
+        self.assertEqual(db.get_data('test', 'k'), 'old')
+        db.db.get_data = get_data
+        self.assertEqual(db.get_data('test', 'k'), 'new')
+
+    def test_buffered_counter(self):
+        db = Datastore({'engine': 'memory', 'incr_buffer': {'interval': 0}})
+        db.create_table('test_counter')
+        for _ in xrange(10):
+            db.incr('test_counter', 'k')
+        self.assertEqual(db.get_count('test_counter', 'k'), None)
+        db.flush()
+        self.assertEqual(db.get_count('test_counter', 'k'), 10)
+        self.assertEqual(db.db.calls['update_item'], 1)
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+'''
+Tests for operation metrics, runs without cloud credentials
+'''
+
+import unittest
+from api import Datastore
+from memory import MemoryStoreThrottled
+from metrics import Metrics
+
+
+class TestMetricsTestCase(unittest.TestCase):
+
+    def test_record(self):
+        metrics = Metrics(buckets=[0.01, 0.1])
+        metrics.record('get_data', 't', 0.005, backend_calls=1)
+        metrics.record('get_data', 't', 0.05, backend_calls=2)
+        metrics.record('get_data', 't', 1, error=True, throttles=1, retries=3, backend_calls=4)
+        stats = metrics.stats()['get_data']['t']
+        self.assertEqual((stats['count'], stats['errors'], stats['throttles'], stats['retries']), (3, 1, 1, 3))
+        self.assertEqual(stats['backend_calls_per_op'], 7 / 3.0)
+        self.assertEqual(stats['histogram'], [(0.01, 1), (0.1, 1), (None, 1)])
+        self.assertEqual((stats['p50'], stats['p99']), (0.1, None))
+
+    def test_measure(self):
+        metrics = Metrics()
+
+        def inner():
+            metrics.backend_call()
+            metrics.retried()
+
+        def outer():
+            metrics.backend_call()
+            metrics.measure('inner', 't', inner)
+
+        metrics.measure('outer', 't', outer)
+        self.assertRaises(MemoryStoreThrottled, metrics.measure, 'fail', None, self._throttled)
+        stats = metrics.stats()
+        self.assertEqual((stats['inner']['t']['backend_calls'], stats['inner']['t']['retries']), (1, 1))
+        self.assertEqual((stats['outer']['t']['backend_calls'], stats['outer']['t']['retries']), (2, 1))
+        self.assertEqual((stats['fail'][None]['errors'], stats['fail'][None]['throttles']), (1, 1))
+
+    def _throttled(self):
+        raise MemoryStoreThrottled('slow down')
+
+    def test_sink(self):
+        events = []
+
+        def broken(*args):
+            raise ValueError('broken sink')
+
+        metrics = Metrics(sinks=[broken, lambda *args: events.append(args)])
+        metrics.record('incr', 't', 0.5, retries=2)
+        self.assertEqual(events, [('incr', 't', 0.5, {'error': False, 'throttles': 0,
+                                                      'retries': 2, 'backend_calls': 0})])
+
+    def test_prometheus_text(self):
+        metrics = Metrics(buckets=[0.1])
+        metrics.record('get_data', 't"x', 0.05)
+        metrics.record('get_data', 't"x', 0.5)
+        text = metrics.prometheus_text()
+        self.assertTrue('datastore_operations_total{operation="get_data",table="t\\"x"} 2\n' in text)
+        self.assertTrue('datastore_latency_seconds_bucket{operation="get_data",table="t\\"x",le="0.1"} 1\n' in text)
+        self.assertTrue('datastore_latency_seconds_bucket{operation="get_data",table="t\\"x",le="+Inf"} 2\n' in text)
+
+
+class TestDatastoreMetricsTestCase(unittest.TestCase):
+
+    def test_backend_calls(self):
+        db = Datastore({'engine': 'memory', 'metrics': True, 'cache': {'ttl': 60}})
+        db.create_table('test')
+        db.create_table('test_counter')
+        db.set_data('test', 'k', 'v')
+        db.get_data('test', 'k')
+        db.get_data('test', 'k')
+        for _ in xrange(10):
+            db.incr('test_counter', 'k', shard_count=5)
+        db.get_count('test_counter', 'k', sharded=True)
+
+        stats = db.stats()
+        self.assertEqual(stats['get_data']['test']['count'], 2)
+        self.assertEqual(stats['get_data']['test']['backend_calls'], 1)  # the second one was cached
+        self.assertEqual(stats['incr']['test_counter']['count'], 10)
+        self.assertEqual(stats['get_count']['test_counter']['backend_calls'],
+                         db.db.calls['get_index'] + db.db.calls['batch_get'])
+        self.assertTrue('create_table' in stats)
+        self.assertEqual(Datastore({'engine': 'memory'}).stats(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
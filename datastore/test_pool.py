@@ -0,0 +1,124 @@
+'''
+Tests for the client pool, runs without cloud credentials
+'''
+
+import gc
+import time
+import weakref
+import threading
+import unittest
+from pool import ClientPool, ClientProxy, ClientPoolError
+
+
+class Client(object):
+
+    def __init__(self):
+        self.setups = []
+
+    def whoami(self):
+        return self
+
+
+class TestClientPoolTestCase(unittest.TestCase):
+
+    def run_thread(self, func):
+        result = []
+
+        def target():
+            try:
+                result.append(func())
+            except Exception as e:
+                result.append(e)
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+        if isinstance(result[0], Exception):
+            raise result[0]
+        return result[0]
+
+    def wait_idle(self, pool, idle):
+        """
+        a finished thread gives its client back once its locals are cleared,
+        which may be after join returns
+        """
+        deadline = time.time() + 1
+        while pool.stats()['idle'] < idle and time.time() < deadline:
+            time.sleep(0.001)
+
+    def test_per_thread(self):
+        pool = ClientPool(Client)
+        client = pool.get()
+        self.assertTrue(pool.get() is client)
+        other = []
+
+        def hold():
+            other.append(pool.get())
+            other.append(pool.get())
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        thread.join()
+        self.assertTrue(other[0] is other[1])
+        self.assertTrue(other[0] is not client)
+
+    def test_reuse_after_thread(self):
+        pool = ClientPool(Client)
+        first = self.run_thread(pool.get)
+        self.wait_idle(pool, 1)
+        self.assertTrue(self.run_thread(pool.get) is first)
+        self.wait_idle(pool, 1)
+        self.assertEqual(pool.stats(), {'size': None, 'created': 1, 'idle': 1})
+
+    def test_release(self):
+        pool = ClientPool(Client, size=1, timeout=0)
+        client = pool.get()
+        self.assertRaises(ClientPoolError, self.run_thread, pool.get)
+        pool.release()
+        self.assertTrue(self.run_thread(pool.get) is client)
+
+    def test_setup(self):
+        pool = ClientPool(Client)
+        client = pool.get()
+        pool.setup(lambda c: c.setups.append('metrics'))
+        self.assertEqual(client.setups, ['metrics'])
+        self.assertEqual(self.run_thread(pool.get).setups, ['metrics'])
+
+    def test_factory_failure(self):
+        def factory():
+            raise ValueError('no credentials')
+
+        pool = ClientPool(factory, size=1, timeout=0)
+        self.assertRaises(ValueError, pool.get)
+        self.assertRaises(ValueError, pool.get)  # the failed client doesn't count
+        self.assertEqual(pool.stats()['created'], 0)
+
+    def test_collected(self):
+        class Engine(object):  # holds its pool, which holds its _connect
+
+            def __init__(self):
+                self.clients = ClientPool(self._connect)
+
+            def _connect(self):
+                return Client()
+
+        gc.collect()
+        engine = Engine()
+        engine.clients.get()
+        self.run_thread(engine.clients.get)
+        self.wait_idle(engine.clients, 1)
+        pool = weakref.ref(engine.clients)
+        del engine  # this thread still holds its lease
+        gc.collect()
+        self.assertIsNone(pool())
+        self.assertEqual(gc.garbage, [])
+
+    def test_proxy(self):
+        pool = ClientPool(Client)
+        proxy = ClientProxy(pool)
+        self.assertTrue(proxy.whoami() is pool.get())
+        self.assertTrue(self.run_thread(lambda: proxy.whoami()) is not pool.get())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+'''
+Tests for the replicated engine, runs without cloud credentials
+'''
+
+import gc
+import time
+import unittest
+import weakref
+from api import Datastore, create_engine
+from replicated import ReplicatedStore, ReplicatedStoreError
+
+
+class TestReplicatedStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Datastore({'engine': 'replicated',
+                             'primary': {'engine': 'memory'},
+                             'secondary': {'engine': 'memory'},
+                             'hedge_delay': 0.01,
+                             'retry': {'max_retries': 2, 'base_backoff': 0.001}})
+        self.db.create_table('test_table')
+        self.engine = self.db.db
+
+    def tearDown(self):
+        self.engine.close()
+
+    def test_replicate(self):
+        self.db.set_data('test_table', 'key', {'a': 1})
+        self.db.set_many('test_table', {'key1': 1, 'key2': 2})
+        self.db.incr('test_table', 'counter', 3)
+        self.db.cas('test_table', 'versioned', None, 'first')
+        self.db.update_if('test_table', 'versioned', lambda value: value + ' second')
+        self.assertTrue(self.engine.drain(5))
+        secondary = self.engine.secondary
+        self.assertEqual(secondary.get_data('test_table', 'key'), {'a': 1})
+        self.assertEqual(secondary.get_many('test_table', ['key1', 'key2']), {'key1': 1, 'key2': 2})
+        self.assertEqual(secondary.get_count('test_table', 'counter'), 3)
+        self.assertEqual(secondary.get_data('test_table', 'versioned'), 'first second')
+        stats = self.engine.replication_stats()
+        self.assertEqual((stats['queued'], stats['replicated'], stats['pending']), (6, 6, 0))
+
+    def test_key_order(self):
+        db = Datastore({'engine': 'replicated', 'primary': {'engine': 'memory'}, 'secondary': {'engine': 'memory'},
+                        'replication_workers': 4})
+        db.create_table('test_table')
+        for i in xrange(200):
+            db.set_data('test_table', 'key%s' % (i % 5), i)
+        db.set_many('test_table', dict(('many%s' % i, i) for i in xrange(20)))
+        db.delete_many('test_table', ['many%s' % i for i in xrange(10)])
+        self.assertTrue(db.db.drain(5))
+        secondary = db.db.secondary
+        self.assertEqual(secondary.get_many('test_table', ['key%s' % i for i in xrange(5)]),
+                         dict(('key%s' % i, 195 + i) for i in xrange(5)))
+        self.assertEqual(dict(secondary.scan('test_table')),
+                         dict(dict(('key%s' % i, 195 + i) for i in xrange(5)),
+                              **dict(('many%s' % i, i) for i in xrange(10, 20))))
+        db.db.close()
+
+    def test_set_data_args(self):
+        self.db.cas('test_table', 'raw', None, 'bytes', pickled=False)
+        self.db.update_if('test_table', 'raw', lambda value: value + ' more', pickled=False)
+        self.engine.drain(5)
+        self.assertEqual(self.engine.secondary.get_data('test_table', 'raw', pickled=False), 'bytes more')
+
+    def test_not_retried(self):
+        secondary = self.engine.secondary
+        incr = secondary.incr
+
+        def applied_then_failed(*args, **kwargs):
+            incr(*args, **kwargs)
+            raise IOError('timed out')
+
+        secondary.incr = applied_then_failed
+        self.db.incr('test_table', 'counter', 3)
+        self.engine.drain(5)
+        self.assertEqual(secondary.get_count('test_table', 'counter'), 3)
+        self.assertEqual(self.engine.replication_stats()['failed'], 1)
+
+    def test_collected(self):
+        engine = ReplicatedStore({'primary': {'engine': 'memory'}, 'secondary': {'engine': 'memory'}}, create_engine)
+        ref = weakref.ref(engine)  # neither the workers nor the exit hook keep it
+        del engine
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_hedged_read(self):
+        self.db.set_data('test_table', 'key', 'value')
+        self.engine.drain(5)
+        self.engine.primary.latency = 0.5
+        start = time.time()
+        self.assertEqual(self.db.get_data('test_table', 'key'), 'value')
+        self.assertTrue(time.time() - start < 0.3)
+        self.assertEqual(self.engine.replication_stats()['secondary_answers'], 1)
+        self.engine.primary.latency = 0
+        self.assertEqual(self.db.get_data('test_table', 'key'), 'value')
+        self.assertEqual(self.engine.replication_stats()['hedged'], 1)
+
+    def test_failures(self):
+        self.engine.primary.create_table('primary_only')
+        self.db.set_data('primary_only', 'key', 'value')  # the secondary has no such table
+        self.engine.drain(5)
+        self.assertEqual(self.engine.replication_stats()['failed'], 1)
+        self.assertEqual(self.db.get_data('primary_only', 'key'), 'value')
+        self.engine.secondary.create_table('secondary_only')
+        self.engine.secondary.set_data('secondary_only', 'key', 'value')
+        self.assertEqual(self.db.get_data('secondary_only', 'key'), 'value')  # the primary fails
+        self.assertRaises(Exception, self.db.get_data, 'missing', 'key')
+        self.assertRaises(ReplicatedStoreError, Datastore, {'engine': 'replicated', 'primary': {'engine': 'memory'}})
+
+
+if __name__ == '__main__':
+    unittest.main()
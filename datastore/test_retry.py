@@ -0,0 +1,85 @@
+'''
+Tests for the retry policy, runs without cloud credentials
+'''
+
+import time
+import unittest
+from retry import RetryPolicy, RetryBudget, RetryError, full_jitter_backoff
+from azuretable import exponential_backoff_waiting_time
+
+
+class TestBackoffTestCase(unittest.TestCase):
+
+    def test_full_jitter(self):
+        for retries in xrange(1, 10):
+            cap = min(60, 0.05 * 2 ** (retries - 1))
+            waits = [full_jitter_backoff(retries) for _ in xrange(100)]
+            self.assertTrue(all(0 <= wait <= cap for wait in waits))
+        self.assertTrue(max(full_jitter_backoff(8) for _ in xrange(100)) > 0.05 * 2 ** 5)
+        self.assertTrue(full_jitter_backoff(1000) <= 60)
+
+    def test_azure_backoff_grows(self):
+        self.assertTrue(max(exponential_backoff_waiting_time(10) for _ in xrange(100)) > 1)
+
+
+class TestRetryPolicyTestCase(unittest.TestCase):
+
+    def test_attempts(self):
+        policy = RetryPolicy(max_retries=3, base_backoff=0.001, budget=False)
+        attempts = []
+
+        def call():
+            for attempt in policy.attempts('op'):
+                attempts.append(attempt)
+                if attempt == 2:
+                    return 'done'
+
+        self.assertEqual(call(), 'done')
+        self.assertEqual(attempts, [0, 1, 2])
+        self.assertEqual(policy.last_retries(), 2)
+        self.assertEqual(policy.stats(), {'op': {'calls': 1, 'retries': 2, 'gave_up': 0}})
+
+    def test_max_retries(self):
+        policy = RetryPolicy(max_retries=3, base_backoff=0.001, budget=False)
+
+        def fail():
+            for _ in policy.attempts('op'):
+                pass
+
+        self.assertRaises(RetryError, fail)
+        self.assertEqual(policy.last_retries(), 3)
+        self.assertEqual(policy.stats()['op']['gave_up'], 1)
+
+    def test_deadline(self):
+        policy = RetryPolicy(max_retries=100, base_backoff=0.01, max_backoff=0.01, deadline=0.05, budget=False)
+        start = time.time()
+        with self.assertRaises(RetryError):
+            for _ in policy.attempts('op'):
+                pass
+        self.assertTrue(time.time() - start < 0.1)
+
+    def test_budget(self):
+        budget = RetryBudget(ratio=0.5, min_per_second=0)
+        policy = RetryPolicy(max_retries=100, base_backoff=0, budget=budget)
+        for _ in xrange(4):
+            for attempt in policy.attempts('ok'):
+                break
+        retries = []
+        with self.assertRaises(RetryError):
+            for attempt in policy.attempts('op'):
+                retries.append(attempt)
+        # 4 calls of ok and 1 of op deposited 2.5 retries
+        self.assertEqual(retries, [0, 1, 2])
+        self.assertEqual(budget.rejected, 1)
+
+    def test_budget_reserve(self):
+        budget = RetryBudget(ratio=0, min_per_second=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        time.sleep(0.6)
+        self.assertTrue(budget.withdraw())
+
+
+if __name__ == '__main__':
+    unittest.main()
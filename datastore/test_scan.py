@@ -0,0 +1,111 @@
+'''
+Tests for streaming scans, runs without cloud credentials
+'''
+
+import time
+import pickle
+import itertools
+import unittest
+from decimal import Decimal
+from api import Datastore
+from dynamodb import DynamoDB
+from scan import scan_pages, RateLimiter, ScanError
+
+
+class TestScanPagesTestCase(unittest.TestCase):
+
+    def fetch(self, segment, start):
+        """
+        segment s holds 10 * s .. 10 * s + 9, pages of 3
+        """
+        start = 10 * segment if start is None else start
+        end = min(start + 3, 10 * segment + 10)
+        return range(start, end), end if end < 10 * segment + 10 else None, end - start
+
+    def test_sequential(self):
+        checkpoint = {}
+        self.assertEqual(list(scan_pages(self.fetch, checkpoint=checkpoint)), range(10))
+        self.assertEqual(checkpoint, {'segments': 1, '0': 'done'})
+
+    def test_parallel(self):
+        self.assertEqual(sorted(scan_pages(self.fetch, segments=4)), range(40))
+
+    def test_resume(self):
+        checkpoint = {}
+        scan = scan_pages(self.fetch, segments=4, checkpoint=checkpoint)
+        first = list(itertools.islice(scan, 20))
+        scan.close()
+        rest = list(scan_pages(self.fetch, segments=4, checkpoint=checkpoint))
+        self.assertEqual(sorted(set(first + rest)), range(40))
+        self.assertTrue(len(first) + len(rest) < 40 + 4 * 3)  # only cut pages again
+        self.assertRaises(ScanError, scan_pages, self.fetch, 2, checkpoint)
+
+    def test_error(self):
+        def fetch(segment, start):
+            if segment == 1:
+                raise ValueError('table is gone')
+            return self.fetch(segment, start)
+
+        self.assertRaises(ValueError, list, scan_pages(fetch, segments=2))
+
+    def test_rate_limit(self):
+        limiter = RateLimiter(100)
+        limiter.take(105)
+        started = time.time()
+        limiter.wait()
+        self.assertTrue(time.time() - started >= 0.05)
+
+
+class TestMemoryStoreScanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Datastore({'engine': 'memory'})
+        self.db.create_table('test_scan')
+        self.items = dict(('key%03d' % i, {'i': i}) for i in xrange(250))
+        self.db.set_many('test_scan', self.items)
+
+    def test_scan(self):
+        self.assertEqual(dict(self.db.scan('test_scan')), self.items)
+        self.assertEqual(dict(self.db.scan('test_scan', segments=4, page_size=7)), self.items)
+
+    def test_keys_only(self):
+        self.assertEqual(dict(self.db.scan('test_scan', keys_only=True)), dict.fromkeys(self.items))
+
+    def test_resume(self):
+        checkpoint = {}
+        scan = self.db.scan('test_scan', segments=3, page_size=10, checkpoint=checkpoint)
+        first = dict(itertools.islice(scan, 100))
+        scan.close()
+        first.update(self.db.scan('test_scan', segments=3, page_size=10, checkpoint=checkpoint))
+        self.assertEqual(first, self.items)
+
+    def test_counters(self):
+        self.db.create_table('test_scan_counter')
+        self.db.incr('test_scan_counter', 'a', 3)
+        self.db.incr('test_scan_counter', 'b')
+        self.assertEqual(dict(self.db.scan('test_scan_counter')), {'a_shard_1': 3, 'b_shard_1': 1})
+
+
+class FakeScanConnection(object):
+
+    def __init__(self, items):
+        self.items = items
+
+    def scan(self, table_name, **kwargs):
+        return {'Items': self.items, 'ConsumedCapacity': {'CapacityUnits': 1}}
+
+
+class TestDynamoDBScanTestCase(unittest.TestCase):
+
+    def test_attribute_types(self):
+        db = DynamoDB({'default_throughput': {}, 'aws_access_key_id': 'id', 'aws_secret_access_key': 'secret'})
+        db.conn = FakeScanConnection([{'key': {'S': 'pickled'}, 'data': {'S': pickle.dumps({'i': 1})}},
+                                      {'key': {'S': 'counter_shard_1'}, 'data': {'N': '5'}},
+                                      {'key': {'S': 'index'}, 'data': {'SS': ['counter_shard_1']}},
+                                      {'key': {'S': 'plain'}, 'data': {'S': 'not pickled'}}])
+        self.assertEqual(dict(db.scan('test_scan')), {'pickled': {'i': 1}, 'counter_shard_1': Decimal(5),
+                                                      'index': set(['counter_shard_1']), 'plain': 'not pickled'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+'''
+Tests for top-K counters, runs without cloud credentials
+'''
+
+import gc
+import random
+import unittest
+import weakref
+from api import Datastore
+from topk import SpaceSaving, TopKTracker, TopKError
+
+
+class TestSpaceSavingTestCase(unittest.TestCase):
+
+    def stream(self, seed):
+        rand = random.Random(seed)
+        for _ in xrange(20000):
+            yield 'key%s' % int(rand.paretovariate(1.2))
+
+    def test_heavy_hitters(self):
+        summary = SpaceSaving(50)
+        exact = {}
+        for key in self.stream(1):
+            summary.offer(key)
+            exact[key] = exact.get(key, 0) + 1
+        top = summary.top(5)
+        self.assertEqual([key for key, _ in top], sorted(exact, key=exact.get, reverse=True)[:5])
+        for key, count in top:
+            self.assertTrue(exact[key] <= count <= exact[key] + summary.errors[key])
+        self.assertEqual(len(summary.counts), 50)
+
+    def test_update(self):
+        first, second = SpaceSaving(50), SpaceSaving(50)
+        for key in self.stream(1):
+            first.offer(key)
+        for key in self.stream(2):
+            second.offer(key)
+        top = dict(first.top(3))
+        first.update(second)
+        self.assertEqual(len(first.counts), 50)
+        self.assertEqual(set(dict(first.top(3))), set(top))
+        self.assertTrue(first.top(1)[0][1] > top['key1'])
+
+    def test_dumps(self):
+        summary = SpaceSaving(3)
+        for key, amount in (('a', 5), ('b', 2), ('c', 1), ('d', 1)):
+            summary.offer(key, amount)
+        self.assertEqual(summary.top(2), [('a', 5), ('b', 2)])
+        self.assertEqual(summary.counts['d'], 2)  # took over the count of 'c'
+        loaded = SpaceSaving.loads(summary.dumps())
+        self.assertEqual((loaded.counts, loaded.errors), (summary.counts, summary.errors))
+        loaded.offer('e')
+        self.assertEqual(len(loaded.counts), 3)
+        self.assertRaises(TopKError, SpaceSaving.loads, '{}')
+
+
+class TestMemoryStoreTopKTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Datastore({'engine': 'memory', 'top_k': {'tables': ['test_counter'], 'interval': 0}})
+        self.db.create_table('test_counter')
+        self.db.create_table('test_other')
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_top_k(self):
+        for i in xrange(10):
+            self.db.incr('test_counter', 'key%s' % i, amount=i + 1)
+            self.db.incr('test_other', 'key%s' % i)
+        self.assertEqual(self.db.top_k('test_counter', 3), [])
+        self.db.flush()
+        self.assertEqual(self.db.top_k('test_counter', 3), [('key9', 10), ('key8', 9), ('key7', 8)])
+        self.assertEqual(self.db.top_k('test_other', 3), [])
+        self.assertEqual(self.db.get_count('test_counter', 'key9'), 10)
+
+    def test_processes(self):
+        other = TopKTracker(self.db.db, interval=0)  # another process on the same table
+        self.db.incr('test_counter', 'a', 5)
+        other.offer('test_counter', 'a', 2)
+        other.offer('test_counter', 'b', 4)
+        self.db.flush()
+        other.close()
+        self.assertEqual(self.db.top_k('test_counter', 2), [('a', 7), ('b', 4)])
+
+    def test_collected(self):
+        tracker = TopKTracker(self.db.db, interval=60)
+        ref = weakref.ref(tracker)  # neither the timer nor the exit hook keep it
+        del tracker
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+'''
+Tests for table export and import, runs without cloud credentials
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from api import Datastore
+from transfer import TransferError
+
+
+class TestTransferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'export')
+        self.source = Datastore({'engine': 'memory'})
+        self.source.create_table('test_source')
+        self.items = dict(('key%03d' % i, {'i': i, 'name': 'item %s' % i}) for i in xrange(120))
+        self.source.set_many('test_source', self.items)
+        self.target = Datastore({'engine': 'memory'})
+        self.target.create_table('test_target')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def copied(self):
+        return self.target.get_many('test_target', self.items.keys())
+
+    def test_binary(self):
+        self.assertEqual(self.source.export_table('test_source', self.path, segments=3, page_size=10), 120)
+        self.assertEqual(self.target.import_table('test_target', self.path, batch_size=25, workers=3), 120)
+        self.assertEqual(self.copied(), self.items)
+
+    def test_jsonl(self):
+        self.source.export_table('test_source', self.path, file_format='jsonl')
+        self.target.import_table('test_target', self.path)
+        copied = self.copied()
+        self.assertEqual(copied['key007'], {'i': 7, 'name': 'item 7'})
+        self.assertEqual(len(copied), 120)
+
+    def test_jsonl_values(self):
+        self.source.set_data('test_source', 'key000', set([1]))
+        self.assertRaises(TransferError, self.source.export_table, 'test_source', self.path, file_format='jsonl')
+        self.source.set_data('test_source', 'key000', '\xff')
+        self.assertRaises(TransferError, self.source.export_table, 'test_source', self.path, file_format='jsonl')
+
+    def test_counters(self):
+        self.source.create_table('test_counter')
+        self.source.incr('test_counter', 'counter', 3)
+        self.assertRaises(TransferError, self.source.export_table, 'test_counter', self.path)
+
+    def test_resume_export(self):
+        checkpoint = {}
+
+        def interrupt(count):
+            if count >= 40:
+                raise KeyboardInterrupt()
+
+        self.assertRaises(KeyboardInterrupt, self.source.export_table, 'test_source', self.path,
+                          page_size=20, checkpoint=checkpoint, progress=interrupt)
+        self.assertEqual(checkpoint['count'], 40)
+        self.assertEqual(self.source.export_table('test_source', self.path, page_size=20, checkpoint=checkpoint), 120)
+        self.target.import_table('test_target', self.path)
+        self.assertEqual(self.copied(), self.items)
+
+    def test_resume_import(self):
+        self.source.export_table('test_source', self.path)
+        checkpoint = {'count': 100}
+        self.assertEqual(self.target.import_table('test_target', self.path, checkpoint=checkpoint), 120)
+        copied = self.copied()
+        self.assertEqual(sum(1 for data in copied.itervalues() if data is not None), 20)
+        self.assertEqual(checkpoint['count'], 120)
+
+    def test_failure(self):
+        self.source.export_table('test_source', self.path)
+        self.assertRaises(Exception, self.target.import_table, 'missing_table', self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        self.assertRaises(TransferError, self.target.import_table, 'test_target', self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+'''
+Tests for sliding window counters, runs without cloud credentials
+'''
+
+import unittest
+from api import Datastore
+from window import Window, WindowError
+
+
+class TestWindowTestCase(unittest.TestCase):
+
+    def test_buckets(self):
+        window = Window(60, retention=300, now=1000)
+        self.assertEqual(window.bucket, 'window_000000000960')
+        self.assertEqual(window.expired_bucket(), 'window_000000000660')
+        names = ['window_%012d' % start for start in xrange(600, 1020, 60)] + ['data']
+        self.assertEqual(window.expired(names), ['window_000000000600', 'window_000000000660'])
+        self.assertRaises(WindowError, Window, 0)
+
+    def test_total(self):
+        buckets = dict(('window_%012d' % start, 1) for start in xrange(0, 1200, 60))
+        buckets['data'] = 100
+        self.assertEqual(Window(now=1000).total(buckets, 300), 5)  # 720 to 960
+        self.assertEqual(Window(now=1000).total(buckets, 60), 1)
+        self.assertEqual(Window(now=1000).total(buckets, 5000), 17)  # not the buckets after now
+        window = Window(60, now=960)
+        self.assertEqual(window.shard(3), 'window_000000000960_3')
+        shards = {window.shard(1): 2, window.shard(2): 3, 'window_000000000900_1': 4}
+        self.assertEqual(window.total(shards, 60), 5)
+        self.assertEqual(window.total(shards, 120), 9)
+        self.assertEqual(Window(60, retention=60, now=1000).expired(shards), ['window_000000000900_1'])
+
+
+class TestMemoryStoreWindowTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Datastore({'engine': 'memory'})
+        self.db.create_table('test_window')
+
+    def test_incr_and_get(self):
+        for now in xrange(1000, 1300, 10):
+            self.db.incr_window('test_window', 'key', 60, now=now)
+        self.db.incr_window('test_window', 'key', 60, amount=5, now=1300)
+        self.assertEqual(self.db.get_window('test_window', 'key', 60, now=1300), 9)  # 1260 to 1300
+        self.assertEqual(self.db.get_window('test_window', 'key', 120, now=1300), 15)
+        self.assertEqual(self.db.get_window('test_window', 'key', 3600, now=1300), 35)
+        self.assertEqual(self.db.get_window('test_window', 'missing', 60, now=1300), 0)
+
+    def test_one_request(self):
+        calls = self.db.db.calls
+        self.db.incr_window('test_window', 'key', 1)
+        self.db.get_window('test_window', 'key', 60)
+        self.assertEqual((calls['update_item'], calls['get_item']), (1, 1))
+
+    def test_expire(self):
+        self.db.incr_window('test_window', 'key', 60, retention=120, now=1000)
+        self.db.incr_window('test_window', 'key', 60, retention=120, now=1070)
+        self.assertEqual(len(self.db.get_table('test_window').windows['key']), 2)
+        self.db.incr_window('test_window', 'key', 60, retention=120, now=5000)
+        self.assertEqual(self.db.get_table('test_window').windows['key'].keys(), ['window_000000004980'])
+        self.assertEqual(self.db.get_window('test_window', 'key', 10000, now=5000), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
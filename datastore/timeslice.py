@@ -0,0 +1,119 @@
+'''
+Lookups across time sliced tables, e.g. 'events_%Y%m%d'
+'''
+import datetime
+import threading
+from multiprocessing.pool import ThreadPool
+from cache import LRUCache
+
+_DEFAULT_LOOKBACK = 1
+_DEFAULT_MAX_WORKERS = 10
+_DEFAULT_NEGATIVE_CACHE_ENTRIES = 100000
+_DEFAULT_NEGATIVE_CACHE_TTL = 3600
+
+# what a lookup reads, the same key names different items, e.g. 'k' and 'k_shard_1'
+DATA = 'data'
+COUNT = 'count'
+SHARDED_COUNT = 'sharded_count'
+
+
+class SliceLookup(object):
+
+    """
+    find a key in the freshest of the current and earlier time slices
+
+    Settings, for the DynamoDB and memory engines
+    'time_slices': {'lookback': 1,       # earlier slices get_data and delete_data look in
+                    'parallel': True,    # look in all slices at once instead of one after another
+                    'max_workers': 10,   # threads of the parallel lookups of this engine
+                    'negative_cache': {'max_entries': 100000, 'ttl': 3600}}
+
+    Earlier slices are no longer written to, so a key missing from one stays
+    missing. With a negative cache those misses are remembered and the slice
+    is not read again for that key until the entry expires, writes through
+    this engine into an earlier slice forget the miss. Misses are kept per
+    kind of lookup, a missing value says nothing about a counter of the key.
+    The current slice is always read.
+    """
+
+    def __init__(self, lookback=_DEFAULT_LOOKBACK, parallel=False, max_workers=_DEFAULT_MAX_WORKERS,
+                 negative_cache=None):
+        self.lookback = lookback
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self.misses = None
+        if negative_cache:
+            options = negative_cache if isinstance(negative_cache, dict) else {}
+            self.misses = LRUCache(max_entries=options.get('max_entries', _DEFAULT_NEGATIVE_CACHE_ENTRIES),
+                                   ttl=options.get('ttl', _DEFAULT_NEGATIVE_CACHE_TTL))
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def table_names(self, table_name, timedelta_slice=1, lookback=None, now=None):
+        """
+        the table names of the slices to look in, the current one first
+        """
+        if '%' not in table_name:
+            return [table_name]
+        if lookback is None:
+            lookback = self.lookback
+        if not timedelta_slice:
+            lookback = 0
+        now = now or datetime.datetime.utcnow()
+        names = []
+        for i in xrange(lookback + 1):
+            name = (now - datetime.timedelta(timedelta_slice) * i).strftime(table_name)
+            if name not in names:
+                names.append(name)
+        return names
+
+    def lookup(self, table_name, key, get, timedelta_slice=1, lookback=None, kind=DATA):
+        """
+        get(slice table name, key) returns None when the key is missing from the slice
+        returns (slice table name, value) of the freshest slice holding the key,
+        (None, None) if none does
+        kind: what get reads, DATA, COUNT or SHARDED_COUNT
+        """
+        names = self.table_names(table_name, timedelta_slice, lookback)
+        current, earlier = names[0], [name for name in names[1:] if not self._known_missing(name, key, kind)]
+        if self.parallel and earlier:
+            pool = self._get_pool()
+            pending = [(name, pool.apply_async(get, (name, key))) for name in earlier]
+            results = ((name, result.get) for name, result in pending)
+        else:
+            results = ((name, lambda name=name: get(name, key)) for name in earlier)
+
+        value = get(current, key)
+        if value is not None:
+            return current, value
+        for name, result in results:
+            value = result()
+            if value is not None:
+                return name, value
+            if self.misses is not None:
+                self.misses.set(name, (kind, key), True)
+        return None, None
+
+    def forget(self, table_name, key, *kinds):
+        """
+        the key was written to the slice table_name, as DATA unless kinds are given
+        """
+        if self.misses is not None:
+            for kind in kinds or (DATA,):
+                self.misses.invalidate(table_name, (kind, key))
+
+    def stats(self):
+        if self.misses is not None:
+            return self.misses.stats()
+        return None
+
+    def _known_missing(self, table_name, key, kind):
+        if self.misses is None:
+            return False
+        return self.misses.get(table_name, (kind, key))[0]
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.max_workers)
+            return self._pool
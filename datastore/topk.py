@@ -0,0 +1,213 @@
+'''
+Approximate top-K counters of a table, Space-Saving summaries fed by incr
+'''
+import json
+import heapq
+import logging
+import threading
+from buffer import close_at_exit, start_timer
+
+logger = logging.getLogger(__name__)
+
+_TOP_K_KEY = '__top_k__'  # the key of the stored summary in the counter table
+_DEFAULT_CAPACITY = 100
+_DEFAULT_INTERVAL = 10.0
+
+
+class TopKError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class SpaceSaving(object):
+
+    """
+    the counts of at most `capacity` keys, a key not tracked replaces the
+    smallest count and takes it over as its error, so counts are upper bounds
+    and every key counted more than total / capacity times is tracked
+    """
+
+    def __init__(self, capacity=_DEFAULT_CAPACITY):
+        self.capacity = max(int(capacity), 1)
+        self.counts = {}
+        self.errors = {}
+        self._heap = []  # (count, key), entries of keys counted since are stale
+
+    def offer(self, key, amount=1):
+        if key in self.counts:
+            self.counts[key] += amount
+            return
+        error = self._evict() if len(self.counts) >= self.capacity else 0
+        self.counts[key] = error + amount
+        self.errors[key] = error
+        heapq.heappush(self._heap, (self.counts[key], key))
+
+    def _evict(self):
+        """
+        drop the key of the smallest count, returns the count
+        """
+        while True:
+            count, key = heapq.heappop(self._heap)
+            if self.counts.get(key) == count:
+                del self.counts[key]
+                del self.errors[key]
+                return count
+            if key in self.counts:
+                heapq.heappush(self._heap, (self.counts[key], key))
+
+    def min_count(self):
+        """
+        the count a key not tracked may have, 0 unless the summary is full
+        """
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.itervalues())
+
+    def update(self, other):
+        """
+        merge the counts of other, a key missing from a full summary
+        may have been counted up to its smallest count
+        """
+        mine, theirs = self.min_count(), other.min_count()
+        counts, errors = {}, {}
+        for key in set(self.counts) | set(other.counts):
+            counts[key] = self.counts.get(key, mine) + other.counts.get(key, theirs)
+            errors[key] = self.errors.get(key, mine) + other.errors.get(key, theirs)
+        kept = sorted(counts, key=counts.get, reverse=True)[:self.capacity]
+        self.counts = dict((key, counts[key]) for key in kept)
+        self.errors = dict((key, errors[key]) for key in kept)
+        self._heap = [(count, key) for key, count in self.counts.iteritems()]
+        heapq.heapify(self._heap)
+
+    def top(self, k):
+        """
+        [(key, count), ...] of the k largest counts, largest first
+        """
+        return [(key, self.counts[key]) for key in heapq.nlargest(k, self.counts, key=self.counts.get)]
+
+    def dumps(self):
+        return json.dumps({'capacity': self.capacity,
+                           'counts': [[key, count, self.errors[key]] for key, count in self.counts.iteritems()]},
+                          separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, value):
+        try:
+            stored = json.loads(value)
+            summary = cls(stored['capacity'])
+            for key, count, error in stored['counts']:
+                summary.counts[key] = count
+                summary.errors[key] = error
+        except (TypeError, ValueError, KeyError) as e:
+            raise TopKError('not a top-K summary: %s' % e)
+        summary._heap = [(count, key) for key, count in summary.counts.iteritems()]
+        heapq.heapify(summary._heap)
+        return summary
+
+
+class TopKTracker(object):
+
+    """
+    count the increments of every counter in a Space-Saving summary per table
+    and merge it into the summary stored in the table every `interval` seconds
+
+    Settings
+    'top_k': {'tables': ['counter'],  # tables tracked, all tables by default
+              'capacity': 100,        # keys of a summary, 10 times the k read is plenty
+              'interval': 10}         # seconds between merges, 0 to merge on flush() only
+
+    The stored summary is the value of the '__top_k__' key of the table, merged
+    with the engine's update_if, so processes merge their summaries without
+    losing each other's. top_k reads it with a single get_data.
+    """
+
+    def __init__(self, engine, tables=None, capacity=_DEFAULT_CAPACITY, interval=_DEFAULT_INTERVAL):
+        self.engine = engine
+        self.tables = set(tables) if tables is not None else None
+        self.capacity = capacity
+        self.interval = interval
+        self._summaries = {}  # table name -> SpaceSaving of the increments since the last merge
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._timer = None
+        if self.interval:
+            self._timer = start_timer(self, 'flush', self.interval, self._closed)
+        close_at_exit(self)
+
+    def offer(self, table_name, key, amount=1):
+        if self.tables is not None and table_name not in self.tables:
+            return
+        with self._lock:
+            summary = self._summaries.get(table_name)
+            if summary is None:
+                summary = self._summaries[table_name] = SpaceSaving(self.capacity)
+            summary.offer(key, amount)
+
+    def flush(self):
+        """
+        merge the summary of every table into the stored one
+        returns the number of tables written
+
+        summaries which fail to be merged are kept for the next flush
+        and the first error is raised after the others are written
+        """
+        with self._flush_lock:
+            with self._lock:
+                summaries, self._summaries = self._summaries, {}
+            written = 0
+            error = None
+            for table_name, summary in summaries.iteritems():
+                try:
+                    self._merge(table_name, summary)
+                    written += 1
+                except Exception as e:
+                    self._restore(table_name, summary)
+                    if error is None:
+                        error = e
+            if error is not None:
+                raise error
+            return written
+
+    def _merge(self, table_name, summary):
+        def merge(current):
+            if current is None:
+                return summary.dumps()
+            stored = SpaceSaving.loads(current)
+            stored.update(summary)
+            return stored.dumps()
+
+        self.engine.update_if(table_name, _TOP_K_KEY, merge)
+
+    def _restore(self, table_name, summary):
+        with self._lock:
+            pending = self._summaries.get(table_name)
+            if pending is not None:
+                summary.update(pending)
+            self._summaries[table_name] = summary
+
+    def close(self):
+        """
+        stop the timer and merge what is left
+        """
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._timer is not None and self._timer is not threading.current_thread():
+            self._timer.join(self.interval)
+        self.flush()
+
+
+def top_k(engine, table_name, k):
+    """
+    [(key, count), ...] of the k largest counters of the table, with one read
+    of the stored summary, counts are upper bounds
+    """
+    stored = engine.get_data(table_name, _TOP_K_KEY)
+    if stored is None:
+        return []
+    return SpaceSaving.loads(stored).top(k)
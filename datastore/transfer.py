@@ -0,0 +1,184 @@
+'''
+Export a table to a local file and import it back, into any engine
+'''
+import json
+import struct
+import logging
+import threading
+import cPickle as pickle
+from multiprocessing.pool import ThreadPool
+from scan import RateLimiter, is_counter_item
+
+logger = logging.getLogger(__name__)
+
+_BINARY_HEADER = 'SSDX\x01'
+_LENGTH = struct.Struct('>I')
+_DEFAULT_BATCH_SIZE = 25  # items of a BatchWriteItem
+_DEFAULT_WORKERS = 4
+
+
+class TransferError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def export_table(engine, table_name, path, file_format='binary', segments=1, page_size=None,
+                 max_units_per_second=None, checkpoint=None, progress=None):
+    """
+    write (key, data) of every item of the table to path, returns the number of records
+
+    file_format: 'binary', records of a 4 bytes length and a pickled (key, data),
+                 or 'jsonl', a json [key, data] per line, for values json can
+                 write, a value it can't fails the export with the key
+    counter tables are refused, import_table would write their counts as values
+    segments, page_size, max_units_per_second: see the scan of the engine
+    checkpoint: dict updated after every scanned page, pass it again to resume
+                an interrupted export into the same file
+    progress: called with the number of records written after every page,
+              once the checkpoint is updated
+    """
+    if file_format not in ('binary', 'jsonl'):
+        raise TransferError("unknown file format '%s'" % file_format)
+    if checkpoint is None:
+        checkpoint = {}
+    scan_checkpoint = dict(checkpoint.get('scan') or {})
+    saved = dict(scan_checkpoint)
+    count = checkpoint.get('count', 0)
+    with open(path, 'r+b' if 'offset' in checkpoint else 'wb') as f:
+        if 'offset' in checkpoint:
+            f.seek(checkpoint['offset'])
+            f.truncate()
+        elif file_format == 'binary':
+            f.write(_BINARY_HEADER)
+        for key, data in engine.scan(table_name, segments=segments, page_size=page_size,
+                                     max_units_per_second=max_units_per_second, checkpoint=scan_checkpoint):
+            if scan_checkpoint != saved:  # a page is done, all of its records are written
+                saved = dict(scan_checkpoint)
+                _save_export(f, checkpoint, saved, count, progress)
+            if is_counter_item(key, data):
+                raise TransferError("'%s' holds counters, they can't be exported" % table_name)
+            f.write(_record(file_format, key, data))
+            count += 1
+        _save_export(f, checkpoint, scan_checkpoint, count, progress)
+    logger.info("Exported %s records of '%s' to %s", count, table_name, path)
+    return count
+
+
+def import_table(engine, table_name, path, batch_size=_DEFAULT_BATCH_SIZE, workers=_DEFAULT_WORKERS,
+                 max_items_per_second=None, checkpoint=None, progress=None):
+    """
+    write the records of an exported file to the table with set_many, returns
+    the number of records, the file format is detected
+
+    batch_size: items per set_many, the batch limit of the backend
+    workers: batches written at the same time
+    checkpoint: dict of the records written, pass it again to resume an
+                interrupted import, records after it may be written twice
+    progress: called with the number of records written, once the checkpoint is updated
+    """
+    if checkpoint is None:
+        checkpoint = {}
+    skip = checkpoint.get('count', 0)
+    limiter = RateLimiter(max_items_per_second) if max_items_per_second else None
+    state = {'watermark': skip, 'done': {}, 'error': None}
+    lock = threading.Lock()
+    in_flight = threading.Semaphore(workers * 2)  # batches read ahead of the writers
+    pool = ThreadPool(workers)
+
+    def write(start, batch):
+        try:
+            if state['error'] is None:
+                engine.set_many(table_name, dict(batch))
+                imported(start, start + len(batch))
+        except Exception as e:
+            state['error'] = state['error'] or e
+        finally:
+            in_flight.release()
+
+    def imported(start, end):
+        with lock:
+            state['done'][start] = end
+            while state['watermark'] in state['done']:
+                state['watermark'] = state['done'].pop(state['watermark'])
+            checkpoint['count'] = state['watermark']
+            if progress is not None:
+                progress(state['watermark'])
+
+    count = 0
+    try:
+        batch = []
+        for key, data in _read_records(path):
+            count += 1
+            if count <= skip:
+                continue
+            batch.append((key, data))
+            if len(batch) == batch_size:
+                _submit(pool, write, count - len(batch), batch, in_flight, limiter, state)
+                batch = []
+        if batch:
+            _submit(pool, write, count - len(batch), batch, in_flight, limiter, state)
+    finally:
+        pool.close()
+        pool.join()
+    if state['error'] is not None:
+        raise state['error']
+    logger.info("Imported %s records of %s to '%s'", count - skip, path, table_name)
+    return count
+
+
+def _submit(pool, write, start, batch, in_flight, limiter, state):
+    if state['error'] is not None:
+        raise state['error']
+    if limiter is not None:
+        limiter.acquire(len(batch))
+    in_flight.acquire()
+    pool.apply_async(write, (start, batch))
+
+
+def _save_export(f, checkpoint, scan_checkpoint, count, progress):
+    f.flush()
+    checkpoint.update({'scan': dict(scan_checkpoint), 'offset': f.tell(), 'count': count})
+    if progress is not None:
+        progress(count)
+
+
+def _record(file_format, key, data):
+    """
+    the bytes of a record, a record that can't be written is not started
+    """
+    if file_format == 'jsonl':
+        try:
+            return json.dumps([key, data]) + '\n'
+        except (TypeError, ValueError) as e:  # UnicodeDecodeError is a ValueError
+            raise TransferError("'%s' can't be written as json, export the binary format: %s" % (key, e))
+    record = pickle.dumps((key, data), pickle.HIGHEST_PROTOCOL)
+    return _LENGTH.pack(len(record)) + record
+
+
+def _read_records(path):
+    """
+    yield (key, data) of the records of an exported file
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(_BINARY_HEADER)) != _BINARY_HEADER:
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    key, data = json.loads(line)
+                    yield key, data
+            return
+        while True:
+            length = f.read(_LENGTH.size)
+            if not length:
+                return
+            if len(length) < _LENGTH.size:
+                raise TransferError('%s is truncated' % path)
+            size = _LENGTH.unpack(length)[0]
+            record = f.read(size)
+            if len(record) < size:
+                raise TransferError('%s is truncated' % path)
+            yield pickle.loads(record)
@@ -0,0 +1,103 @@
+'''
+Sliding window counters, time buckets kept under one counter key
+'''
+import time
+
+_BUCKET_PREFIX = 'window_'
+_BUCKET_FORMAT = _BUCKET_PREFIX + '%012d'  # bucket start in epoch seconds, names sort by time
+_SHARD_FORMAT = '%s_%s'  # a shard of a bucket, sorts after the bucket name and before the next one
+_DEFAULT_RETENTION_BUCKETS = 60
+
+
+class WindowError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class Window(object):
+
+    """
+    the buckets of one incr_window or get_window call
+
+    bucket_seconds: the width of a bucket, buckets start at multiples of it
+    retention: seconds of buckets kept, older ones are deleted by the engine,
+               60 buckets by default
+    now: epoch seconds, the current time by default
+
+    A window of window_seconds sums the buckets that started in the last
+    window_seconds, so it covers between window_seconds - bucket_seconds
+    and window_seconds of increments.
+    """
+
+    def __init__(self, bucket_seconds=None, retention=None, now=None):
+        if bucket_seconds is not None and bucket_seconds < 1:
+            raise WindowError('bucket_seconds must be at least 1, not %s' % bucket_seconds)
+        self.bucket_seconds = bucket_seconds
+        self.now = time.time() if now is None else now
+        if bucket_seconds is not None:
+            retention = retention or _DEFAULT_RETENTION_BUCKETS * bucket_seconds
+            self.buckets = -(-retention // bucket_seconds)  # buckets kept, the current one included
+            self.start = int(self.now) // bucket_seconds * bucket_seconds
+
+    @property
+    def bucket(self):
+        """
+        the name of the current bucket
+        """
+        return _BUCKET_FORMAT % self.start
+
+    def shard(self, shard):
+        """
+        the name of a shard of the current bucket, for engines spreading
+        a bucket over rows, total() sums the shards of a bucket
+        """
+        return _SHARD_FORMAT % (self.bucket, shard)
+
+    def expired_bucket(self):
+        """
+        the name of the bucket that just went out of retention
+        """
+        return _BUCKET_FORMAT % self._cutoff()
+
+    def expired(self, names):
+        """
+        the bucket names out of retention
+        """
+        cutoff = self._cutoff()
+        return [name for name in names if is_bucket(name) and bucket_start(name) <= cutoff]
+
+    def _cutoff(self):
+        return self.start - self.buckets * self.bucket_seconds
+
+    def first_bucket(self, window_seconds):
+        """
+        the name of the oldest bucket in the window, bucket names sort by time
+        """
+        return _BUCKET_FORMAT % max(0, int(self.now - window_seconds) + 1)
+
+    def total(self, buckets, window_seconds):
+        """
+        buckets: dict of bucket or bucket shard name to count, other names are ignored
+        """
+        first = max(0, int(self.now - window_seconds) + 1)
+        return sum(int(count) for name, count in buckets.iteritems()
+                   if is_bucket(name) and first <= bucket_start(name) <= int(self.now))
+
+
+def is_bucket(name):
+    return isinstance(name, basestring) and name.startswith(_BUCKET_PREFIX)
+
+
+def bucket_start(name):
+    return int(name[len(_BUCKET_PREFIX):].split('_', 1)[0])
+
+
+def bucket_bounds():
+    """
+    names sorting before and after every bucket name
+    """
+    return _BUCKET_PREFIX, _BUCKET_PREFIX + '~'